@@ -0,0 +1,293 @@
+"""Нагрузочный тест обработки входящих сообщений.
+
+Синтетические обновления от множества пользователей (текст, фото, стикеры, альбомы) проходят
+через те же обработчики и тот же UserLaneUpdateProcessor, что и в рабочем боте. Telegram заменен
+поддельным Bot API, который записывает вызовы и умеет добавлять задержку и ответы 429. База -
+mongomock в памяти (pip install mongomock) или отдельная база на настоящем сервере:
+
+    python benchmarks/load_test.py --updates 5000 --users 500 --rate 200
+    MONGODB_URI=mongodb://localhost:27017/ python benchmarks/load_test.py --mongo server
+
+Лимиты и размеры очередей берутся из тех же переменных окружения, что и у бота, например
+OUTBOUND_CHAT_RATE=30 python benchmarks/load_test.py. Локальный журнал создается во временном
+каталоге; --outage 5 делает запись сообщений в базу недоступной первые 5 секунд, чтобы
+проверить запись в журнал и перенос из него. Для сравнения запусков между собой:
+
+    python benchmarks/load_test.py --save baseline.json
+    python benchmarks/load_test.py --compare baseline.json --tolerance 0.15
+
+При сравнении скрипт завершается с кодом 1, если пропускная способность упала, а p99 или число
+вызовов Bot API на обновление выросли больше допустимого.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from collections import Counter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("ADMIN_USER_ID", "1")
+os.environ.setdefault("TELEGRAM_BOT_TOKEN", "123456:load-test")
+os.environ.setdefault("MONGODB_URI", "mongodb://localhost:27017/")
+os.environ["MONGODB_DB"] = os.getenv("BENCH_MONGODB_DB", "telegram_bot_bench")
+os.environ["METRICS_PORT"] = "0"
+os.environ["SPOOL_PATH"] = os.path.join(tempfile.mkdtemp(prefix="load_test_"), "spool.sqlite3")
+os.environ.setdefault("SPOOL_REPLAY_INTERVAL", "1")
+
+import main  # noqa: E402
+from pymongo.errors import AutoReconnect  # noqa: E402
+from telegram import Update  # noqa: E402
+
+# Доля каждого вида обновлений; альбом - одно «событие» из нескольких обновлений
+MIX = [("text", 70), ("photo", 15), ("sticker", 10), ("album", 5)]
+WORDS = ["привет", "заказ", "доставка", "вопрос", "спасибо", "когда", "оплата", "адрес", "можно", "сегодня"]
+
+class FakeBotAPI(main.DryRunRequest):
+    """Поддельный Bot API: отвечает как DryRunRequest, но с задержкой и случайными 429."""
+
+    def __init__(self, latency, rate_limit_share, retry_after):
+        super().__init__()
+        self.latency = latency
+        self.rate_limit_share = rate_limit_share
+        self.retry_after = retry_after
+        self.calls = Counter()
+        self.rate_limited = 0
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None,
+                         write_timeout=None, connect_timeout=None, pool_timeout=None):
+        api_method = url.rsplit("/", 1)[-1]
+        self.calls[api_method] += 1
+        if self.latency:
+            await asyncio.sleep(random.uniform(0.5, 1.5) * self.latency)
+        if api_method != "getMe" and random.random() < self.rate_limit_share:
+            self.rate_limited += 1
+            return 429, json.dumps({
+                "ok": False,
+                "error_code": 429,
+                "description": f"Too Many Requests: retry after {self.retry_after}",
+                "parameters": {"retry_after": self.retry_after}
+            }).encode()
+        return await super().do_request(url, method, request_data, read_timeout, write_timeout, connect_timeout, pool_timeout)
+
+class OutageCollection:
+    """Коллекция, в которую первые seconds секунд нельзя записать сообщения."""
+
+    def __init__(self, collection, seconds):
+        self.collection = collection
+        self.until = time.monotonic() + seconds
+        self.failed = 0
+
+    def __getattr__(self, name):
+        return getattr(self.collection, name)
+
+    def insert_many(self, *args, **kwargs):
+        if time.monotonic() < self.until:
+            self.failed += 1
+            raise AutoReconnect("база недоступна (--outage)")
+        return self.collection.insert_many(*args, **kwargs)
+
+class UpdateFactory:
+    def __init__(self, users):
+        self.users = users
+        self.update_ids = iter(range(1, 10 ** 9))
+
+    def _message(self, user_id, **content):
+        update_id = next(self.update_ids)
+        return {
+            "update_id": update_id,
+            "message": {
+                "message_id": update_id,
+                "date": int(time.time()),
+                "chat": {"id": user_id, "type": "private"},
+                "from": {"id": user_id, "is_bot": False, "first_name": "Имя", "username": f"user{user_id}"},
+                **content
+            }
+        }
+
+    @staticmethod
+    def _photo(name):
+        return [{"file_id": f"photo_{name}", "file_unique_id": f"u_{name}", "width": 90, "height": 90}]
+
+    def event(self, kind):
+        # Возвращает данные одного или нескольких обновлений; объекты Update создаются перед отправкой
+        user_id = random.randint(2, self.users + 1)
+        text = " ".join(random.choices(WORDS, k=random.randint(1, 12)))
+        if kind == "text":
+            return [self._message(user_id, text=text)]
+        if kind == "photo":
+            return [self._message(user_id, photo=self._photo(random.getrandbits(32)), caption=text)]
+        if kind == "sticker":
+            sticker = {
+                "file_id": "sticker_1", "file_unique_id": "u_sticker_1", "width": 512, "height": 512,
+                "is_animated": False, "is_video": False, "type": "regular"
+            }
+            return [self._message(user_id, sticker=sticker)]
+        media_group_id = str(random.getrandbits(48))
+        return [
+            self._message(user_id, photo=self._photo(random.getrandbits(32)), media_group_id=media_group_id)
+            for _ in range(random.randint(2, 4))
+        ]
+
+def use_memory_mongo():
+    try:
+        import mongomock
+    except ImportError:
+        sys.exit("Для --mongo memory нужен mongomock: pip install mongomock")
+    database = mongomock.MongoClient()[main.MONGODB_DB]
+    main.db = database
+    for value in vars(main).values():
+        if isinstance(value, main.AsyncCollection):
+            value.collection = database[value.collection.name]
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+async def process(application, data, latencies):
+    update = Update.de_json(data, application.bot)
+    started = time.perf_counter()
+    await main.update_processor.process_update(update, application.process_update(update))
+    latencies[update.update_id] = time.perf_counter() - started
+
+async def run(args):
+    random.seed(args.seed)
+    if args.mongo == "memory":
+        use_memory_mongo()
+    else:
+        main.client.drop_database(main.MONGODB_DB)
+        await main.ensure_schema()
+
+    outage = None
+    if args.outage:
+        outage = main.messages_collection.collection = OutageCollection(main.messages_collection.collection, args.outage)
+
+    api = FakeBotAPI(args.api_latency, args.rate_limit, args.retry_after)
+    application = main.build_application(api)
+    await application.initialize()
+    # Запущенное приложение дожидается при остановке задач create_task, например, отложенных альбомов
+    await application.start()
+    # Тот же порядок запуска, что и в post_init, без фоновых задач, которые не участвуют в приеме сообщений
+    await main.spool.open()
+    await main.blocklist.load()
+    main.message_buffer.start()
+    main.background_tasks.append(asyncio.create_task(main.spool.run(main.messages_collection)))
+    main.background_tasks.append(asyncio.create_task(main.digest.run(application.bot)))
+    api.calls.clear()
+
+    factory = UpdateFactory(args.users)
+    kinds = [kind for kind, _ in MIX]
+    weights = [weight for _, weight in MIX]
+    latencies = {}
+    tasks = []
+    sent = 0
+    started = time.perf_counter()
+    while sent < args.updates:
+        for data in factory.event(random.choices(kinds, weights)[0]):
+            tasks.append(asyncio.create_task(process(application, data, latencies)))
+            sent += 1
+        if args.rate:
+            # Открытая модель нагрузки: обновления приходят по расписанию, а не после обработки предыдущих
+            delay = started + sent / args.rate - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+    await asyncio.gather(*tasks)
+    handled = time.perf_counter() - started
+
+    # Альбомы досылаются после паузы, а исходящие вызовы и запись в базу завершаются при остановке
+    await application.stop()
+    if outage:
+        # Журнал переносится в базу фоновой задачей; дожидаемся переноса до ее остановки
+        while main.spool.active or len(main.message_buffer):
+            await asyncio.sleep(0.1)
+    await main.post_stop(application)
+    finished = time.perf_counter() - started
+    await application.shutdown()
+    main.spool.close()
+    shutil.rmtree(os.path.dirname(main.SPOOL_PATH), ignore_errors=True)
+
+    values = list(latencies.values())
+    api_calls = sum(api.calls.values())
+    stored = await main.messages_collection.run(main.messages_collection.collection.count_documents, {})
+    return {
+        "updates": sent,
+        "updates_per_second": round(sent / handled, 1),
+        "latency_ms": {
+            "p50": round(statistics.median(values) * 1000, 2),
+            "p95": round(percentile(values, 0.95) * 1000, 2),
+            "p99": round(percentile(values, 0.99) * 1000, 2),
+            "max": round(max(values) * 1000, 2),
+        },
+        "drain_seconds": round(finished - handled, 2),
+        "api_calls_per_update": round(api_calls / sent, 3),
+        "api_calls": dict(api.calls.most_common()),
+        "rate_limited": api.rate_limited,
+        "stored_messages": stored,
+        "outage_failed_writes": outage.failed if outage else 0,
+        "config": {
+            "users": args.users, "rate": args.rate, "api_latency": args.api_latency, "rate_limit": args.rate_limit,
+            "mongo": args.mongo, "outage": args.outage, "seed": args.seed, "concurrency": main.UPDATE_CONCURRENCY,
+            "outbound_chat_rate": main.OUTBOUND_CHAT_RATE, "outbound_global_rate": main.OUTBOUND_GLOBAL_RATE,
+        },
+    }
+
+def report(result):
+    latency = result["latency_ms"]
+    print(f"Обновлений: {result['updates']}, обработано в секунду: {result['updates_per_second']}")
+    print(f"Задержка, мс: p50 {latency['p50']}, p95 {latency['p95']}, p99 {latency['p99']}, макс. {latency['max']}")
+    print(f"Досылка очередей после обработки: {result['drain_seconds']} с")
+    print(f"Вызовов Bot API на обновление: {result['api_calls_per_update']}, ответов 429: {result['rate_limited']}")
+    for method, count in result["api_calls"].items():
+        print(f"    {method}: {count}")
+    print(f"Сохранено сообщений в базе: {result['stored_messages']}")
+    if result["outage_failed_writes"]:
+        print(f"Неудачных записей во время недоступности базы: {result['outage_failed_writes']}")
+
+def compare(result, baseline, tolerance):
+    checks = [
+        ("обновлений в секунду", result["updates_per_second"], baseline["updates_per_second"], False),
+        ("p99, мс", result["latency_ms"]["p99"], baseline["latency_ms"]["p99"], True),
+        ("вызовов Bot API на обновление", result["api_calls_per_update"], baseline["api_calls_per_update"], True),
+    ]
+    regressed = False
+    for name, current, previous, lower_is_better in checks:
+        change = (current - previous) / previous if previous else 0.0
+        worse = change > tolerance if lower_is_better else change < -tolerance
+        regressed = regressed or worse
+        print(f"{'❌' if worse else '✅'} {name}: {previous} -> {current} ({change:+.1%})")
+    return regressed
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Нагрузочный тест обработки входящих сообщений")
+    parser.add_argument("--updates", type=int, default=2000, help="сколько обновлений отправить")
+    parser.add_argument("--users", type=int, default=200, help="число разных пользователей")
+    parser.add_argument("--rate", type=float, default=200, help="обновлений в секунду (0 - все сразу)")
+    parser.add_argument("--api-latency", type=float, default=0.05, help="средняя задержка ответа Bot API, с")
+    parser.add_argument("--rate-limit", type=float, default=0.0, help="доля вызовов Bot API, получающих 429")
+    parser.add_argument("--retry-after", type=int, default=1, help="retry_after в ответах 429, с")
+    parser.add_argument("--mongo", choices=["memory", "server"], default="memory", help="mongomock или MONGODB_URI")
+    parser.add_argument("--outage", type=float, default=0, help="сколько секунд запись в базу недоступна")
+    parser.add_argument("--seed", type=int, default=1, help="зерно генератора для повторяемых прогонов")
+    parser.add_argument("--save", help="сохранить результат в JSON-файл")
+    parser.add_argument("--compare", help="сравнить с сохраненным результатом")
+    parser.add_argument("--tolerance", type=float, default=0.15, help="допустимое ухудшение при сравнении")
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    args = parse_args()
+    logging.getLogger().setLevel(logging.WARNING)
+    result = asyncio.run(run(args))
+    report(result)
+    if args.save:
+        with open(args.save, "w", encoding="utf-8") as file:
+            json.dump(result, file, ensure_ascii=False, indent=2)
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as file:
+            baseline = json.load(file)
+        sys.exit(1 if compare(result, baseline, args.tolerance) else 0)
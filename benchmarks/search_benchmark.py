@@ -0,0 +1,107 @@
+"""Замер задержки /search на синтетическом корпусе сообщений.
+
+Нужна работающая MongoDB; данные пишутся в отдельную базу (BENCH_MONGODB_DB, по умолчанию
+telegram_bot_bench), рабочая база не затрагивается:
+
+    MONGODB_URI=mongodb://localhost:27017/ python benchmarks/search_benchmark.py --messages 1000000
+
+Индексы создаются той же функцией ensure_schema, что и при запуске бота, а запросы выполняются
+теми же функциями, что и команда /search.
+"""
+import argparse
+import asyncio
+import os
+import random
+import statistics
+import sys
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("ADMIN_USER_ID", "1")
+os.environ["MONGODB_DB"] = os.getenv("BENCH_MONGODB_DB", "telegram_bot_bench")
+
+import main  # noqa: E402
+
+# Слова в разных формах, чтобы проверить стемминг: запрос «заказ» должен находить «заказа», «заказом» и т.д.
+WORDS = [
+    "заказ", "заказа", "заказом", "заказы", "доставка", "доставки", "доставку", "оплата", "оплаты",
+    "оплатил", "спасибо", "привет", "здравствуйте", "вопрос", "вопросы", "цена", "цены", "скидка",
+    "скидку", "товар", "товара", "товары", "возврат", "возврата", "адрес", "адреса", "курьер",
+    "курьера", "подскажите", "пожалуйста", "когда", "сколько", "можно", "нужно", "сегодня", "завтра",
+    "не", "и", "в", "на", "по", "с", "для", "это", "у", "меня", "вас", "есть", "будет",
+]
+QUERIES = ["заказ", "доставка курьером", "возврат товара", "скидки", "оплатила", "здравствуйте вопрос"]
+
+def generate_messages(count, users, batch_size):
+    collection = main.messages_collection.collection
+    start = datetime.now() - timedelta(days=365)
+    step = timedelta(days=365) / count
+    for offset in range(0, count, batch_size):
+        batch = []
+        for i in range(offset, min(offset + batch_size, count)):
+            user_id = random.randint(1, users)
+            batch.append({
+                "user_id": user_id,
+                "username": f"user{user_id}",
+                "first_name": "Имя",
+                "last_name": "",
+                "message_id": i,
+                "text": " ".join(random.choices(WORDS, k=random.randint(3, 20))),
+                "caption": "",
+                "date": start + step * i,
+                "file_id": None,
+                "file_type": None
+            })
+        collection.insert_many(batch, ordered=False)
+        print(f"\rСгенерировано {min(offset + batch_size, count)} из {count}", end="", flush=True)
+    print()
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+async def measure(runs, users):
+    print(f"{'запрос':<40} {'p50, мс':>9} {'p95, мс':>9} {'p99, мс':>9} {'стр. 2, мс':>11}")
+    for query in QUERIES + [f"user:{random.randint(1, users)} заказ", "from:01.01.2000 to:01.01.2100 доставка"]:
+        session = main.parse_search_args(query.split())
+        search_filter = main.build_search_filter(session)
+        first_page = []
+        next_page = []
+        for _ in range(runs):
+            started = time.perf_counter()
+            messages, _, has_older = await main.fetch_messages_page(None, None, main.MESSAGES_PAGE_SIZE, search_filter)
+            first_page.append((time.perf_counter() - started) * 1000)
+            if has_older:
+                cursor = main.decode_message_cursor(*main.encode_message_cursor(messages[-1]).split("_"))
+                started = time.perf_counter()
+                await main.fetch_messages_page("older", cursor, main.MESSAGES_PAGE_SIZE, search_filter)
+                next_page.append((time.perf_counter() - started) * 1000)
+        print(
+            f"{query:<40} {statistics.median(first_page):>9.1f} {percentile(first_page, 0.95):>9.1f} "
+            f"{percentile(first_page, 0.99):>9.1f} {statistics.median(next_page) if next_page else 0:>11.1f}"
+        )
+
+async def run(args):
+    collection = main.messages_collection.collection
+    if not args.reuse or collection.estimated_document_count() != args.messages:
+        main.client.drop_database(main.MONGODB_DB)
+        started = time.perf_counter()
+        generate_messages(args.messages, args.users, args.batch)
+        print(f"Вставка: {time.perf_counter() - started:.1f} с")
+    started = time.perf_counter()
+    await main.ensure_schema()
+    print(f"Создание индексов: {time.perf_counter() - started:.1f} с")
+    await measure(args.runs, args.users)
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Замер задержки полнотекстового поиска /search")
+    parser.add_argument("--messages", type=int, default=1_000_000, help="размер корпуса")
+    parser.add_argument("--users", type=int, default=5000, help="число разных пользователей")
+    parser.add_argument("--batch", type=int, default=10_000, help="размер пакета вставки")
+    parser.add_argument("--runs", type=int, default=20, help="повторов каждого запроса")
+    parser.add_argument("--reuse", action="store_true", help="не пересоздавать корпус, если он уже нужного размера")
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    asyncio.run(run(parse_args()))
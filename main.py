@@ -1,28 +1,1237 @@
 import os
+import asyncio
+import atexit
+import contextvars
+import functools
+import hashlib
+import heapq
+import itertools
 import logging
+import logging.handlers
+import queue
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+from aiohttp import web
 from dotenv import load_dotenv
 from telegram import Update, ForceReply, InlineKeyboardMarkup, InlineKeyboardButton
+from telegram import InputMediaPhoto, InputMediaVideo, InputMediaDocument, InputMediaAudio
+from telegram.error import RetryAfter, NetworkError, BadRequest, Forbidden
+from telegram.request import BaseRequest, HTTPXRequest
+from telegram.ext import BaseUpdateProcessor
 from telegram.ext import Application, CommandHandler, MessageHandler, filters, CallbackContext, CallbackQueryHandler
-from pymongo import MongoClient
-from datetime import datetime
+from pymongo import MongoClient, ReturnDocument, ASCENDING, DESCENDING, UpdateOne, monitoring
+from pymongo.errors import DuplicateKeyError, BulkWriteError, CollectionInvalid
+import bson
+from bson import ObjectId
+from prometheus_client import Counter, Gauge, Histogram, start_http_server
+from datetime import datetime, timedelta
 import re
+import io
+import csv
+import gzip
+import json
+import tempfile
+from pathlib import Path
+import signal
+import secrets
+import sqlite3
+from collections import deque, OrderedDict
 
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO
-)
 logger = logging.getLogger(__name__)
 
 load_dotenv()
 TELEGRAM_TOKEN = os.getenv('TELEGRAM_BOT_TOKEN')
 ADMIN_USER_ID = int(os.getenv('ADMIN_USER_ID'))
+BOT_MODE = os.getenv('BOT_MODE', 'polling')
+TELEGRAM_DRY_RUN = os.getenv('TELEGRAM_DRY_RUN', '') == '1'
+WEBHOOK_URL = os.getenv('WEBHOOK_URL', '')
+WEBHOOK_LISTEN = os.getenv('WEBHOOK_LISTEN', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', '8080'))
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/telegram')
+WEBHOOK_SECRET_TOKEN = os.getenv('WEBHOOK_SECRET_TOKEN', '')
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv('WEBHOOK_MAX_CONNECTIONS', '40'))
+WEBHOOK_MAX_PENDING = int(os.getenv('WEBHOOK_MAX_PENDING', '500'))
+UPDATE_CONCURRENCY = int(os.getenv('UPDATE_CONCURRENCY', '16'))
+UPDATE_MAX_PENDING = int(os.getenv('UPDATE_MAX_PENDING', '1000'))
+# При polling обновления получает только один процесс, и локальный кэш состояния ответа достоверен.
+# При вебхуке обновления могут обрабатывать несколько экземпляров, поэтому состояние всегда читается из базы
+REPLY_STATE_CACHE_TTL = float(os.getenv('REPLY_STATE_CACHE_TTL', '3600' if BOT_MODE == 'polling' else '0'))
+UPDATE_DEDUP = os.getenv('UPDATE_DEDUP', '1' if BOT_MODE == 'webhook' else '0') == '1'
+UPDATE_DEDUP_TTL = int(os.getenv('UPDATE_DEDUP_TTL', '86400'))
+UPDATE_CLAIM_TIMEOUT = float(os.getenv('UPDATE_CLAIM_TIMEOUT', '1'))
+UPDATE_CLAIM_RETRY = float(os.getenv('UPDATE_CLAIM_RETRY', '30'))
 MONGODB_URI = os.getenv('MONGODB_URI')
 MONGODB_DB = os.getenv('MONGODB_DB')
+MONGODB_POOL_SIZE = int(os.getenv('MONGODB_POOL_SIZE', '10'))
+MONGODB_TIMEOUT_MS = int(os.getenv('MONGODB_TIMEOUT_MS', '5000'))
+BLOCKLIST_REFRESH_INTERVAL = int(os.getenv('BLOCKLIST_REFRESH_INTERVAL', '30'))
+MESSAGE_BATCH_SIZE = int(os.getenv('MESSAGE_BATCH_SIZE', '100'))
+MESSAGE_FLUSH_INTERVAL = float(os.getenv('MESSAGE_FLUSH_INTERVAL', '0.5'))
+MESSAGE_BUFFER_LIMIT = int(os.getenv('MESSAGE_BUFFER_LIMIT', '1000'))
+MESSAGE_SHUTDOWN_TIMEOUT = float(os.getenv('MESSAGE_SHUTDOWN_TIMEOUT', '30'))
+SPOOL_PATH = os.getenv('SPOOL_PATH', 'data/spool.sqlite3')
+SPOOL_REPLAY_INTERVAL = float(os.getenv('SPOOL_REPLAY_INTERVAL', '5'))
+DB_INIT_RETRY_MAX = float(os.getenv('DB_INIT_RETRY_MAX', '60'))
+OUTBOUND_GLOBAL_RATE = float(os.getenv('OUTBOUND_GLOBAL_RATE', '25'))
+OUTBOUND_CHAT_RATE = float(os.getenv('OUTBOUND_CHAT_RATE', '1'))
+OUTBOUND_CHAT_BURST = int(os.getenv('OUTBOUND_CHAT_BURST', '5'))
+OUTBOUND_MAX_RETRIES = int(os.getenv('OUTBOUND_MAX_RETRIES', '5'))
+MEDIA_GROUP_WINDOW = float(os.getenv('MEDIA_GROUP_WINDOW', '1.5'))
+DIGEST_THRESHOLD = int(os.getenv('DIGEST_THRESHOLD', '30'))
+DIGEST_INTERVAL = int(os.getenv('DIGEST_INTERVAL', '60'))
+DIGEST_MAX_USERS = int(os.getenv('DIGEST_MAX_USERS', '20'))
+FLOOD_RATE = float(os.getenv('FLOOD_RATE', '0.5'))
+FLOOD_BURST = int(os.getenv('FLOOD_BURST', '10'))
+FLOOD_STRIKES = int(os.getenv('FLOOD_STRIKES', '20'))
+FLOOD_MUTE_SECONDS = int(os.getenv('FLOOD_MUTE_SECONDS', '600'))
+FLOOD_MAX_USERS = int(os.getenv('FLOOD_MAX_USERS', '10000'))
+DEDUP_WINDOW = int(os.getenv('DEDUP_WINDOW', '600'))
+DEDUP_MAX_ENTRIES = int(os.getenv('DEDUP_MAX_ENTRIES', '10000'))
+DEDUP_FLUSH_INTERVAL = float(os.getenv('DEDUP_FLUSH_INTERVAL', '5'))
+MESSAGES_PAGE_SIZE = int(os.getenv('MESSAGES_PAGE_SIZE', '10'))
+MESSAGES_PAGE_SIZE_MAX = 50
+MESSAGE_PAGE_CACHE_TTL = float(os.getenv('MESSAGE_PAGE_CACHE_TTL', '60'))
+MESSAGE_PAGE_CACHE_SIZE = int(os.getenv('MESSAGE_PAGE_CACHE_SIZE', '100'))
+RETENTION_DAYS = int(os.getenv('RETENTION_DAYS', '0'))
+RETENTION_INTERVAL = int(os.getenv('RETENTION_INTERVAL', '3600'))
+RETENTION_BATCH_SIZE = int(os.getenv('RETENTION_BATCH_SIZE', '500'))
+RETENTION_PAUSE = float(os.getenv('RETENTION_PAUSE', '1.0'))
+# Telegram принимает от ботов файлы до 50 МБ, части экспорта делаются с запасом
+EXPORT_PART_SIZE = int(os.getenv('EXPORT_PART_SIZE', str(45 * 1024 * 1024)))
+EXPORT_UPLOAD_TIMEOUT = float(os.getenv('EXPORT_UPLOAD_TIMEOUT', '300'))
+BROADCAST_RATE = float(os.getenv('BROADCAST_RATE', '20'))
+BROADCAST_CONCURRENCY = int(os.getenv('BROADCAST_CONCURRENCY', '50'))
+BROADCAST_BATCH_SIZE = int(os.getenv('BROADCAST_BATCH_SIZE', '200'))
+BROADCAST_PROGRESS_INTERVAL = float(os.getenv('BROADCAST_PROGRESS_INTERVAL', '5'))
+BROADCAST_LEASE = int(os.getenv('BROADCAST_LEASE', '120'))
+METRICS_LISTEN = os.getenv('METRICS_LISTEN', '127.0.0.1')
+METRICS_PORT = int(os.getenv('METRICS_PORT', '9090'))
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'json')
+LOG_SAMPLE_RATE = float(os.getenv('LOG_SAMPLE_RATE', '1.0'))
+
+# Идентификатор обновления, в рамках которого сделана запись в журнал, и попало ли обновление в выборку
+correlation_id = contextvars.ContextVar("correlation_id", default="-")
+log_sampled = contextvars.ContextVar("log_sampled", default=True)
+
+class CorrelationFilter(logging.Filter):
+    """Добавляет к записи идентификатор обновления и отбрасывает информационные записи вне выборки.
+
+    Решение о выборке принимается один раз на обновление, поэтому записи одного обновления
+    сохраняются или отбрасываются вместе. Предупреждения и ошибки сохраняются всегда.
+    """
+
+    def filter(self, record):
+        record.correlation_id = correlation_id.get()
+        return record.levelno >= logging.WARNING or log_sampled.get()
+
+class LogQueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record):
+        # Аргументы подставляются в вызывающем потоке, пока объекты не изменились, а JSON и запись
+        # в поток вывода выполняются в фоновом потоке
+        record = logging.makeLogRecord(record.__dict__)
+        record.message = record.getMessage()
+        record.msg, record.args = record.message, None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "correlation_id": getattr(record, "correlation_id", "-"),
+            "message": record.getMessage(),
+        }
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+def setup_logging():
+    # Очередь не ограничена: запись в журнал никогда не блокирует цикл событий и не теряет ошибки
+    log_queue = queue.SimpleQueue()
+    queue_handler = LogQueueHandler(log_queue)
+    queue_handler.addFilter(CorrelationFilter())
+    output = logging.StreamHandler()
+    if LOG_FORMAT == 'json':
+        output.setFormatter(JsonFormatter())
+    else:
+        output.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - [%(correlation_id)s] %(message)s'))
+    root = logging.getLogger()
+    root.handlers = [queue_handler]
+    root.setLevel(LOG_LEVEL)
+    listener = logging.handlers.QueueListener(log_queue, output)
+    listener.start()
+    # При выходе оставшиеся в очереди записи дописываются до завершения процесса
+    atexit.register(listener.stop)
+
+setup_logging()
+
+# Метрики в формате Prometheus отдаются по http://METRICS_LISTEN:METRICS_PORT/metrics (0 - не отдавать)
+HANDLER_LATENCY = Histogram("bot_handler_seconds", "Время выполнения обработчика обновления", ["handler"])
+HANDLER_ERRORS = Counter("bot_handler_errors_total", "Необработанные исключения в обработчиках", ["handler"])
+MONGO_LATENCY = Histogram(
+    "bot_mongo_command_seconds", "Время выполнения команды MongoDB", ["command", "collection"],
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+)
+MONGO_FAILURES = Counter("bot_mongo_command_failures_total", "Команды MongoDB, завершившиеся ошибкой", ["command", "collection"])
+MONGO_EXECUTOR_WAIT = Histogram(
+    "bot_mongo_executor_wait_seconds", "Ожидание свободного потока в пуле обращений к базе",
+    buckets=(0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+)
+BOT_API_LATENCY = Histogram("bot_api_request_seconds", "Время вызова метода Bot API", ["method"])
+BOT_API_ERRORS = Counter("bot_api_errors_total", "Ошибки вызовов Bot API", ["method", "error"])
+UPDATE_LAG = Histogram(
+    "bot_update_lag_seconds", "Время от отправки сообщения пользователем до начала его обработки",
+    buckets=(0.5, 1.0, 2.0, 5.0, 10.0, 30.0, 60.0, 300.0)
+)
+MESSAGES_RECEIVED = Counter("bot_messages_total", "Входящие сообщения пользователей по типу", ["type"])
+FLOOD_DROPPED = Counter("bot_flood_dropped_total", "Сообщения, отброшенные ограничением частоты")
+UPDATES_RUNNING = Gauge("bot_updates_running", "Обновления, обрабатываемые в данный момент")
+UPDATES_PENDING = Gauge("bot_updates_pending", "Обновления, ожидающие в очередях пользователей")
+OUTBOUND_DEPTH = Gauge("bot_outbound_queue_depth", "Исходящие вызовы Bot API в очереди")
+BUFFER_DEPTH = Gauge("bot_write_buffer_depth", "Сообщения, ожидающие записи в базу")
+
+class MongoCommandMetrics(monitoring.CommandListener):
+    """Время каждой команды, которую pymongo отправляет серверу, включая getMore курсоров."""
 
-client = MongoClient(MONGODB_URI)
+    def __init__(self):
+        self.collections = {}
+
+    def started(self, event):
+        # getMore хранит в поле команды номер курсора, а имя коллекции - в поле collection
+        field = "collection" if event.command_name == "getMore" else event.command_name
+        collection = event.command.get(field)
+        self.collections[event.request_id] = collection if isinstance(collection, str) else ""
+
+    def succeeded(self, event):
+        collection = self.collections.pop(event.request_id, "")
+        MONGO_LATENCY.labels(event.command_name, collection).observe(event.duration_micros / 1e6)
+
+    def failed(self, event):
+        collection = self.collections.pop(event.request_id, "")
+        MONGO_LATENCY.labels(event.command_name, collection).observe(event.duration_micros / 1e6)
+        MONGO_FAILURES.labels(event.command_name, collection).inc()
+
+client = MongoClient(
+    MONGODB_URI,
+    maxPoolSize=MONGODB_POOL_SIZE,
+    serverSelectionTimeoutMS=MONGODB_TIMEOUT_MS,
+    connectTimeoutMS=MONGODB_TIMEOUT_MS,
+    socketTimeoutMS=MONGODB_TIMEOUT_MS,
+    waitQueueTimeoutMS=MONGODB_TIMEOUT_MS,
+    event_listeners=[MongoCommandMetrics()],
+    # Соединение устанавливается при первом запросе, импорт и запуск бота не ждут базу
+    connect=False,
+)
 db = client[MONGODB_DB]
-messages_collection = db['messages']
-blocked_users_collection = db['blocked_users']
+
+# pymongo синхронный, поэтому все обращения к базе выполняются в ограниченном пуле потоков,
+# а цикл событий бота в это время продолжает обрабатывать другие обновления
+mongo_executor = ThreadPoolExecutor(max_workers=MONGODB_POOL_SIZE, thread_name_prefix="mongo")
+
+class AsyncCollection:
+    """Асинхронная обертка над коллекцией pymongo."""
+
+    def __init__(self, collection, executor):
+        self.collection = collection
+        self.executor = executor
+
+    async def run(self, func, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        submitted = time.perf_counter()
+        
+        def call():
+            MONGO_EXECUTOR_WAIT.observe(time.perf_counter() - submitted)
+            return func(*args, **kwargs)
+        return await loop.run_in_executor(self.executor, call)
+
+    async def find(self, filter=None, projection=None, sort=None, limit=0):
+        # Курсор читается целиком внутри пула потоков, чтобы итерация тоже не блокировала цикл событий
+        def query():
+            cursor = self.collection.find(filter or {}, projection)
+            if sort:
+                cursor = cursor.sort(sort)
+            if limit:
+                cursor = cursor.limit(limit)
+            return list(cursor)
+        return await self.run(query)
+
+    async def find_one(self, *args, **kwargs):
+        return await self.run(self.collection.find_one, *args, **kwargs)
+
+    async def count_documents(self, *args, **kwargs):
+        return await self.run(self.collection.count_documents, *args, **kwargs)
+
+    async def insert_one(self, *args, **kwargs):
+        return await self.run(self.collection.insert_one, *args, **kwargs)
+
+    async def insert_many(self, *args, **kwargs):
+        return await self.run(self.collection.insert_many, *args, **kwargs)
+
+    async def update_one(self, *args, **kwargs):
+        return await self.run(self.collection.update_one, *args, **kwargs)
+
+    async def delete_one(self, *args, **kwargs):
+        return await self.run(self.collection.delete_one, *args, **kwargs)
+
+    async def find_one_and_update(self, *args, **kwargs):
+        return await self.run(self.collection.find_one_and_update, *args, **kwargs)
+
+    async def update_many(self, *args, **kwargs):
+        return await self.run(self.collection.update_many, *args, **kwargs)
+
+    async def delete_many(self, *args, **kwargs):
+        return await self.run(self.collection.delete_many, *args, **kwargs)
+
+    async def aggregate(self, pipeline, **kwargs):
+        return await self.run(lambda: list(self.collection.aggregate(pipeline, **kwargs)))
+
+    async def create_index(self, *args, **kwargs):
+        return await self.run(self.collection.create_index, *args, **kwargs)
+
+    async def bulk_write(self, *args, **kwargs):
+        return await self.run(self.collection.bulk_write, *args, **kwargs)
+
+messages_collection = AsyncCollection(db['messages'], mongo_executor)
+blocked_users_collection = AsyncCollection(db['blocked_users'], mongo_executor)
+meta_collection = AsyncCollection(db['meta'], mongo_executor)
+users_collection = AsyncCollection(db['users'], mongo_executor)
+conversation_state_collection = AsyncCollection(db['conversation_state'], mongo_executor)
+processed_updates_collection = AsyncCollection(db['processed_updates'], mongo_executor)
+search_sessions_collection = AsyncCollection(db['search_sessions'], mongo_executor)
+messages_archive_collection = AsyncCollection(db['messages_archive'], mongo_executor)
+broadcasts_collection = AsyncCollection(db['broadcasts'], mongo_executor)
+
+# Обработчики пишут в users, пока идут миграции, поэтому этот индекс создается до них
+USERS_INDEX = (users_collection, [("user_id", ASCENDING)], {"name": "user_id_unique", "unique": True})
+
+# Индексы создаются при каждом запуске: create_index ничего не делает, если индекс уже есть
+INDEXES = [
+    (messages_collection, [("date", DESCENDING), ("_id", DESCENDING)], {"name": "date_id_desc"}),
+    (messages_collection, [("user_id", ASCENDING), ("date", DESCENDING)], {"name": "user_id_date"}),
+    (blocked_users_collection, [("user_id", ASCENDING)], {"name": "user_id_unique", "unique": True}),
+    USERS_INDEX,
+    (users_collection, [("blocked", ASCENDING)], {"name": "blocked"}),
+    (users_collection, [("last_activity", DESCENDING), ("_id", DESCENDING)], {"name": "last_activity_id_desc"}),
+    # Полнотекстовый индекс со стеммингом русского языка: находит разные формы слова
+    (messages_collection, [("text", "text"), ("caption", "text"), ("username", "text"), ("first_name", "text"), ("last_name", "text")], {
+        "name": "messages_text",
+        "default_language": "russian",
+        "weights": {"text": 10, "caption": 5, "username": 2, "first_name": 2, "last_name": 2}
+    }),
+    (messages_archive_collection, [("user_id", ASCENDING), ("date", DESCENDING)], {"name": "user_id_date"}),
+    (messages_archive_collection, [("date", DESCENDING)], {"name": "date_desc"}),
+    (search_sessions_collection, [("created_at", ASCENDING)], {"name": "created_at_ttl", "expireAfterSeconds": 86400}),
+    (processed_updates_collection, [("claimed_at", ASCENDING)], {"name": "claimed_at_ttl", "expireAfterSeconds": UPDATE_DEDUP_TTL}),
+    # Одновременно выполняется не больше одной рассылки
+    (broadcasts_collection, [("status", ASCENDING)], {
+        "name": "one_running", "unique": True, "partialFilterExpression": {"status": "running"}
+    }),
+]
+
+async def migrate_dedupe_blocked_users():
+    # До появления уникального индекса одного пользователя можно было заблокировать дважды
+    duplicates = await blocked_users_collection.aggregate([
+        {"$sort": {"blocked_at": 1}},
+        {"$group": {"_id": "$user_id", "ids": {"$push": "$_id"}, "count": {"$sum": 1}}},
+        {"$match": {"count": {"$gt": 1}}}
+    ])
+    for duplicate in duplicates:
+        await blocked_users_collection.delete_many({"_id": {"$in": duplicate["ids"][1:]}})
+    logger.info("Удалены повторные блокировки для %s пользователей", len(duplicates))
+
+async def dedupe_users():
+    # Без уникального индекса одновременные upsert могли создать несколько записей одного пользователя:
+    # остается самая старая, счетчики остальных прибавляются к ней
+    duplicates = await users_collection.aggregate([
+        {"$sort": {"_id": 1}},
+        {"$group": {
+            "_id": "$user_id",
+            "ids": {"$push": "$_id"},
+            "message_count": {"$sum": "$message_count"},
+            "unread": {"$sum": "$unread"},
+            "blocked": {"$max": "$blocked"},
+            "count": {"$sum": 1}
+        }},
+        {"$match": {"count": {"$gt": 1}}}
+    ], allowDiskUse=True)
+    for duplicate in duplicates:
+        await users_collection.update_one({"_id": duplicate["ids"][0]}, {"$set": {
+            "message_count": duplicate["message_count"],
+            "unread": duplicate["unread"],
+            "blocked": bool(duplicate["blocked"])
+        }})
+        await users_collection.delete_many({"_id": {"$in": duplicate["ids"][1:]}})
+    logger.warning("Объединены повторные записи для %s пользователей", len(duplicates))
+
+async def ensure_users_index():
+    collection, keys, options = USERS_INDEX
+    try:
+        await collection.create_index(keys, **options)
+    except DuplicateKeyError:
+        await dedupe_users()
+        await collection.create_index(keys, **options)
+
+async def migrate_backfill_message_fields():
+    # Старые документы могли быть сохранены без части полей
+    for field, default in (("text", ""), ("caption", ""), ("file_id", None), ("file_type", None)):
+        result = await messages_collection.update_many({field: {"$exists": False}}, {"$set": {field: default}})
+        logger.info("Поле %s заполнено в %s сообщениях", field, result.modified_count)
+
+async def migrate_build_users():
+    # Заполняет коллекцию users по уже сохраненным сообщениям и списку блокировок
+    users = await messages_collection.aggregate([
+        {"$sort": {"date": 1}},
+        {"$group": {
+            "_id": "$user_id",
+            "username": {"$last": "$username"},
+            "first_name": {"$last": "$first_name"},
+            "last_name": {"$last": "$last_name"},
+            "first_seen": {"$first": "$date"},
+            "last_seen": {"$last": "$date"},
+            "message_count": {"$sum": 1}
+        }}
+    ], allowDiskUse=True)
+    blocked_ids = {user_data["user_id"] for user_data in await blocked_users_collection.find(projection={"user_id": 1})}
+    operations = [
+        UpdateOne({"user_id": user["_id"]}, {"$set": {
+            "username": None if user["username"] == "Нет имени пользователя" else user["username"],
+            "first_name": user["first_name"],
+            "last_name": user["last_name"],
+            "first_seen": user["first_seen"],
+            "last_seen": user["last_seen"],
+            "message_count": user["message_count"],
+            "blocked": user["_id"] in blocked_ids
+        }}, upsert=True)
+        for user in users
+    ]
+    operations.extend(
+        UpdateOne({"user_id": user_id}, {"$set": {"blocked": True}, "$setOnInsert": {"message_count": 0}}, upsert=True)
+        for user_id in blocked_ids
+    )
+    for i in range(0, len(operations), 1000):
+        await users_collection.bulk_write(operations[i:i + 1000], ordered=False)
+    logger.info("Коллекция пользователей заполнена: %s пользователей", len(users))
+
+async def migrate_create_archive():
+    # Архив читается редко, поэтому хранится с более сильным сжатием zstd
+    try:
+        await messages_archive_collection.run(
+            db.create_collection,
+            'messages_archive',
+            storageEngine={"wiredTiger": {"configString": "block_compressor=zstd"}}
+        )
+    except CollectionInvalid:
+        logger.info("Коллекция архива уже существует")
+
+async def migrate_conversations():
+    # Все сохраненные до этого сообщения - входящие; для списка диалогов нужна последняя активность
+    for collection in (messages_collection, messages_archive_collection):
+        result = await collection.update_many({"direction": {"$exists": False}}, {"$set": {"direction": "in"}})
+        logger.info("Направление заполнено в %s сообщениях", result.modified_count)
+    last_messages = await messages_collection.aggregate([
+        {"$match": {"direction": {"$ne": "out"}}},
+        {"$sort": {"user_id": 1, "date": 1}},
+        {"$group": {
+            "_id": "$user_id",
+            "date": {"$last": "$date"},
+            "text": {"$last": "$text"},
+            "caption": {"$last": "$caption"},
+            "file_type": {"$last": "$file_type"}
+        }}
+    ], allowDiskUse=True)
+    operations = [
+        UpdateOne({"user_id": last["_id"], "last_activity": {"$exists": False}}, {"$set": {
+            "last_activity": last["date"],
+            "last_preview": message_preview(last)[:100],
+            "last_direction": "in",
+            "unread": 0
+        }})
+        for last in last_messages
+    ]
+    for i in range(0, len(operations), 1000):
+        await users_collection.bulk_write(operations[i:i + 1000], ordered=False)
+
+# Версионированные миграции данных. Новые миграции добавляются в конец списка со следующим номером
+MIGRATIONS = [
+    (1, "удаление повторных блокировок", migrate_dedupe_blocked_users),
+    (2, "заполнение отсутствующих полей сообщений", migrate_backfill_message_fields),
+    (3, "коллекция пользователей", migrate_build_users),
+    (4, "сжатая коллекция архива сообщений", migrate_create_archive),
+    (5, "направление сообщений и список диалогов", migrate_conversations),
+]
+
+async def ensure_schema():
+    schema_doc = await meta_collection.find_one({"_id": "schema"})
+    current_version = schema_doc["version"] if schema_doc else 0
+    
+    await ensure_users_index()
+    for version, description, migration in MIGRATIONS:
+        if version <= current_version:
+            continue
+        logger.info("Применение миграции %s: %s", version, description)
+        await migration()
+        await meta_collection.update_one(
+            {"_id": "schema"},
+            {"$set": {"version": version, "applied_at": datetime.now()}},
+            upsert=True
+        )
+        current_version = version
+    
+    # Остальные индексы создаются после миграций, так как уникальный индекс требует очищенных данных
+    for collection, keys, options in INDEXES:
+        await collection.create_index(keys, **options)
+    
+    logger.info("Схема базы данных актуальна, версия %s", current_version)
+
+# Фоновые задачи (обновление кэшей и т.п.), которые останавливаются при завершении бота
+background_tasks = []
+
+class BlocklistCache:
+    """Множество заблокированных пользователей в памяти.
+
+    Проверка входящих сообщений не обращается к базе. Любое изменение списка увеличивает
+    версию в коллекции meta, по которой другие экземпляры бота перечитывают список.
+    """
+
+    def __init__(self):
+        self.user_ids = set()
+        self.version = None
+
+    def __contains__(self, user_id):
+        return user_id in self.user_ids
+
+    async def current_version(self):
+        version_doc = await meta_collection.find_one({"_id": "blocklist"})
+        return version_doc["version"] if version_doc else 0
+
+    async def load(self):
+        # Версию читаем до списка: если список изменится между запросами, следующая проверка его перечитает
+        version = await self.current_version()
+        blocked_users = await blocked_users_collection.find(projection={"user_id": 1, "_id": 0})
+        self.user_ids = {user_data["user_id"] for user_data in blocked_users}
+        self.version = version
+        message_pages.invalidate()
+        logger.info("Загружен список заблокированных пользователей: %s, версия %s", len(self.user_ids), version)
+        await self._save_snapshot()
+
+    async def load_snapshot(self):
+        # Копия списка на диске действует, пока база недоступна при запуске
+        try:
+            self.user_ids = set(await spool.load_state("blocklist") or [])
+            logger.info("Загружена локальная копия списка заблокированных пользователей: %s", len(self.user_ids))
+        except Exception as e:
+            logger.error("Ошибка при чтении локальной копии списка заблокированных пользователей: %s", e)
+
+    async def _save_snapshot(self):
+        try:
+            await spool.save_state("blocklist", sorted(self.user_ids))
+        except Exception as e:
+            logger.error("Ошибка при сохранении локальной копии списка заблокированных пользователей: %s", e)
+
+    async def block(self, user_id, blocked_by):
+        if await blocked_users_collection.find_one({"user_id": user_id}):
+            self.user_ids.add(user_id)
+            return False
+        try:
+            await blocked_users_collection.insert_one({
+                "user_id": user_id,
+                "blocked_by": blocked_by,
+                "blocked_at": datetime.now()
+            })
+        except DuplicateKeyError:
+            # Пользователя одновременно заблокировали из другого обработчика или экземпляра бота
+            self.user_ids.add(user_id)
+            return False
+        self.user_ids.add(user_id)
+        message_pages.invalidate()
+        await users_collection.update_one({"user_id": user_id}, {"$set": {"blocked": True}})
+        await self._bump_version()
+        return True
+
+    async def unblock(self, user_id):
+        result = await blocked_users_collection.delete_one({"user_id": user_id})
+        self.user_ids.discard(user_id)
+        if result.deleted_count > 0:
+            message_pages.invalidate()
+            await users_collection.update_one({"user_id": user_id}, {"$set": {"blocked": False}})
+            await self._bump_version()
+        return result.deleted_count > 0
+
+    async def _bump_version(self):
+        version_doc = await meta_collection.find_one_and_update(
+            {"_id": "blocklist"},
+            {"$inc": {"version": 1}},
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+        # Если между нашими изменениями версия менялась кем-то еще, оставляем старую версию,
+        # чтобы периодическая проверка перечитала список целиком
+        if self.version is not None and version_doc["version"] == self.version + 1:
+            self.version = version_doc["version"]
+        await self._save_snapshot()
+
+    async def refresh_periodically(self):
+        while True:
+            await asyncio.sleep(BLOCKLIST_REFRESH_INTERVAL)
+            try:
+                if await self.current_version() != self.version:
+                    await self.load()
+            except Exception as e:
+                logger.error("Ошибка при обновлении списка заблокированных пользователей: %s", e)
+
+blocklist = BlocklistCache()
+
+class UserDirectory:
+    """Сведения о пользователях из коллекции users и небольшой кэш имен для интерфейса."""
+
+    def __init__(self, cache_size=1000):
+        self.cache_size = cache_size
+        self.names = OrderedDict()
+
+    def remember(self, user_id, username, first_name, last_name):
+        self.names[user_id] = (username, first_name, last_name)
+        self.names.move_to_end(user_id)
+        if len(self.names) > self.cache_size:
+            self.names.popitem(last=False)
+
+    def remember_user(self, user):
+        self.remember(user.id, user.username, user.first_name or "", user.last_name or "")
+
+    async def get_name(self, user_id):
+        # Возвращает (username, first_name, last_name) или None, если пользователь боту не писал
+        if user_id in self.names:
+            self.names.move_to_end(user_id)
+            return self.names[user_id]
+        user_doc = await users_collection.find_one(
+            {"user_id": user_id}, {"username": 1, "first_name": 1, "last_name": 1}
+        )
+        if not user_doc:
+            return None
+        self.remember(user_id, user_doc.get("username"), user_doc.get("first_name", ""), user_doc.get("last_name", ""))
+        return self.names[user_id]
+
+    async def display_name(self, user_id, fallback):
+        name = await self.get_name(user_id)
+        return format_display_name(name, fallback) if name else "Неизвестный пользователь"
+
+    async def exists(self, user_id):
+        return await self.get_name(user_id) is not None
+
+    async def touch(self, user):
+        # Пользователь запустил бота: запись создается без увеличения счетчика сообщений
+        self.remember_user(user)
+        now = datetime.now()
+        await users_collection.update_one(
+            {"user_id": user.id},
+            {
+                "$set": {"username": user.username, "first_name": user.first_name or "", "last_name": user.last_name or "", "last_seen": now},
+                "$setOnInsert": {"first_seen": now, "message_count": 0, "blocked": False}
+            },
+            upsert=True
+        )
+
+    async def record_messages(self, documents):
+        # Вызывается после записи пакета сообщений: одно обновление на пользователя, а не на сообщение.
+        # Здесь же ведется список диалогов: последняя активность, последнее сообщение и число
+        # непрочитанных, которое обнуляется ответом администратора
+        users = {}
+        for document in documents:
+            user = users.setdefault(document["user_id"], {"count": 0, "unread": 0, "replied": False, "last_in": None})
+            if document.get("direction") == "out":
+                user["unread"] = 0
+                user["replied"] = True
+            else:
+                user["count"] += 1
+                user["unread"] += 1
+                user["last_in"] = document
+            user["last"] = document
+            user.setdefault("first_seen", document["date"])
+        operations = []
+        for user_id, user in users.items():
+            last = user["last"]
+            preview = message_preview(last)
+            fields = {
+                "last_activity": last["date"],
+                "last_preview": (f"Вы: {preview}" if last.get("direction") == "out" else preview)[:100],
+                "last_direction": last.get("direction", "in")
+            }
+            increments = {}
+            if user["last_in"]:
+                last_in = user["last_in"]
+                fields.update({
+                    "username": None if last_in["username"] == "Нет имени пользователя" else last_in["username"],
+                    "first_name": last_in["first_name"],
+                    "last_name": last_in["last_name"],
+                    "last_seen": last_in["date"],
+                    "bot_blocked": False
+                })
+                increments["message_count"] = user["count"]
+            if user["replied"]:
+                fields["unread"] = user["unread"]
+            else:
+                increments["unread"] = user["unread"]
+            update = {"$set": fields, "$setOnInsert": {"first_seen": user["first_seen"], "blocked": False}}
+            if increments:
+                update["$inc"] = increments
+            if "message_count" not in increments:
+                update["$setOnInsert"]["message_count"] = 0
+            operations.append(UpdateOne({"user_id": user_id}, update, upsert=True))
+        await users_collection.bulk_write(operations, ordered=False)
+
+    async def mark_read(self, user_id):
+        await users_collection.update_one({"user_id": user_id, "unread": {"$gt": 0}}, {"$set": {"unread": 0}})
+
+user_directory = UserDirectory()
+
+class ReplyStateStore:
+    """Кому сейчас отвечает администратор.
+
+    Состояние хранится в коллекции conversation_state, поэтому переживает перезапуск и видно всем
+    экземплярам бота. Запись идет сразу в базу и в локальный кэш; чтение из кэша допускается не
+    дольше REPLY_STATE_CACHE_TTL секунд. Цель ответа забирается атомарно, поэтому одно сообщение
+    администратора не может быть доставлено дважды разными экземплярами.
+    """
+
+    def __init__(self, cache_ttl):
+        self.cache_ttl = cache_ttl
+        self.cache = {}
+
+    def _remember(self, admin_id, reply_to):
+        if self.cache_ttl > 0:
+            self.cache[admin_id] = (reply_to, time.monotonic() + self.cache_ttl)
+
+    async def get(self, admin_id):
+        cached = self.cache.get(admin_id)
+        if cached and cached[1] > time.monotonic():
+            return cached[0]
+        state = await conversation_state_collection.find_one({"_id": admin_id})
+        reply_to = state.get("reply_to") if state else None
+        self._remember(admin_id, reply_to)
+        return reply_to
+
+    async def set(self, admin_id, user_id):
+        await conversation_state_collection.update_one(
+            {"_id": admin_id},
+            {"$set": {"reply_to": user_id, "updated_at": datetime.now()}},
+            upsert=True
+        )
+        self._remember(admin_id, user_id)
+
+    async def consume(self, admin_id):
+        # Возвращает цель ответа и сбрасывает ее одной операцией
+        state = await conversation_state_collection.find_one_and_update(
+            {"_id": admin_id, "reply_to": {"$ne": None}},
+            {"$set": {"reply_to": None, "updated_at": datetime.now()}}
+        )
+        self._remember(admin_id, None)
+        return state["reply_to"] if state else None
+
+    async def restore(self, admin_id, user_id):
+        # Ответ не отправлен: возвращаем цель, если администратор еще не выбрал новую
+        await conversation_state_collection.update_one(
+            {"_id": admin_id, "reply_to": None},
+            {"$set": {"reply_to": user_id, "updated_at": datetime.now()}}
+        )
+        self.cache.pop(admin_id, None)
+
+reply_state = ReplyStateStore(REPLY_STATE_CACHE_TTL)
+
+class UpdateClaims:
+    """Отметки обработанных обновлений для нескольких экземпляров бота.
+
+    Первый экземпляр, записавший update_id, обрабатывает обновление, повторная доставка
+    пропускается. Отметка ждет базу не дольше UPDATE_CLAIM_TIMEOUT секунд. После ошибки, а
+    также пока сообщения пишутся в локальный журнал, обновления UPDATE_CLAIM_RETRY секунд
+    обрабатываются без отметки: прием сообщений при недоступной базе не замедляется, а
+    повторная доставка в это время может быть обработана дважды.
+    """
+
+    def __init__(self, timeout, retry):
+        self.timeout = timeout
+        self.retry = retry
+        self.retry_at = 0.0
+        self.skipped = 0
+
+    async def claim(self, update_id):
+        if spool.active or time.monotonic() < self.retry_at:
+            self.skipped += 1
+            return True
+        try:
+            await asyncio.wait_for(
+                processed_updates_collection.insert_one({"_id": update_id, "claimed_at": datetime.now()}), self.timeout
+            )
+            return True
+        except DuplicateKeyError:
+            return False
+        except Exception as e:
+            # Если база недоступна, лучше обработать обновление, чем потерять его
+            self.retry_at = time.monotonic() + self.retry
+            logger.error("Не удалось отметить обновление %s как обработанное: %r", update_id, e)
+            return True
+
+update_claims = UpdateClaims(UPDATE_CLAIM_TIMEOUT, UPDATE_CLAIM_RETRY)
+
+def format_display_name(name, fallback):
+    username, first_name, last_name = name
+    if username:
+        return f"@{username}"
+    full_name = f"{first_name or ''} {last_name or ''}"
+    return full_name if full_name.strip() else fallback
+
+async def insert_without_duplicates(collection, documents):
+    # Документы с заранее назначенным _id, записанные прошлой попыткой, пропускаются
+    while documents:
+        try:
+            await collection.insert_many(documents, ordered=True)
+            return
+        except BulkWriteError as e:
+            write_errors = e.details.get("writeErrors", [])
+            if not write_errors or write_errors[0].get("code") != 11000:
+                raise
+            # Начало пакета записано, документ с дублирующимся _id уже был в базе
+            documents = documents[e.details.get("nInserted", 0) + 1:]
+
+class MessageSpool:
+    """Локальный журнал сообщений в SQLite на время недоступности MongoDB.
+
+    Пока журнал не пуст, буфер записи дописывает в него все новые пакеты, а run() переносит
+    журнал в базу пакетами в исходном порядке и удаляет перенесенное. Пакет удаляется из журнала
+    только после записи в базу, а повтор после сбоя пропускает уже записанные _id, поэтому
+    сообщения не теряются и не дублируются. Здесь же хранится копия списка блокировок для запуска
+    без базы. Все обращения к SQLite идут через один поток.
+    """
+
+    def __init__(self, path, replay_interval, batch_size):
+        self.path = path
+        self.replay_interval = replay_interval
+        self.batch_size = batch_size
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="spool")
+        self.connection = None
+        self.lock = asyncio.Lock()
+        self.active = False
+        self.size = 0
+
+    async def _run(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, functools.partial(func, *args))
+
+    def _open(self):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.connection = sqlite3.connect(self.path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=FULL")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS messages (seq INTEGER PRIMARY KEY AUTOINCREMENT, document BLOB NOT NULL)")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        self.connection.commit()
+        return self.connection.execute("SELECT COUNT(*) FROM messages").fetchone()[0]
+
+    async def open(self):
+        self.size = await self._run(self._open)
+        self.active = self.size > 0
+        if self.size:
+            logger.warning("В локальном журнале %s сообщений, которые еще не перенесены в базу", self.size)
+
+    def _append(self, documents):
+        with self.connection:
+            self.connection.executemany(
+                "INSERT INTO messages (document) VALUES (?)", [(bson.encode(document),) for document in documents]
+            )
+
+    async def append(self, documents):
+        async with self.lock:
+            await self._run(self._append, documents)
+            self.active = True
+            self.size += len(documents)
+
+    def _read(self):
+        rows = self.connection.execute(
+            "SELECT seq, document FROM messages ORDER BY seq LIMIT ?", (self.batch_size,)
+        ).fetchall()
+        return (rows[-1][0] if rows else None), [bson.decode(document) for _, document in rows]
+
+    def _delete(self, last_seq):
+        with self.connection:
+            self.connection.execute("DELETE FROM messages WHERE seq <= ?", (last_seq,))
+
+    def __len__(self):
+        return self.size
+
+    async def replay_once(self, collection):
+        moved = 0
+        while True:
+            # Проверка пустоты и снятие флага под той же блокировкой, что и запись, чтобы новый
+            # пакет не попал в базу раньше журнала
+            async with self.lock:
+                last_seq, documents = await self._run(self._read)
+                if not documents:
+                    self.active = False
+                    return moved
+            await insert_without_duplicates(collection, documents)
+            message_pages.invalidate()
+            await self._run(self._delete, last_seq)
+            moved += len(documents)
+            self.size -= len(documents)
+            try:
+                await user_directory.record_messages(documents)
+            except Exception as e:
+                logger.error("Ошибка при обновлении сведений о пользователях: %s", e)
+
+    async def run(self, collection):
+        while True:
+            if self.active:
+                try:
+                    moved = await self.replay_once(collection)
+                    if moved:
+                        logger.info("Из локального журнала в базу перенесено сообщений: %s", moved)
+                except Exception as e:
+                    logger.warning("База данных недоступна, перенос локального журнала отложен: %s", e)
+            await asyncio.sleep(self.replay_interval)
+
+    def _save_state(self, key, value):
+        with self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO state (key, value) VALUES (?, ?)", (key, json.dumps(value))
+            )
+
+    async def save_state(self, key, value):
+        await self._run(self._save_state, key, value)
+
+    def _load_state(self, key):
+        row = self.connection.execute("SELECT value FROM state WHERE key = ?", (key,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    async def load_state(self, key):
+        return await self._run(self._load_state, key)
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        if self.connection:
+            self.connection.close()
+
+spool = MessageSpool(SPOOL_PATH, SPOOL_REPLAY_INTERVAL, MESSAGE_BATCH_SIZE)
+
+class MessageWriteBuffer:
+    """Отложенная пакетная запись сообщений в базу.
+
+    Обработчик только ставит документ в очередь и сразу продолжает пересылку, а фоновая задача
+    записывает накопленное через insert_many, когда набирается MESSAGE_BATCH_SIZE документов
+    или проходит MESSAGE_FLUSH_INTERVAL секунд.
+
+    Гарантии:
+    - документы записываются в порядке постановки в очередь (одна задача записи, ordered insert_many);
+    - _id назначается при постановке в очередь, повторная запись после ошибки не создает дублей;
+    - при ошибке базы пакет и все следующие документы пишутся в локальный журнал (MessageSpool),
+      пока он не будет перенесен в базу, поэтому очередь не переполняется и при недоступной базе;
+    - если в очереди MESSAGE_BUFFER_LIMIT документов, add() ждет освобождения места;
+    - при штатной остановке очередь записывается полностью (не дольше MESSAGE_SHUTDOWN_TIMEOUT),
+      при аварийном завершении процесса незаписанные документы из памяти теряются.
+    """
+
+    def __init__(self, collection, batch_size, flush_interval, limit):
+        self.collection = collection
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue = asyncio.Queue(maxsize=limit)
+        self.pending = []
+        self.closing = False
+        self.task = None
+
+    def __len__(self):
+        return self.queue.qsize() + len(self.pending)
+
+    async def add(self, document):
+        document.setdefault("_id", ObjectId())
+        if self.queue.full():
+            logger.warning("Очередь записи сообщений заполнена (%s), ожидание записи", self.queue.qsize())
+        await self.queue.put(document)
+        return document["_id"]
+
+    def start(self):
+        self.task = asyncio.create_task(self.run())
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while not (self.closing and self.queue.empty()):
+            deadline = loop.time() + self.flush_interval
+            while len(self.pending) < self.batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0 or (self.closing and self.queue.empty()):
+                    break
+                try:
+                    self.pending.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            if self.pending:
+                batch = self.pending
+                if await self._write():
+                    await self._record_users(batch)
+
+    async def _write(self):
+        # True - пакет записан в базу, False - в локальный журнал, откуда его перенесет spool.run
+        delay = 0.5
+        while True:
+            if not spool.active:
+                try:
+                    await insert_without_duplicates(self.collection, self.pending)
+                    message_pages.invalidate()
+                    logger.info("Записано сообщений в базу данных: %s", len(self.pending))
+                    self.pending = []
+                    return True
+                except Exception as e:
+                    logger.error("Ошибка при записи сообщений в базу данных, запись в локальный журнал: %s", e)
+            try:
+                await spool.append(self.pending)
+                logger.warning("Записано сообщений в локальный журнал: %s", len(self.pending))
+                self.pending = []
+                return False
+            except Exception as e:
+                logger.critical("Ошибка при записи в локальный журнал, повтор через %s с: %s", delay, e)
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 30)
+
+    async def _record_users(self, batch):
+        try:
+            await user_directory.record_messages(batch)
+        except Exception as e:
+            logger.error("Ошибка при обновлении сведений о пользователях: %s", e)
+
+    async def close(self):
+        if not self.task:
+            return
+        self.closing = True
+        try:
+            await asyncio.wait_for(self.task, MESSAGE_SHUTDOWN_TIMEOUT)
+        except asyncio.TimeoutError:
+            logger.critical("Не удалось записать в базу данных %s сообщений при остановке", len(self))
+
+message_buffer = MessageWriteBuffer(messages_collection, MESSAGE_BATCH_SIZE, MESSAGE_FLUSH_INTERVAL, MESSAGE_BUFFER_LIMIT)
+
+# Приоритеты исходящих сообщений: меньшее значение отправляется раньше
+PRIORITY_INTERACTIVE = 0  # ответы на действия администратора: просмотр сообщений, подтверждения, ошибки
+PRIORITY_HIGH = 1         # пересылка администратору и ответы администратора пользователям
+PRIORITY_NORMAL = 2       # служебные уведомления
+PRIORITY_LOW = 3          # подтверждения пользователям
+PRIORITY_BULK = 4         # рассылки, дополнительно ограничены BROADCAST_RATE
+
+class TokenBucket:
+    """Ограничитель частоты: rate токенов в секунду, не больше capacity подряд.
+
+    Ожидающие получают токены в порядке приоритета, при равном приоритете - в порядке очереди.
+    """
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.waiters = []
+        self.counter = itertools.count()
+        self.timer = None
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    @property
+    def idle(self):
+        self._refill()
+        return not self.waiters and self.tokens >= self.capacity
+
+    async def acquire(self, priority=PRIORITY_NORMAL):
+        self._refill()
+        if not self.waiters and self.tokens >= 1:
+            self.tokens -= 1
+            return
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.waiters, (priority, next(self.counter), future))
+        self._wake_waiters()
+        await future
+
+    def _wake_waiters(self):
+        self._refill()
+        while self.waiters and self.tokens >= 1:
+            _, _, future = heapq.heappop(self.waiters)
+            if future.done():
+                continue
+            self.tokens -= 1
+            future.set_result(None)
+        if self.waiters and self.timer is None:
+            delay = (1 - self.tokens) / self.rate
+            self.timer = asyncio.get_running_loop().call_later(delay, self._on_timer)
+
+    def _on_timer(self):
+        self.timer = None
+        self._wake_waiters()
+
+    def pause(self, seconds):
+        # Долг в токенах: следующие получат токен не раньше чем через seconds секунд
+        self._refill()
+        self.tokens = min(self.tokens, 0) - seconds * self.rate
+
+class OutboundRequest:
+    def __init__(self, priority, chat_id, method, kwargs, future):
+        self.priority = priority
+        self.chat_id = chat_id
+        self.method = method
+        self.kwargs = kwargs
+        self.future = future
+        self.created = time.monotonic()
+        # Очередь чата отправляет вызовы разных обновлений, поэтому их контекст журнала сохраняется с вызовом
+        self.correlation_id = correlation_id.get()
+        self.log_sampled = log_sampled.get()
+
+class OutboundDispatcher:
+    """Единая очередь исходящих вызовов Bot API.
+
+    Для каждого чата своя очередь с приоритетами и своим ограничителем частоты, поэтому порядок
+    сообщений в одном чате сохраняется, а медленный чат не задерживает остальные. Общий
+    ограничитель держит суммарную частоту в пределах лимитов Telegram. При RetryAfter отправка
+    в этот чат приостанавливается на указанное время, при сетевых ошибках повторяется с паузой.
+
+    Рассылки (PRIORITY_BULK) проходят еще и через свой ограничитель: RetryAfter любой из них
+    приостанавливает всю рассылку, а остальные сообщения продолжают отправляться.
+    """
+
+    def __init__(self, global_rate, chat_rate, chat_burst, max_retries, bulk_rate):
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.bulk_bucket = TokenBucket(bulk_rate, bulk_rate)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self.lanes = {}
+        self.chat_buckets = {}
+        self.counter = itertools.count()
+        self.sent = 0
+        self.retried = 0
+        self.retry_after = 0
+        self.failed = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    @property
+    def depth(self):
+        return sum(lane.qsize() for lane, _ in self.lanes.values())
+
+    def _enqueue(self, priority, method, kwargs):
+        chat_id = kwargs["chat_id"]
+        future = asyncio.get_running_loop().create_future()
+        request = OutboundRequest(priority, chat_id, method, kwargs, future)
+        if chat_id not in self.lanes:
+            lane = asyncio.PriorityQueue()
+            self.lanes[chat_id] = (lane, asyncio.create_task(self._drain(chat_id, lane)))
+        self.lanes[chat_id][0].put_nowait((priority, next(self.counter), request))
+        return future
+
+    async def send(self, priority, method, **kwargs):
+        # Ждет фактической отправки и возвращает результат метода Bot API
+        return await self._enqueue(priority, method, kwargs)
+
+    def submit(self, priority, method, **kwargs):
+        # Отправка без ожидания результата, ошибки только записываются в журнал
+        future = self._enqueue(priority, method, kwargs)
+        future.add_done_callback(self._log_failure)
+        return future
+
+    def _log_failure(self, future):
+        if not future.cancelled() and future.exception():
+            logger.error("Не удалось отправить сообщение: %s", future.exception())
+
+    def _chat_bucket(self, chat_id):
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self.chat_buckets) > 10000:
+                # Ограничители чатов без недавних отправок больше не нужны
+                self.chat_buckets = {key: value for key, value in self.chat_buckets.items() if not value.idle}
+            bucket = self.chat_buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+
+    async def _drain(self, chat_id, lane):
+        while True:
+            try:
+                _, _, request = lane.get_nowait()
+            except asyncio.QueueEmpty:
+                del self.lanes[chat_id]
+                return
+            if not request.future.cancelled():
+                await self._send(request)
+
+    async def _send(self, request):
+        correlation_id.set(request.correlation_id)
+        log_sampled.set(request.log_sampled)
+        bucket = self._chat_bucket(request.chat_id)
+        attempt = 0
+        while True:
+            if request.priority == PRIORITY_BULK:
+                await self.bulk_bucket.acquire()
+            await bucket.acquire(request.priority)
+            await self.global_bucket.acquire(request.priority)
+            try:
+                result = await request.method(**request.kwargs)
+            except RetryAfter as e:
+                self.retry_after += 1
+                if request.priority == PRIORITY_BULK:
+                    self.bulk_bucket.pause(e.retry_after)
+                logger.warning("Превышен лимит отправки в чат %s, пауза %s с", request.chat_id, e.retry_after)
+                await asyncio.sleep(e.retry_after + random.uniform(0, 1))
+                continue
+            except BadRequest as e:
+                self._fail(request, e)
+                return
+            except NetworkError as e:
+                attempt += 1
+                if attempt > self.max_retries:
+                    self._fail(request, e)
+                    return
+                self.retried += 1
+                delay = min(2 ** attempt, 30) * random.uniform(0.5, 1.5)
+                logger.warning("Ошибка сети при отправке в чат %s, повтор через %.1f с: %s", request.chat_id, delay, e)
+                await asyncio.sleep(delay)
+                continue
+            except Exception as e:
+                self._fail(request, e)
+                return
+            wait = time.monotonic() - request.created
+            self.sent += 1
+            self.total_wait += wait
+            self.max_wait = max(self.max_wait, wait)
+            if not request.future.done():
+                request.future.set_result(result)
+            return
+
+    def _fail(self, request, error):
+        self.failed += 1
+        if not request.future.done():
+            request.future.set_exception(error)
+
+    def stats_text(self):
+        average_wait = self.total_wait / self.sent if self.sent else 0.0
+        return (
+            f"📤 Очередь отправки: {self.depth} сообщений в {len(self.lanes)} чатах\n"
+            f"⏱️ Ожидание: среднее {average_wait:.2f} с, максимальное {self.max_wait:.2f} с\n"
+            f"✅ Отправлено: {self.sent}, повторов: {self.retried}, лимитов Telegram: {self.retry_after}, ошибок: {self.failed}"
+        )
+
+    async def close(self, timeout):
+        tasks = [task for _, task in self.lanes.values()]
+        if tasks:
+            done, pending = await asyncio.wait(tasks, timeout=timeout)
+            for task in pending:
+                task.cancel()
+            if pending:
+                logger.critical("Не отправлено при остановке: %s сообщений", self.depth)
+
+outbound = OutboundDispatcher(
+    OUTBOUND_GLOBAL_RATE, OUTBOUND_CHAT_RATE, OUTBOUND_CHAT_BURST, OUTBOUND_MAX_RETRIES, BROADCAST_RATE
+)
 
 async def start(update: Update, context: CallbackContext) -> None:
     user = update.effective_user
@@ -31,37 +1240,107 @@ async def start(update: Update, context: CallbackContext) -> None:
         f"Просто напишите ваше сообщение, и я его перешлю.",
         reply_markup=ForceReply(selective=True),
     )
-    logger.info(f"Пользователь {user.id} (@{user.username}) запустил бота")
+    logger.info("Пользователь %s (@%s) запустил бота", user.id, user.username)
+    
+    try:
+        await user_directory.touch(user)
+    except Exception as e:
+        logger.error("Ошибка при сохранении сведений о пользователе %s: %s", user.id, e)
     
     # Всегда отправляем уведомление администратору, независимо от того, кто запустил бота
     try:
         if user.id != ADMIN_USER_ID:
-            await context.bot.send_message(
+            # Уведомление ставится в очередь чата администратора без ожидания отправки
+            outbound.submit(
+                PRIORITY_NORMAL, context.bot.send_message,
                 chat_id=ADMIN_USER_ID,
                 text=f"📢 Новый пользователь запустил бота:\n"
                      f"👤 {user.first_name} {user.last_name or ''} (@{user.username or 'без username'})\n"
                      f"🆔 ID: {user.id}"
             )
-            logger.info(f"Отправлено уведомление администратору о новом пользователе {user.id}")
+            logger.info("Уведомление администратору о новом пользователе %s поставлено в очередь", user.id)
         else:
-            await context.bot.send_message(
+            await outbound.send(
+                PRIORITY_NORMAL, context.bot.send_message,
                 chat_id=ADMIN_USER_ID,
                 text=f"✅ Бот запущен вами (администратором)."
             )
             logger.info("Бот запущен администратором")
     except Exception as e:
-        logger.error(f"Ошибка при отправке уведомления администратору: {str(e)}")
+        logger.error("Ошибка при отправке уведомления администратору: %s", e)
 
-async def handle_message(update: Update, context: CallbackContext) -> None:
-    user = update.effective_user
-    message = update.message
-    logger.info(f"Получено сообщение от пользователя {user.id} (@{user.username})")
-    
-    if blocked_users_collection.find_one({"user_id": user.id}):
-        logger.info(f"Сообщение от заблокированного пользователя {user.id} проигнорировано")
-        return
-    
-    message_data = {
+def get_file_info(message):
+    # Анимация приходит вместе с полем document, поэтому проверяется первой
+    if message.animation:
+        return message.animation.file_id, 'animation'
+    elif message.photo:
+        return message.photo[-1].file_id, 'photo'
+    elif message.document:
+        return message.document.file_id, 'document'
+    elif message.video:
+        return message.video.file_id, 'video'
+    elif message.voice:
+        return message.voice.file_id, 'voice'
+    elif message.audio:
+        return message.audio.file_id, 'audio'
+    elif message.sticker:
+        return message.sticker.file_id, 'sticker'
+    elif message.video_note:
+        return message.video_note.file_id, 'video_note'
+    return None, None
+
+# Содержимое без файла; место (venue) приходит вместе с геопозицией, поэтому проверяется первым
+NON_FILE_CONTENT_TYPES = ["venue", "location", "contact", "poll", "dice"]
+
+CONTENT_LABELS = {
+    "photo": "фото", "video": "видео", "document": "документ", "audio": "аудио",
+    "voice": "голосовое сообщение", "animation": "GIF-анимацию", "sticker": "стикер",
+    "video_note": "видеосообщение", "venue": "место", "location": "геопозицию",
+    "contact": "контакт", "poll": "опрос", "dice": "кубик",
+}
+
+# Типы, к которым Telegram разрешает подпись (не длиннее CAPTION_LIMIT символов)
+CAPTIONABLE_TYPES = {"photo", "video", "document", "audio", "voice", "animation"}
+CAPTION_LIMIT = 1024
+
+def get_content_type(message):
+    _, file_type = get_file_info(message)
+    if file_type:
+        return file_type
+    for content_type in NON_FILE_CONTENT_TYPES:
+        if getattr(message, content_type):
+            return content_type
+    return "text" if message.text else "other"
+
+def stored_content_type(message_data):
+    # Сообщения, сохраненные до появления content_type, различаются только по file_type
+    return message_data.get("content_type") or message_data.get("file_type") or "text"
+
+def get_file_unique_id(message):
+    attachment = message.effective_attachment
+    if isinstance(attachment, (list, tuple)):
+        attachment = attachment[-1] if attachment else None
+    return getattr(attachment, "file_unique_id", None)
+
+def normalize_text(text):
+    return " ".join(text.casefold().split())
+
+def content_fingerprint(message, file_unique_id):
+    # Один и тот же файл (file_unique_id не зависит от отправки) с той же подписью или тот же текст
+    # с точностью до регистра и пробелов считаются повтором
+    if file_unique_id:
+        source = f"file:{file_unique_id}:{normalize_text(message.caption or '')}"
+    elif message.text:
+        source = f"text:{normalize_text(message.text)}"
+    else:
+        return None
+    return hashlib.sha1(source.encode("utf-8")).hexdigest()
+
+def build_message_data(user, message):
+    file_id, file_type = get_file_info(message)
+    content_type = get_content_type(message)
+    file_unique_id = get_file_unique_id(message)
+    return {
         "user_id": user.id,
         "username": user.username or "Нет имени пользователя",
         "first_name": user.first_name or "",
@@ -70,226 +1349,1121 @@ async def handle_message(update: Update, context: CallbackContext) -> None:
         "text": message.text or "",
         "caption": message.caption or "",
         "date": datetime.now(),
-        "file_id": None,
-        "file_type": None
+        "file_id": file_id,
+        # Для списков и поиска содержимое без файла (геопозиция, контакт, опрос) показывается как вложение
+        "file_type": file_type or (content_type if content_type not in ("text", "other") else None),
+        "content_type": content_type,
+        "chat_id": message.chat_id,
+        "file_unique_id": file_unique_id,
+        "fingerprint": content_fingerprint(message, file_unique_id),
+        "direction": "in"
+    }
+
+def format_user_info(user):
+    return f"👤 Пользователь: {user.first_name} {user.last_name or ''} (@{user.username or 'без username'})\n🆔 ID: {user.id}"
+
+def user_actions_buttons(user_id):
+    return [
+        [
+            InlineKeyboardButton("Заблокировать", callback_data=f"block_{user_id}"),
+            InlineKeyboardButton("Ответить", callback_data=f"reply_{user_id}")
+        ]
+    ]
+
+def user_actions_keyboard(user_id):
+    return InlineKeyboardMarkup(user_actions_buttons(user_id))
+
+def user_header_button(user_id, name, content_type):
+    # Заменяет подпись с данными пользователя там, где подпись невозможна
+    label = CONTENT_LABELS.get(content_type, "сообщение")
+    return InlineKeyboardButton(f"👤 {name} (ID: {user_id}) — {label}", callback_data=f"user_msgs_{user_id}")
+
+async def copy_message_with_header(bot, priority, chat_id, from_chat_id, message_id, content_type,
+                                   caption=None, keyboard=None, header_button=None):
+    """Копирует сообщение одним вызовом copy_message с подписью и кнопками.
+
+    Для типов с подписью caption заменяет исходную подпись. Если подпись у типа невозможна
+    или не помещается в лимит, исходное сообщение копируется как есть, а данные пользователя
+    показываются кнопкой header_button над остальными кнопками.
+    """
+    return await outbound.send(priority, bot.copy_message, **copy_message_kwargs(
+        chat_id, from_chat_id, message_id, content_type, caption, keyboard, header_button
+    ))
+
+def copy_message_kwargs(chat_id, from_chat_id, message_id, content_type, caption=None, keyboard=None, header_button=None):
+    kwargs = {"chat_id": chat_id, "from_chat_id": from_chat_id, "message_id": message_id}
+    rows = list(keyboard or [])
+    if caption is not None and content_type in CAPTIONABLE_TYPES and len(caption) <= CAPTION_LIMIT:
+        kwargs["caption"] = caption
+    elif header_button:
+        rows.insert(0, [header_button])
+    if rows:
+        kwargs["reply_markup"] = InlineKeyboardMarkup(rows)
+    return kwargs
+
+def build_input_media(file_id, file_type, caption=None):
+    # Телеграм сам проверяет, что в альбоме совместимые типы, поэтому сохраненный альбом можно отправить как есть
+    media_types = {
+        'photo': InputMediaPhoto,
+        'video': InputMediaVideo,
+        'document': InputMediaDocument,
+        'audio': InputMediaAudio,
     }
+    return media_types[file_type](media=file_id, caption=caption)
+
+def send_confirmation(context: CallbackContext, user) -> None:
+    # Обработчик не ждет отправки, ошибки записываются в журнал очередью отправки
+    outbound.submit(
+        PRIORITY_LOW, context.bot.send_message,
+        chat_id=user.id,
+        text="Спасибо! Ваше сообщение было передано."
+    )
+
+def track_admin_forward(context: CallbackContext, future, user, description, on_sent=None) -> None:
+    """Разбирает результат пересылки администратору, когда очередь отправки до нее дойдет.
+
+    Обработчик не ждет отправки: чат администратора ограничен OUTBOUND_CHAT_RATE сообщениями
+    в секунду, и ожидание держало бы очередь пользователя и место обработки обновления.
+    """
+    def done(future):
+        if future.cancelled():
+            return
+        error = future.exception()
+        if error:
+            outbound.submit(
+                PRIORITY_HIGH, context.bot.send_message,
+                chat_id=ADMIN_USER_ID,
+                text=f"⚠️ Ошибка при пересылке {description} от пользователя {user.id}:\n{str(error)}"
+            )
+            return
+        logger.info("Пересылка (%s) от пользователя %s доставлена администратору", description, user.id)
+        if on_sent:
+            on_sent(future.result())
+    future.add_done_callback(done)
+
+class MediaGroupCollector:
+    """Собирает части альбома (одинаковый media_group_id) в одно сообщение.
+
+    Альбом обрабатывается, когда от него MEDIA_GROUP_WINDOW секунд не приходило новых частей:
+    сохраняется один документ, администратору уходит один send_media_group и одно сообщение
+    с кнопками, пользователю - одно подтверждение.
+    """
+
+    def __init__(self, window):
+        self.window = window
+        self.groups = {}
+
+    def add(self, context, user, message):
+        loop = asyncio.get_running_loop()
+        group = self.groups.get(message.media_group_id)
+        if group is None:
+            group = self.groups[message.media_group_id] = {"user": user, "messages": [], "updated": loop.time()}
+            # Задачи application.create_task дожидаются при остановке бота, поэтому альбомы не теряются
+            context.application.create_task(self._process_later(context, message.media_group_id))
+        group["messages"].append(message)
+        group["updated"] = loop.time()
+
+    async def _process_later(self, context, media_group_id):
+        loop = asyncio.get_running_loop()
+        group = self.groups[media_group_id]
+        while True:
+            delay = group["updated"] + self.window - loop.time()
+            if delay <= 0:
+                break
+            await asyncio.sleep(delay)
+        del self.groups[media_group_id]
+        messages = sorted(group["messages"], key=lambda message: message.message_id)
+        await process_media_group(context, group["user"], messages)
+
+media_groups = MediaGroupCollector(MEDIA_GROUP_WINDOW)
+
+class AdminDigest:
+    """Режим сводки для администратора при наплыве сообщений.
+
+    Если за последнюю минуту пришло не меньше DIGEST_THRESHOLD сообщений, отдельные пересылки
+    заменяются сводкой раз в DIGEST_INTERVAL секунд. Режим выключается, когда поток падает
+    ниже половины порога. Сохранение и подтверждения пользователям работают как обычно.
+    """
+
+    def __init__(self, threshold, interval, max_users):
+        self.threshold = threshold
+        self.interval = interval
+        self.max_users = max_users
+        self.arrivals = deque()
+        self.active = False
+        self.entries = {}
+        self.started = time.monotonic()
+
+    def rate(self):
+        # Число входящих сообщений за последние 60 секунд
+        now = time.monotonic()
+        while self.arrivals and self.arrivals[0] < now - 60:
+            self.arrivals.popleft()
+        return len(self.arrivals)
+
+    def record_arrival(self):
+        self.arrivals.append(time.monotonic())
+        if not self.active and self.rate() >= self.threshold:
+            self.active = True
+            self.started = time.monotonic()
+            logger.warning("Включен режим сводки: %s сообщений в минуту", self.rate())
+
+    def add(self, user, preview):
+        entry = self.entries.get(user.id)
+        if entry is None:
+            entry = self.entries[user.id] = {"user": user, "count": 0, "previews": []}
+        entry["count"] += 1
+        if len(entry["previews"]) < 2:
+            entry["previews"].append(preview.split("\n")[0][:80])
+
+    def build_summary(self):
+        total = sum(entry["count"] for entry in self.entries.values())
+        text = f"📋 Сводка: {total} сообщений от {len(self.entries)} пользователей\n\n"
+        keyboard = []
+        for idx, entry in enumerate(list(self.entries.values())[:self.max_users], 1):
+            user = entry["user"]
+            text += f"{idx}. 👤 {user.first_name} {user.last_name or ''} (@{user.username or 'без username'}), ID: {user.id} — ×{entry['count']}\n"
+            for preview in entry["previews"]:
+                text += f"   📝 {preview}\n"
+            keyboard.append([InlineKeyboardButton(f"{idx}. {user.first_name} — ×{entry['count']}", callback_data=f"user_msgs_{user.id}")])
+        if len(self.entries) > self.max_users:
+            text += f"\n…и еще {len(self.entries) - self.max_users} пользователей"
+        return text[:4096], InlineKeyboardMarkup(keyboard)
+
+    async def run(self, bot):
+        while True:
+            await asyncio.sleep(self.interval)
+            if not self.active:
+                continue
+            try:
+                if self.entries:
+                    text, reply_markup = self.build_summary()
+                    self.entries = {}
+                    await outbound.send(
+                        PRIORITY_HIGH, bot.send_message,
+                        chat_id=ADMIN_USER_ID,
+                        text=text,
+                        reply_markup=reply_markup
+                    )
+                    logger.info("Сводка сообщений отправлена администратору")
+                if self.rate() < self.threshold / 2:
+                    self.active = False
+                    await outbound.send(
+                        PRIORITY_HIGH, bot.send_message,
+                        chat_id=ADMIN_USER_ID,
+                        text="✅ Поток сообщений снизился, пересылка отдельных сообщений возобновлена."
+                    )
+                    logger.info("Режим сводки выключен")
+            except Exception as e:
+                logger.error("Ошибка при отправке сводки администратору: %s", e)
+
+digest = AdminDigest(DIGEST_THRESHOLD, DIGEST_INTERVAL, DIGEST_MAX_USERS)
+
+FLOOD_ADMIT = "admit"
+FLOOD_DROP = "drop"
+FLOOD_MUTE = "mute"
+
+class FloodGuard:
+    """Ограничение частоты сообщений от одного пользователя до сохранения и пересылки.
+
+    У каждого пользователя свой счетчик токенов: FLOOD_BURST сообщений подряд, дальше
+    FLOOD_RATE сообщений в секунду. Сообщения сверх лимита отбрасываются без записи в базу,
+    пересылки и подтверждения. После FLOOD_STRIKES отброшенных подряд пользователь заглушается
+    на FLOOD_MUTE_SECONDS секунд, а администратор получает одно уведомление о нем.
+
+    Счетчики хранятся в LRU не больше чем на FLOOD_MAX_USERS пользователей. Вытесняется
+    пользователь, который дольше всех ничего не присылал; при повторном появлении он начинает
+    с полного счетчика, что совпадает с его состоянием, если он молчал дольше FLOOD_BURST / FLOOD_RATE.
+    """
+
+    def __init__(self, rate, burst, strikes, mute_seconds, max_users):
+        self.rate = rate
+        self.burst = burst
+        self.strikes = strikes
+        self.mute_seconds = mute_seconds
+        self.max_users = max_users
+        self.buckets = OrderedDict()
+        self.muted = {}
+        self.dropped = 0
+
+    @property
+    def enabled(self):
+        return self.rate > 0
+
+    def is_muted(self, user_id, now):
+        until = self.muted.get(user_id)
+        if until is None:
+            return False
+        if until <= now:
+            del self.muted[user_id]
+            return False
+        return True
+
+    def check(self, user_id):
+        now = time.monotonic()
+        if self.is_muted(user_id, now):
+            self.dropped += 1
+            return FLOOD_DROP
+        bucket = self.buckets.get(user_id)
+        if bucket is None:
+            bucket = self.buckets[user_id] = {"tokens": float(self.burst), "updated": now, "strikes": 0}
+            if len(self.buckets) > self.max_users:
+                self.buckets.popitem(last=False)
+        else:
+            self.buckets.move_to_end(user_id)
+            bucket["tokens"] = min(self.burst, bucket["tokens"] + (now - bucket["updated"]) * self.rate)
+            bucket["updated"] = now
+        if bucket["tokens"] >= 1:
+            bucket["tokens"] -= 1
+            bucket["strikes"] = 0
+            return FLOOD_ADMIT
+        self.dropped += 1
+        bucket["strikes"] += 1
+        if bucket["strikes"] < self.strikes:
+            return FLOOD_DROP
+        bucket["strikes"] = 0
+        self.muted[user_id] = now + self.mute_seconds
+        if len(self.muted) > self.max_users:
+            self.muted = {key: until for key, until in self.muted.items() if until > now}
+        return FLOOD_MUTE
+
+    def stats_text(self):
+        now = time.monotonic()
+        active = sum(1 for until in self.muted.values() if until > now)
+        return f"🛡️ Ограничение частоты: отброшено {self.dropped} сообщений, заглушено сейчас: {active}"
+
+flood_guard = FloodGuard(FLOOD_RATE, FLOOD_BURST, FLOOD_STRIKES, FLOOD_MUTE_SECONDS, FLOOD_MAX_USERS)
+
+class RecentContentIndex:
+    """Недавнее содержимое пользователей для схлопывания повторов.
+
+    Ключ - пользователь и отпечаток содержимого (file_unique_id с подписью или нормализованный
+    текст), значение - _id сохраненного оригинала и пересланное администратору сообщение.
+    Повтор в течение DEDUP_WINDOW секунд не сохраняется и не пересылается: у оригинала
+    увеличивается repeat_count, а у пересланного сообщения обновляется отметка «×N». Записей
+    не больше DEDUP_MAX_ENTRIES, при переполнении вытесняются самые старые.
+
+    Оригинал может еще ждать записи в буфере или в локальном журнале, поэтому увеличения
+    копятся в памяти и записываются в базу раз в DEDUP_FLUSH_INTERVAL секунд. После ответа
+    администратора записи пользователя забываются: повтор уже не дубль, а новое обращение.
+    """
+
+    def __init__(self, window, max_entries, flush_interval):
+        self.window = window
+        self.max_entries = max_entries
+        self.flush_interval = flush_interval
+        self.entries = OrderedDict()
+        self.increments = {}
+        self.collapsed = 0
+
+    @property
+    def enabled(self):
+        return self.window > 0
+
+    def lookup(self, user_id, fingerprint):
+        entry = self.entries.get((user_id, fingerprint))
+        if entry is None:
+            return None
+        if entry["expires"] <= time.monotonic():
+            del self.entries[(user_id, fingerprint)]
+            return None
+        return entry
+
+    def remember(self, user_id, fingerprint, message_id):
+        entry = {"message_id": message_id, "expires": time.monotonic() + self.window, "count": 1, "forward": None}
+        self.entries[(user_id, fingerprint)] = entry
+        self.entries.move_to_end((user_id, fingerprint))
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+        return entry
+
+    def forget_user(self, user_id):
+        for key in [key for key in self.entries if key[0] == user_id]:
+            del self.entries[key]
+
+    def repeat(self, entry):
+        entry["count"] += 1
+        self.collapsed += 1
+        pending = self.increments.setdefault(entry["message_id"], {"count": 0, "attempts": 0})
+        pending["count"] += 1
+        return entry["count"]
+
+    def show_repeat(self, bot, entry):
+        # Правка ставится в очередь без ожидания; пока пересылка не отправлена, счетчик покажет
+        # обработчик ее отправки
+        forward = entry["forward"]
+        if not forward:
+            return
+        body = f"{forward['body']}\n\n🔁 Повторено ×{entry['count']}"
+        if len(body) > (4096 if forward["kind"] == "text" else CAPTION_LIMIT):
+            return
+        method, field = (bot.edit_message_text, "text") if forward["kind"] == "text" else (bot.edit_message_caption, "caption")
+        outbound.submit(
+            PRIORITY_LOW, method,
+            chat_id=ADMIN_USER_ID,
+            message_id=forward["message_id"],
+            reply_markup=forward["reply_markup"],
+            **{field: body}
+        )
+
+    async def flush(self):
+        # Пока журнал не перенесен, оригиналов из него еще нет в базе
+        if spool.active:
+            return
+        for message_id, pending in list(self.increments.items()):
+            count = pending["count"]
+            result = await messages_collection.update_one({"_id": message_id}, {"$inc": {"repeat_count": count}})
+            if result.matched_count:
+                message_pages.invalidate()
+                pending["count"] -= count
+                if pending["count"] == 0:
+                    del self.increments[message_id]
+            else:
+                pending["attempts"] += 1
+                if pending["attempts"] >= 10:
+                    logger.warning("Сообщение %s не найдено, повторы не учтены: %s", message_id, pending["count"])
+                    del self.increments[message_id]
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error("Ошибка при записи счетчиков повторов: %s", e)
+
+recent_content = RecentContentIndex(DEDUP_WINDOW, DEDUP_MAX_ENTRIES, DEDUP_FLUSH_INTERVAL)
+
+def notify_flood(context: CallbackContext, user) -> None:
+    minutes = max(1, flood_guard.mute_seconds // 60)
+    outbound.submit(
+        PRIORITY_HIGH, context.bot.send_message,
+        chat_id=ADMIN_USER_ID,
+        text=(
+            f"🚫 Слишком много сообщений\n\n{format_user_info(user)}\n\n"
+            f"Лишние сообщения не сохраняются и не пересылаются, пользователь заглушен на {minutes} мин."
+        ),
+        reply_markup=user_actions_keyboard(user.id)
+    )
+
+def message_preview(message_data):
+    if message_data.get("file_type"):
+        return f"[{message_data['file_type']}]" + (f" {message_data['caption']}" if message_data.get("caption") else "")
+    return message_data.get("text") or "[Пустое сообщение]"
+
+async def process_media_group(context: CallbackContext, user, messages) -> None:
+    message_data = build_message_data(user, messages[0])
+    media = []
+    for message in messages:
+        file_id, file_type = get_file_info(message)
+        if file_id:
+            media.append({"file_id": file_id, "file_type": file_type})
+    caption = next((message.caption for message in messages if message.caption), "")
+    message_data.update({
+        "message_ids": [message.message_id for message in messages],
+        "media_group_id": messages[0].media_group_id,
+        "caption": caption,
+        "file_id": media[0]["file_id"] if media else None,
+        "file_type": "media_group",
+        "media": media
+    })
+    message_id_in_db = await message_buffer.add(message_data)
+    logger.info("Альбом из %s файлов от пользователя %s поставлен в очередь на запись с ID: %s", len(media), user.id, message_id_in_db)
     
-    file_id = None
-    file_type = None
+    if digest.active:
+        digest.add(user, message_preview(message_data))
+        send_confirmation(context, user)
+        return
     
-    if message.photo:
-        file_id = message.photo[-1].file_id
-        file_type = 'photo'
-    elif message.document:
-        file_id = message.document.file_id
-        file_type = 'document'
-    elif message.video:
-        file_id = message.video.file_id
-        file_type = 'video'
-    elif message.voice:
-        file_id = message.voice.file_id
-        file_type = 'voice'
-    elif message.audio:
-        file_id = message.audio.file_id
-        file_type = 'audio'
-    elif message.sticker:
-        file_id = message.sticker.file_id
-        file_type = 'sticker'
+    user_info = format_user_info(user)
+    # Очередь чата администратора отправляет альбом и сообщение с кнопками в порядке постановки
+    album = outbound.submit(
+        PRIORITY_HIGH, context.bot.send_media_group,
+        chat_id=ADMIN_USER_ID,
+        media=[build_input_media(item["file_id"], item["file_type"]) for item in media]
+    )
+    track_admin_forward(context, album, user, "альбома")
+    outbound.submit(
+        PRIORITY_HIGH, context.bot.send_message,
+        chat_id=ADMIN_USER_ID,
+        text=f"{user_info}\n\nПрислал альбом из {len(media)} файлов" + (f" с текстом: {caption}" if caption else ""),
+        reply_markup=user_actions_keyboard(user.id)
+    )
+    logger.info("Альбом от пользователя %s поставлен в очередь пересылки администратору", user.id)
+    
+    send_confirmation(context, user)
+
+async def handle_message(update: Update, context: CallbackContext) -> None:
+    user = update.effective_user
+    message = update.message
+    logger.info("Получено сообщение от пользователя %s (@%s)", user.id, user.username)
     
-    message_data["file_id"] = file_id
-    message_data["file_type"] = file_type
+    if user.id in blocklist:
+        logger.info("Сообщение от заблокированного пользователя %s проигнорировано", user.id)
+        return
     
-    result = messages_collection.insert_one(message_data)
-    message_id_in_db = result.inserted_id
-    logger.info(f"Сообщение от пользователя {user.id} сохранено в базе данных с ID: {message_id_in_db}")
+    # Остальные части уже начатого альбома не расходуют лимит: альбом считается одним сообщением
+    if flood_guard.enabled and not (message.media_group_id and message.media_group_id in media_groups.groups):
+        admission = flood_guard.check(user.id)
+        if admission != FLOOD_ADMIT:
+            FLOOD_DROPPED.inc()
+            if admission == FLOOD_MUTE:
+                logger.warning("Пользователь %s заглушен за превышение частоты сообщений", user.id)
+                notify_flood(context, user)
+            return
     
-    user_info = f"👤 Пользователь: {user.first_name} {user.last_name or ''} (@{user.username or 'без username'})\n🆔 ID: {user.id}"
+    digest.record_arrival()
+    user_directory.remember_user(user)
+    MESSAGES_RECEIVED.labels(get_content_type(message)).inc()
     
-    keyboard = [
-        [
-            InlineKeyboardButton("Заблокировать", callback_data=f"block_{user.id}"),
-            InlineKeyboardButton("Ответить", callback_data=f"reply_{user.id}")
-        ]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    if message.media_group_id:
+        # Части альбома приходят отдельными обновлениями, они обрабатываются вместе после паузы
+        media_groups.add(context, user, message)
+        logger.info("Часть альбома %s от пользователя %s добавлена в ожидание", message.media_group_id, user.id)
+        return
+    
+    message_data = build_message_data(user, message)
+    fingerprint = message_data["fingerprint"] if recent_content.enabled else None
+    
+    original = recent_content.lookup(user.id, fingerprint) if fingerprint else None
+    if original:
+        # Повтор не сохраняется и не пересылается, администратор видит счетчик на первом сообщении
+        count = recent_content.repeat(original)
+        logger.info("Повтор сообщения %s от пользователя %s (×%s)", original["message_id"], user.id, count)
+        if not digest.active:
+            recent_content.show_repeat(context.bot, original)
+        send_confirmation(context, user)
+        return
+    
+    message_id_in_db = await message_buffer.add(message_data)
+    logger.info("Сообщение от пользователя %s поставлено в очередь на запись с ID: %s", user.id, message_id_in_db)
+    recent = recent_content.remember(user.id, fingerprint, message_id_in_db) if fingerprint else None
+    
+    if digest.active:
+        # Во время наплыва сообщение попадет в ближайшую сводку вместо отдельной пересылки
+        digest.add(user, message_preview(message_data))
+        send_confirmation(context, user)
+        return
+    
+    user_info = format_user_info(user)
+    content_type = message_data["content_type"]
+    
+    if content_type == "text":
+        forward_kind = "text"
+        forward_body = f"{user_info}\n\n📝 Сообщение: {message.text or '[Пустое сообщение]'}"
+        forward = outbound.submit(
+            PRIORITY_HIGH, context.bot.send_message,
+            chat_id=int(ADMIN_USER_ID),
+            text=forward_body,
+            reply_markup=user_actions_keyboard(user.id)
+        )
+    else:
+        # Любой тип содержимого пересылается одним вызовом вместе с данными пользователя и кнопками
+        label = CONTENT_LABELS.get(content_type, "сообщение")
+        forward_body = f"{user_info}\n\nПрислал {label}" + (f" с текстом: {message.caption}" if message.caption else "")
+        forward_kind = "caption" if content_type in CAPTIONABLE_TYPES and len(forward_body) <= CAPTION_LIMIT else None
+        forward = outbound.submit(PRIORITY_HIGH, context.bot.copy_message, **copy_message_kwargs(
+            int(ADMIN_USER_ID), message.chat_id, message.message_id, content_type,
+            caption=forward_body,
+            keyboard=user_actions_buttons(user.id),
+            header_button=user_header_button(user.id, user.first_name, content_type)
+        ))
+    
+    def remember_forward(sent_message):
+        # Номер пересланного сообщения нужен, чтобы показывать на нем счетчик повторов
+        recent["forward"] = {
+            "message_id": sent_message.message_id, "kind": forward_kind,
+            "body": forward_body, "reply_markup": user_actions_keyboard(user.id)
+        }
+        if recent["count"] > 1:
+            # Повторы пришли, пока пересылка ждала в очереди
+            recent_content.show_repeat(context.bot, recent)
+    track_admin_forward(context, forward, user, "сообщения", remember_forward if recent and forward_kind else None)
+    logger.info("Сообщение (%s) от пользователя %s поставлено в очередь пересылки администратору", content_type, user.id)
+    
+    send_confirmation(context, user)
+
+# Поля, которые показываются в списке сообщений
+MESSAGE_LIST_PROJECTION = {
+    "user_id": 1, "username": 1, "first_name": 1, "last_name": 1,
+    "text": 1, "caption": 1, "file_type": 1, "date": 1, "repeat_count": 1, "direction": 1
+}
+
+# Ответы администратора хранятся рядом с сообщениями пользователей, в общих списках показываются только входящие
+INBOUND_FILTER = {"direction": {"$ne": "out"}}
+
+def encode_message_cursor(message):
+    # Дата в миллисекундах (точность MongoDB) и _id, не длиннее ограничения callback_data в 64 байта
+    milliseconds = (message["date"] - datetime(1970, 1, 1)) // timedelta(milliseconds=1)
+    return f"{milliseconds}_{message['_id']}"
+
+def decode_message_cursor(milliseconds, message_id):
+    return datetime(1970, 1, 1) + timedelta(milliseconds=int(milliseconds)), ObjectId(message_id)
+
+async def fetch_messages_page(direction, cursor, limit, base_filter=None):
+    # Возвращает сообщения от новых к старым и признаки наличия более новых и более старых страниц
+    base_filter = base_filter or {}
+    if direction is None:
+        messages = await messages_collection.find(
+            base_filter, MESSAGE_LIST_PROJECTION, sort=[("date", -1), ("_id", -1)], limit=limit + 1
+        )
+        return messages[:limit], False, len(messages) > limit
+    
+    date, message_id = cursor
+    if direction == "older":
+        keyset = {"$or": [{"date": {"$lt": date}}, {"date": date, "_id": {"$lt": message_id}}]}
+        sort = [("date", -1), ("_id", -1)]
+    else:
+        keyset = {"$or": [{"date": {"$gt": date}}, {"date": date, "_id": {"$gt": message_id}}]}
+        sort = [("date", 1), ("_id", 1)]
+    messages = await messages_collection.find(
+        {"$and": [base_filter, keyset]}, MESSAGE_LIST_PROJECTION, sort=sort, limit=limit + 1
+    )
+    has_more = len(messages) > limit
+    messages = messages[:limit]
+    if direction == "older":
+        return messages, True, has_more
+    return list(reversed(messages)), has_more, True
+
+def split_message_text(header, entries, limit=4096):
+    # Делит текст на части не длиннее лимита Telegram, не разрывая отдельные записи
+    chunks = []
+    current = header
+    for entry in entries:
+        if len(current) + len(entry) > limit and current:
+            chunks.append(current)
+            current = ""
+        current += entry[:limit]
+    chunks.append(current)
+    return chunks
+
+def render_message_entries(messages):
+    entries = []
+    for idx, msg in enumerate(messages, 1):
+        username = msg.get("username", "Нет имени пользователя")
+        if username == "Нет имени пользователя":
+            username = f"{msg.get('first_name', '')} {msg.get('last_name', '')}"
+            if username.strip() == "":
+                username = f"ID: {msg['user_id']}"
+        
+        if msg.get("file_type"):
+            text = f"[{msg.get('file_type', 'вложение')}]" + (f" с текстом: {msg.get('caption', '')[:30]}" if msg.get('caption') else "")
+        else:
+            text = msg.get("text", "") or "[Пустое сообщение]"
+        
+        entry = f"{idx}. 🕒 {msg['date'].strftime('%d.%m.%Y %H:%M')}\n"
+        entry += f"👤 {username} (ID: {msg['user_id']}){' 🚫' if msg['user_id'] in blocklist else ''}\n"
+        entry += f"📝 {text[:50]}{'...' if len(text) > 50 else ''}"
+        entry += f" (×{msg['repeat_count'] + 1})\n\n" if msg.get("repeat_count") else "\n\n"
+        entries.append(entry)
+    return entries
+
+def message_view_buttons(messages):
+    # Кнопки с номерами сообщений, по 5 в ряду
+    keyboard = []
+    message_buttons = []
+    for idx, msg in enumerate(messages, 1):
+        if len(message_buttons) < 5:
+            message_buttons.append(InlineKeyboardButton(f"{idx}", callback_data=f"view_msg_{str(msg['_id'])}"))
+        else:
+            keyboard.append(message_buttons)
+            message_buttons = [InlineKeyboardButton(f"{idx}", callback_data=f"view_msg_{str(msg['_id'])}")]
     
+    if message_buttons:  # Добавляем последний ряд кнопок
+        keyboard.append(message_buttons)
+    return keyboard
+
+class MessagePageCache:
+    """Отрисованные страницы /messages в памяти.
+
+    Ключ - размер страницы, направление и ключ крайнего сообщения, значение - части текста и
+    клавиатура. Запись сообщений, счетчики повторов, архивация и блокировки увеличивают версию
+    и очищают кэш. Изменения из других экземпляров бота сюда не доходят, поэтому страница живет
+    не дольше MESSAGE_PAGE_CACHE_TTL секунд. Для сообщений со списком запоминается показанная
+    страница, и обновление без изменений обходится без обращения к Bot API.
+    """
+
+    def __init__(self, ttl, max_entries):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.version = 0
+        self.pages = OrderedDict()
+        self.shown = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.unchanged = 0
+
+    def invalidate(self):
+        self.version += 1
+        self.pages.clear()
+
+    def get(self, key):
+        page = self.pages.get(key)
+        if page is None or page["expires"] <= time.monotonic():
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.pages.move_to_end(key)
+        return page
+
+    def put(self, key, version, chunks, keyboard):
+        page = {
+            "chunks": chunks,
+            "keyboard": keyboard,
+            "signature": (tuple(chunks), tuple(
+                tuple((button.text, button.callback_data) for button in row) for row in keyboard.inline_keyboard
+            )),
+            "expires": time.monotonic() + self.ttl
+        }
+        # Если пока шел запрос версия сменилась, страница могла устареть и в кэш не попадает
+        if self.ttl > 0 and version == self.version:
+            self.pages[key] = page
+            self.pages.move_to_end(key)
+            while len(self.pages) > self.max_entries:
+                self.pages.popitem(last=False)
+        return page
+
+    def is_shown(self, message, page):
+        return self.shown.get((message.chat_id, message.message_id)) == page["signature"]
+
+    def mark_shown(self, message, page):
+        self.shown[(message.chat_id, message.message_id)] = page["signature"]
+        self.shown.move_to_end((message.chat_id, message.message_id))
+        while len(self.shown) > self.max_entries:
+            self.shown.popitem(last=False)
+
+    def stats_text(self):
+        return f"🗂️ Кэш страниц /messages: попаданий {self.hits}, промахов {self.misses}, обновлений без изменений {self.unchanged}"
+
+message_pages = MessagePageCache(MESSAGE_PAGE_CACHE_TTL, MESSAGE_PAGE_CACHE_SIZE)
+
+async def render_messages_page(limit, direction, cursor):
+    key = (limit, direction, cursor)
+    page = message_pages.get(key)
+    if page:
+        return page
+    
+    version = message_pages.version
+    latest_messages, has_newer, has_older = await fetch_messages_page(direction, cursor, limit, INBOUND_FILTER)
+    if not latest_messages:
+        return None
+    
+    entries = render_message_entries(latest_messages)
+    keyboard = message_view_buttons(latest_messages)
+    
+    # Кнопки страниц несут ключ крайнего сообщения, поэтому каждая страница - один запрос по индексу
+    navigation_buttons = []
+    if has_newer:
+        navigation_buttons.append(InlineKeyboardButton(
+            "⬅️ Новее",
+            callback_data=f"msgs_newer_{limit}_{encode_message_cursor(latest_messages[0])}"
+        ))
+    if has_older:
+        navigation_buttons.append(InlineKeyboardButton(
+            "Старше ➡️",
+            callback_data=f"msgs_older_{limit}_{encode_message_cursor(latest_messages[-1])}"
+        ))
+    if navigation_buttons:
+        keyboard.append(navigation_buttons)
+    
+    # Добавляем дополнительные функциональные кнопки
+    keyboard.append([InlineKeyboardButton("🔄 Обновить", callback_data="refresh_messages")])
+    
+    chunks = split_message_text("📬 Последние сообщения:\n\n", entries)
+    return message_pages.put(key, version, chunks, InlineKeyboardMarkup(keyboard))
+
+async def edit_messages_page(query, page):
+    # Страница заменяет текст сообщения, на кнопку которого нажали. Сообщения с медиа и страницы
+    # из нескольких частей отредактировать нельзя, для них возвращается False
+    message = query.message
+    if len(page["chunks"]) > 1 or message.text is None:
+        return False
+    if message_pages.is_shown(message, page):
+        message_pages.unchanged += 1
+        return True
     try:
-        if file_id:
-            if file_type == 'photo':
-                await context.bot.send_photo(
-                    chat_id=int(ADMIN_USER_ID),
-                    photo=file_id,
-                    caption=f"{user_info}\n\nПрислал фото" + (f" с текстом: {message.caption}" if message.caption else ""),
-                    reply_markup=reply_markup  # Ensure reply buttons are always present
-                )
-                logger.info(f"Фото от пользователя {user.id} переслано администратору")
-            elif file_type == 'document':
-                await context.bot.send_document(
-                    chat_id=int(ADMIN_USER_ID),
-                    document=file_id,
-                    caption=f"{user_info}\n\nПрислал документ" + (f" с текстом: {message.caption}" if message.caption else ""),
-                    reply_markup=reply_markup  # Ensure reply buttons are always present
-                )
-                logger.info(f"Документ от пользователя {user.id} переслан администратору")
-            elif file_type == 'video':
-                await context.bot.send_video(
-                    chat_id=int(ADMIN_USER_ID),
-                    video=file_id,
-                    caption=f"{user_info}\n\nПрислал видео" + (f" с текстом: {message.caption}" if message.caption else ""),
-                    reply_markup=reply_markup  # Ensure reply buttons are always present
-                )
-                logger.info(f"Видео от пользователя {user.id} переслан администратору")
-            elif file_type == 'voice':
-                await context.bot.send_voice(
-                    chat_id=int(ADMIN_USER_ID),
-                    voice=file_id,
-                    caption=f"{user_info}\n\nПрислал голосовое сообщение",
-                    reply_markup=reply_markup  # Ensure reply buttons are always present
-                )
-                logger.info(f"Голосовое сообщение от пользователя {user.id} переслано администратору")
-            elif file_type == 'audio':
-                await context.bot.send_audio(
-                    chat_id=int(ADMIN_USER_ID),
-                    audio=file_id,
-                    caption=f"{user_info}\n\nПрислал аудио" + (f" с текстом: {message.caption}" if message.caption else ""),
-                    reply_markup=reply_markup  # Ensure reply buttons are always present
-                )
-                logger.info(f"Аудио от пользователя {user.id} переслано администратору")
-            elif file_type == 'sticker':
-                # Send message first with reply buttons
-                await context.bot.send_message(
-                    chat_id=int(ADMIN_USER_ID),
-                    text=f"{user_info}\n\nПрислал стикер:",
-                    reply_markup=reply_markup  # Ensure reply buttons are always present
-                )
-                # Then send the sticker separately
-                await context.bot.send_sticker(
-                    chat_id=int(ADMIN_USER_ID),
-                    sticker=file_id
-                )
-                logger.info(f"Стикер от пользователя {user.id} переслан администратору")
+        await query.edit_message_text(page["chunks"][0], reply_markup=page["keyboard"])
+    except BadRequest as e:
+        if "not modified" not in str(e).lower():
+            logger.warning("Не удалось отредактировать список сообщений: %s", e)
+            return False
+    message_pages.mark_shown(message, page)
+    return True
+
+async def get_messages(update: Update, context: CallbackContext) -> None:
+    user = update.effective_user
+    if user.id != ADMIN_USER_ID:
+        # Проверяем, откуда пришел запрос (из сообщения или из callback query)
+        if update.callback_query:
+            await update.callback_query.message.reply_text("У вас нет доступа к этой команде.")
         else:
-            sent_message = await context.bot.send_message(
-                chat_id=int(ADMIN_USER_ID),
-                text=f"{user_info}\n\n📝 Сообщение: {message.text or '[Пустое сообщение]'}",
-                reply_markup=reply_markup
-            )
-            logger.info(f"Текстовое сообщение от пользователя {user.id} переслано администратору, message_id: {sent_message.message_id}")
-    except Exception as e:
-        logger.error(f"Ошибка при пересылке сообщения администратору: {str(e)}")
+            await update.message.reply_text("У вас нет доступа к этой команде.")
+        logger.warning("Пользователь %s пытался получить доступ к административной команде /messages", user.id)
+        return
+    
+    args = context.args
+    limit = MESSAGES_PAGE_SIZE
+    if args and args[0].isdigit():
+        limit = min(int(args[0]), MESSAGES_PAGE_SIZE_MAX)
+    
+    # Для перехода по страницам: направление и ключ (дата, _id) крайнего сообщения текущей страницы
+    direction = args[1] if len(args) > 3 else None
+    cursor = decode_message_cursor(args[2], args[3]) if direction else None
+    page = await render_messages_page(limit, direction, cursor)
+    
+    if page is None:
+        # Проверяем, откуда пришел запрос
+        if update.callback_query:
+            await update.callback_query.message.reply_text("Сообщений пока нет.")
+        else:
+            await update.message.reply_text("Сообщений пока нет.")
+        logger.info("Запрос на получение сообщений: сообщений нет")
+        return
+    
+    if update.callback_query and await edit_messages_page(update.callback_query, page):
+        logger.info("Список из %s сообщений показан на месте", limit)
+        return
+    
+    # Проверяем, откуда пришел запрос
+    reply_target = update.callback_query.message if update.callback_query else update.message
+    for chunk in page["chunks"][:-1]:
+        await reply_target.reply_text(chunk)
+    sent = await reply_target.reply_text(page["chunks"][-1], reply_markup=page["keyboard"])
+    if len(page["chunks"]) == 1:
+        message_pages.mark_shown(sent, page)
+    
+    logger.info("Запрос на получение %s сообщений выполнен", limit)
+
+def parse_search_args(args):
+    # /search [user:ID] [from:ДД.ММ.ГГГГ] [to:ДД.ММ.ГГГГ] запрос
+    session = {"query": "", "user_id": None, "date_from": None, "date_to": None}
+    words = []
+    for arg in args:
+        if arg.startswith("user:") and arg[5:].isdigit():
+            session["user_id"] = int(arg[5:])
+        elif arg.startswith("from:"):
+            session["date_from"] = datetime.strptime(arg[5:], "%d.%m.%Y")
+        elif arg.startswith("to:"):
+            session["date_to"] = datetime.strptime(arg[3:], "%d.%m.%Y") + timedelta(days=1)
+        else:
+            words.append(arg)
+    session["query"] = " ".join(words)
+    return session
+
+def build_range_filter(session):
+    range_filter = {}
+    if session.get("user_id"):
+        range_filter["user_id"] = session["user_id"]
+    if session.get("date_from") or session.get("date_to"):
+        range_filter["date"] = {}
+        if session.get("date_from"):
+            range_filter["date"]["$gte"] = session["date_from"]
+        if session.get("date_to"):
+            range_filter["date"]["$lt"] = session["date_to"]
+    return range_filter
+
+def build_search_filter(session):
+    search_filter = {"$text": {"$search": session["query"], "$language": "russian"}}
+    search_filter.update(build_range_filter(session))
+    search_filter.update(INBOUND_FILTER)
+    return search_filter
+
+async def search_messages(update: Update, context: CallbackContext) -> None:
+    user = update.effective_user
+    if user.id != ADMIN_USER_ID:
+        await update.effective_message.reply_text("У вас нет доступа к этой команде.")
+        logger.warning("Пользователь %s пытался получить доступ к административной команде /search", user.id)
+        return
+    
+    reply_target = update.callback_query.message if update.callback_query else update.message
+    args = context.args or []
+    
+    if update.callback_query:
+        # Переход по страницам: параметры поиска хранятся в базе под коротким ключом из callback_data
+        token, direction, milliseconds, message_id_str = args
+        session = await search_sessions_collection.find_one({"_id": token})
+        if not session:
+            await reply_target.reply_text("Результаты поиска устарели, повторите команду /search.")
+            return
+        cursor = decode_message_cursor(milliseconds, message_id_str)
+    else:
         try:
-            await context.bot.send_message(
-                chat_id=int(ADMIN_USER_ID),
-                text=f"⚠️ Ошибка при пересылке сообщения от пользователя {user.id}:\n{str(e)}"
+            session = parse_search_args(args)
+        except ValueError:
+            await reply_target.reply_text("Неверный формат даты. Используйте ДД.ММ.ГГГГ, например: from:01.02.2024")
+            return
+        if not session["query"]:
+            await reply_target.reply_text(
+                "Укажите, что искать. Например: /search привет\n"
+                "Дополнительно: user:123456789 from:01.02.2024 to:29.02.2024"
             )
-        except Exception as inner_e:
-            logger.critical(f"Критическая ошибка при отправке уведомления о проблеме: {str(inner_e)}")
+            return
+        token = secrets.token_hex(4)
+        session.update({"_id": token, "created_at": datetime.now()})
+        await search_sessions_collection.insert_one(session)
+        direction = None
+        cursor = None
+    
+    found_messages, has_newer, has_older = await fetch_messages_page(
+        direction, cursor, MESSAGES_PAGE_SIZE, build_search_filter(session)
+    )
+    
+    if not found_messages:
+        await reply_target.reply_text(f"По запросу «{session['query']}» ничего не найдено.")
+        logger.info("Поиск сообщений: ничего не найдено")
+        return
+    
+    keyboard = message_view_buttons(found_messages)
+    navigation_buttons = []
+    if has_newer:
+        navigation_buttons.append(InlineKeyboardButton(
+            "⬅️ Новее", callback_data=f"srch_{token}_newer_{encode_message_cursor(found_messages[0])}"
+        ))
+    if has_older:
+        navigation_buttons.append(InlineKeyboardButton(
+            "Старше ➡️", callback_data=f"srch_{token}_older_{encode_message_cursor(found_messages[-1])}"
+        ))
+    if navigation_buttons:
+        keyboard.append(navigation_buttons)
     
+    chunks = split_message_text(f"🔎 Результаты поиска «{session['query']}»:\n\n", render_message_entries(found_messages))
+    for chunk in chunks[:-1]:
+        await reply_target.reply_text(chunk)
+    await reply_target.reply_text(chunks[-1], reply_markup=InlineKeyboardMarkup(keyboard))
+    logger.info("Поиск сообщений выполнен, найдено на странице: %s", len(found_messages))
+
+EXPORT_CSV_FIELDS = [
+    "_id", "date", "user_id", "username", "first_name", "last_name",
+    "message_id", "direction", "text", "caption", "file_id", "file_type", "media_group_id", "media",
+]
+
+def export_value(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, (list, dict)):
+        return json.dumps(value, ensure_ascii=False, default=export_value)
+    return str(value)
+
+class MessageExport:
+    """Потоковая выгрузка сообщений в сжатые файлы JSONL или CSV.
+
+    Документы читаются курсором в порядке (date, _id) и сразу пишутся во временный gzip-файл,
+    поэтому в памяти находится только текущий пакет курсора. Когда сжатый файл достигает
+    EXPORT_PART_SIZE, часть закрывается, а следующий вызов write_part продолжает с того же
+    места курсора. Методы блокирующие и вызываются в пуле потоков базы.
+    """
+
+    def __init__(self, collections, export_filter, export_format, part_size):
+        self.collections = collections
+        self.export_filter = export_filter
+        self.export_format = export_format
+        self.part_size = part_size
+        self.cursors = []
+        self.documents = None
+        self.exported = 0
+        self.parts = 0
+
+    def _open(self):
+        for collection in self.collections:
+            cursor = collection.collection.find(self.export_filter)
+            self.cursors.append(cursor.sort([("date", ASCENDING), ("_id", ASCENDING)]).batch_size(1000))
+        # Архив хранит более старые сообщения, поэтому он выгружается первым
+        self.documents = itertools.chain.from_iterable(self.cursors)
+
+    def write_part(self):
+        if self.documents is None:
+            self._open()
+        fd, path = tempfile.mkstemp(prefix="export_", suffix=f".{self.export_format}.gz")
+        written = 0
+        with os.fdopen(fd, "wb") as raw, gzip.GzipFile(fileobj=raw, mode="wb") as archive:
+            with io.TextIOWrapper(archive, encoding="utf-8", newline="") as text:
+                if self.export_format == "csv":
+                    writer = csv.DictWriter(text, fieldnames=EXPORT_CSV_FIELDS, extrasaction="ignore")
+                    writer.writeheader()
+                for document in self.documents:
+                    if self.export_format == "csv":
+                        writer.writerow({key: export_value(value) for key, value in document.items() if value is not None})
+                    else:
+                        text.write(json.dumps(document, ensure_ascii=False, default=export_value) + "\n")
+                    written += 1
+                    # raw.tell() отстает на содержимое буферов сжатия, это покрывает запас до лимита Telegram
+                    if raw.tell() >= self.part_size:
+                        break
+        if not written:
+            os.remove(path)
+            return None
+        self.exported += written
+        self.parts += 1
+        return path
+
+    def close(self):
+        for cursor in self.cursors:
+            cursor.close()
+
+async def run_export(context: CallbackContext, export_filter, export_format) -> None:
+    collections = [messages_collection]
+    if RETENTION_DAYS > 0:
+        collections.insert(0, messages_archive_collection)
+    export = MessageExport(collections, export_filter, export_format, EXPORT_PART_SIZE)
+    stamp = datetime.now().strftime("%Y%m%d_%H%M%S")
     try:
-        await update.message.reply_text("Спасибо! Ваше сообщение было передано.")
-        logger.info(f"Подтверждение отправлено пользователю {user.id}")
+        while True:
+            path = await messages_collection.run(export.write_part)
+            if path is None:
+                break
+            try:
+                # Путь, а не открытый файл: при повторной отправке Bot API файл читается заново
+                await outbound.send(
+                    PRIORITY_LOW, context.bot.send_document,
+                    chat_id=ADMIN_USER_ID,
+                    document=Path(path),
+                    filename=f"messages_{stamp}_part{export.parts}.{export_format}.gz",
+                    write_timeout=EXPORT_UPLOAD_TIMEOUT
+                )
+            finally:
+                os.remove(path)
+        if export.exported:
+            text = f"📦 Экспорт завершен: {export.exported} сообщений, файлов: {export.parts}"
+        else:
+            text = "По заданным условиям сообщений не найдено."
+        await outbound.send(PRIORITY_NORMAL, context.bot.send_message, chat_id=ADMIN_USER_ID, text=text)
+        logger.info("Экспорт завершен: %s сообщений, частей: %s", export.exported, export.parts)
     except Exception as e:
-        logger.error(f"Ошибка при отправке подтверждения пользователю {user.id}: {str(e)}")
+        logger.error("Ошибка при экспорте сообщений: %s", e)
+        outbound.submit(
+            PRIORITY_NORMAL, context.bot.send_message,
+            chat_id=ADMIN_USER_ID,
+            text=f"Экспорт прерван после {export.exported} сообщений: {str(e)}"
+        )
+    finally:
+        await messages_collection.run(export.close)
 
-async def get_messages(update: Update, context: CallbackContext) -> None:
+async def export_messages(update: Update, context: CallbackContext) -> None:
     user = update.effective_user
     if user.id != ADMIN_USER_ID:
-        # Проверяем, откуда пришел запрос (из сообщения или из callback query)
-        if update.callback_query:
-            await update.callback_query.message.reply_text("У вас нет доступа к этой команде.")
-        else:
-            await update.message.reply_text("У вас нет доступа к этой команде.")
-        logger.warning(f"Пользователь {user.id} пытался получить доступ к административной команде /messages")
+        await update.message.reply_text("У вас нет доступа к этой команде.")
+        logger.warning("Пользователь %s пытался получить доступ к административной команде /export", user.id)
         return
     
-    args = context.args
-    limit = 10 
-    if args and args[0].isdigit():
-        limit = int(args[0])
-    
-    latest_messages = list(messages_collection.find().sort("date", -1).limit(limit))
-    
-    if not latest_messages:
-        # Проверяем, откуда пришел запрос
-        if update.callback_query:
-            await update.callback_query.message.reply_text("Сообщений пока нет.")
-        else:
-            await update.message.reply_text("Сообщений пока нет.")
-        logger.info("Запрос на получение сообщений: сообщений нет")
+    try:
+        # Формат указывается тем же свободным словом, которым в /search задается запрос
+        session = parse_search_args(context.args or [])
+    except ValueError:
+        await update.message.reply_text("Неверный формат даты. Используйте ДД.ММ.ГГГГ, например: from:01.02.2024")
+        return
+    export_format = session["query"].lower() or "jsonl"
+    if export_format not in ("jsonl", "csv"):
+        await update.message.reply_text(
+            "Использование: /export [user:123456789] [from:01.02.2024] [to:29.02.2024] [jsonl|csv]"
+        )
         return
     
-    response = "📬 Последние сообщения:\n\n"
-    for idx, msg in enumerate(latest_messages, 1):
-        username = msg.get("username", "Нет имени пользователя")
-        if username == "Нет имени пользователя":
-            username = f"{msg.get('first_name', '')} {msg.get('last_name', '')}"
-            if username.strip() == "":
-                username = f"ID: {msg['user_id']}"
-        
-        if msg.get("file_type"):
-            text = f"[{msg.get('file_type', 'вложение')}]" + (f" с текстом: {msg.get('caption', '')[:30]}" if msg.get('caption') else "")
-        else:
-            text = msg.get("text", "") or "[Пустое сообщение]"
-        
-        response += f"{idx}. 🕒 {msg['date'].strftime('%d.%m.%Y %H:%M')}\n"
-        response += f"👤 {username} (ID: {msg['user_id']})\n"
-        response += f"📝 {text[:50]}{'...' if len(text) > 50 else ''}\n\n"
-    
-    # Создаем улучшенное навигационное меню
-    keyboard = []
+    # Выгрузка может идти долго, поэтому она не занимает очередь обработки обновлений администратора
+    context.application.create_task(run_export(context, build_range_filter(session), export_format))
+    await update.message.reply_text("⏳ Экспорт начат, файлы придут по мере готовности.")
+    logger.info("Запущен экспорт сообщений в формате %s", export_format)
+
+async def broadcast_message(update: Update, context: CallbackContext) -> None:
+    user = update.effective_user
+    if user.id != ADMIN_USER_ID:
+        await update.message.reply_text("У вас нет доступа к этой команде.")
+        logger.warning("Пользователь %s пытался получить доступ к административной команде /broadcast", user.id)
+        return
     
-    # Добавляем кнопки с номерами сообщений
-    message_buttons = []
-    for idx, msg in enumerate(latest_messages, 1):
-        if len(message_buttons) < 5:  # По 5 кнопок в ряду
-            message_buttons.append(InlineKeyboardButton(f"{idx}", callback_data=f"view_msg_{str(msg['_id'])}"))
+    args = context.args or []
+    if args == ["stop"]:
+        if await broadcaster.cancel():
+            await update.message.reply_text("Рассылка будет остановлена после текущего пакета.")
+            logger.info("Рассылка остановлена администратором")
         else:
-            keyboard.append(message_buttons)
-            message_buttons = [InlineKeyboardButton(f"{idx}", callback_data=f"view_msg_{str(msg['_id'])}")]
-    
-    if message_buttons:  # Добавляем последний ряд кнопок
-        keyboard.append(message_buttons)
-    
-    # Добавляем дополнительные функциональные кнопки
-    keyboard.append([
-        InlineKeyboardButton("🔄 Обновить", callback_data="refresh_messages"),
-        InlineKeyboardButton("🔍 Больше сообщений", callback_data=f"more_messages_{limit}")
-    ])
-    
-    reply_markup = InlineKeyboardMarkup(keyboard)
+            await update.message.reply_text("Нет выполняющейся рассылки.")
+        return
     
-    # Проверяем, откуда пришел запрос
-    if update.callback_query:
-        await update.callback_query.message.reply_text(response, reply_markup=reply_markup)
+    # Текст после команды отправляется как есть, а сообщение, на которое ответили командой, копируется
+    source = update.message.reply_to_message
+    if source:
+        content = {"from_chat_id": source.chat_id, "message_id": source.message_id}
+    elif args:
+        content = {"text": update.message.text.split(maxsplit=1)[1]}
     else:
-        await update.message.reply_text(response, reply_markup=reply_markup)
+        await update.message.reply_text(
+            "Использование: /broadcast текст, или ответьте командой /broadcast на сообщение, которое нужно разослать.\n"
+            "Остановить рассылку: /broadcast stop"
+        )
+        return
     
-    logger.info(f"Запрос на получение {limit} сообщений выполнен")
+    status_message = await update.message.reply_text("📣 Рассылка запускается...")
+    try:
+        broadcast = await broadcaster.create(context.bot, content, status_message)
+    except DuplicateKeyError:
+        await status_message.edit_text("Уже выполняется другая рассылка. Остановить ее: /broadcast stop")
+        return
+    logger.info("Запущена рассылка %s для %s пользователей", broadcast["_id"], broadcast["total"])
+
+# Запасной способ показать файл, если исходное сообщение в чате пользователя уже удалено
+STORED_FILE_SENDERS = {
+    "photo": "send_photo", "video": "send_video", "document": "send_document", "audio": "send_audio",
+    "voice": "send_voice", "animation": "send_animation", "sticker": "send_sticker", "video_note": "send_video_note",
+}
+
+async def replay_stored_content(bot, chat_id, message, content_type):
+    try:
+        await copy_message_with_header(
+            bot, PRIORITY_INTERACTIVE, chat_id, message.get("chat_id", message["user_id"]), message["message_id"], content_type
+        )
+        return
+    except BadRequest as e:
+        logger.warning("Не удалось скопировать сообщение %s из чата %s: %s", message["message_id"], message["user_id"], e)
+    if message.get("file_id") and content_type in STORED_FILE_SENDERS:
+        try:
+            await outbound.send(
+                PRIORITY_INTERACTIVE, getattr(bot, STORED_FILE_SENDERS[content_type]),
+                chat_id=chat_id,
+                **{content_type: message["file_id"]}
+            )
+            return
+        except Exception as e:
+            logger.error("Ошибка при отправке медиафайла: %s", e)
+    await outbound.send(PRIORITY_INTERACTIVE, bot.send_message, chat_id=chat_id, text="Исходное сообщение удалено пользователем.")
 
 async def view_message(update: Update, context: CallbackContext, message_id_str: str) -> None:
+    # Ответы идут через очередь отправки с приоритетом выше пересылок и по порядку: детали не
+    # обгоняют копию исходного сообщения
+    chat_id = update.callback_query.message.chat_id
     try:
-        from bson import ObjectId
-        message = messages_collection.find_one({"_id": ObjectId(message_id_str)})
+        message = await messages_collection.find_one({"_id": ObjectId(message_id_str)})
+        archived = False
+        if not message:
+            # Старые сообщения могли быть перенесены в архив
+            message = await messages_archive_collection.find_one({"_id": ObjectId(message_id_str)})
+            archived = message is not None
         
         if not message:
-            await update.callback_query.message.reply_text("Сообщение не найдено в базе данных.")
-            logger.warning(f"Попытка просмотреть несуществующее сообщение с ID {message_id_str}")
+            await outbound.send(
+                PRIORITY_INTERACTIVE, context.bot.send_message,
+                chat_id=chat_id,
+                text="Сообщение не найдено в базе данных."
+            )
+            logger.warning("Попытка просмотреть несуществующее сообщение с ID %s", message_id_str)
             return
         
         username = message.get("username") or f"{message.get('first_name', '')} {message.get('last_name', '')}"
         if username.strip() == "":
             username = f"Пользователь с ID: {message['user_id']}"
         
-        detail_text = f"📝 Детали сообщения:\n\n"
+        detail_text = f"📝 Детали сообщения{' (из архива)' if archived else ''}:\n\n"
         detail_text += f"👤 Пользователь: {username}\n"
         detail_text += f"🆔 ID пользователя: {message['user_id']}\n"
         detail_text += f"🕒 Дата: {message['date'].strftime('%d.%m.%Y %H:%M:%S')}\n"
+        if message.get("direction") == "out":
+            detail_text += "↩️ Ответ администратора\n"
         
-        file_id = message.get("file_id")
-        file_type = message.get("file_type")
+        content_type = stored_content_type(message)
+        if message.get("repeat_count"):
+            detail_text += f"🔁 Отправлено повторно: {message['repeat_count']} раз\n"
         
-        if file_type:
-            detail_text += f"📎 Тип файла: {file_type}\n"
+        if content_type != "text":
+            detail_text += f"📎 Тип: {content_type}\n"
             if message.get("caption"):
                 detail_text += f"📄 Подпись: {message['caption']}\n"
         else:
@@ -302,67 +2476,170 @@ async def view_message(update: Update, context: CallbackContext, message_id_str:
             [InlineKeyboardButton("⬅️ Вернуться к списку", callback_data="back_to_messages")]
         ]
         
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
-        logger.info(f"Отправка деталей сообщения с ID {message_id_str} с кнопками навигации")
+        logger.info("Отправка деталей сообщения с ID %s с кнопками навигации", message_id_str)
         
-        # Отправляем сообщение с деталями и кнопками
-        message_with_buttons = await update.callback_query.message.reply_text(detail_text, reply_markup=reply_markup)
+        if content_type in CAPTIONABLE_TYPES and len(detail_text) <= CAPTION_LIMIT:
+            try:
+                # Исходное сообщение повторяется одним вызовом, детали и кнопки идут в его подписи
+                await copy_message_with_header(
+                    context.bot, PRIORITY_INTERACTIVE, chat_id, message.get("chat_id", message["user_id"]),
+                    message["message_id"], content_type, caption=detail_text, keyboard=keyboard
+                )
+                logger.info("Просмотр деталей сообщения с ID %s успешно завершен", message_id_str)
+                return
+            except BadRequest as e:
+                logger.warning("Не удалось скопировать сообщение с ID %s: %s", message_id_str, e)
         
-        # Если сообщение содержит медиафайл, отправляем его
-        if file_id:
+        # Детали ставятся в очередь без ожидания, чтобы копия встала сразу за ними и между ними
+        # не оказалась пересылка
+        details = outbound.submit(
+            PRIORITY_INTERACTIVE, context.bot.send_message,
+            chat_id=chat_id,
+            text=detail_text,
+            reply_markup=InlineKeyboardMarkup(keyboard)
+        )
+        if content_type == "media_group":
             try:
-                if file_type == 'photo':
-                    await context.bot.send_photo(
-                        chat_id=update.callback_query.message.chat_id,
-                        photo=file_id,
-                        caption="📷 Фото из сообщения"
-                    )
-                elif file_type == 'document':
-                    await context.bot.send_document(
-                        chat_id=update.callback_query.message.chat_id,
-                        document=file_id,
-                        caption="📄 Документ из сообщения"
-                    )
-                elif file_type == 'video':
-                    await context.bot.send_video(
-                        chat_id=update.callback_query.message.chat_id,
-                        video=file_id,
-                        caption="🎥 Видео из сообщения"
-                    )
-                elif file_type == 'voice':
-                    await context.bot.send_voice(
-                        chat_id=update.callback_query.message.chat_id,
-                        voice=file_id,
-                        caption="🎤 Голосовое сообщение"
-                    )
-                elif file_type == 'audio':
-                    await context.bot.send_audio(
-                        chat_id=update.callback_query.message.chat_id,
-                        audio=file_id,
-                        caption="🎵 Аудио из сообщения"
-                    )
-                elif file_type == 'sticker':
-                    await context.bot.send_sticker(
-                        chat_id=update.callback_query.message.chat_id,
-                        sticker=file_id
-                    )
-                logger.info(f"Отправлен медиафайл типа {file_type} для сообщения с ID {message_id_str}")
+                await outbound.send(
+                    PRIORITY_INTERACTIVE, context.bot.send_media_group,
+                    chat_id=chat_id,
+                    media=[build_input_media(item["file_id"], item["file_type"]) for item in message.get("media", [])]
+                )
             except Exception as e:
-                logger.error(f"Ошибка при отправке медиафайла: {str(e)}")
-                await update.callback_query.message.reply_text(f"Ошибка при отправке медиафайла: {str(e)}")
+                logger.error("Ошибка при отправке альбома: %s", e)
+                outbound.submit(
+                    PRIORITY_INTERACTIVE, context.bot.send_message,
+                    chat_id=chat_id,
+                    text=f"Ошибка при отправке альбома: {str(e)}"
+                )
+        elif content_type != "text":
+            await replay_stored_content(context.bot, chat_id, message, content_type)
+        await details
         
-        logger.info(f"Просмотр деталей сообщения с ID {message_id_str} успешно завершен")
+        logger.info("Просмотр деталей сообщения с ID %s успешно завершен", message_id_str)
     except Exception as e:
-        logger.error(f"Ошибка при показе детальной информации о сообщении: {str(e)}")
-        await update.callback_query.message.reply_text(f"Произошла ошибка: {str(e)}")
+        logger.error("Ошибка при показе детальной информации о сообщении: %s", e)
+        outbound.submit(PRIORITY_INTERACTIVE, context.bot.send_message, chat_id=chat_id, text=f"Произошла ошибка: {str(e)}")
+
+def render_thread_entries(messages, user_name):
+    # Переписка в хронологическом порядке: входящие и ответы администратора отмечены стрелками
+    entries = []
+    for idx, msg in enumerate(messages, 1):
+        author = "➡️ Вы" if msg.get("direction") == "out" else f"⬅️ {user_name}"
+        text = message_preview(msg)
+        entry = f"{idx}. {author} · 🕒 {msg['date'].strftime('%d.%m.%Y %H:%M')}\n"
+        entry += f"📝 {text[:100]}{'...' if len(text) > 100 else ''}"
+        entry += f" (×{msg['repeat_count'] + 1})\n\n" if msg.get("repeat_count") else "\n\n"
+        entries.append(entry)
+    return entries
+
+async def show_user_messages(update: Update, context: CallbackContext, user_id: int, direction=None, cursor=None) -> None:
+    # Переписка с пользователем в обе стороны, страницы по ключу (дата, _id), как в /messages
+    thread_messages, has_newer, has_older = await fetch_messages_page(
+        direction, cursor, MESSAGES_PAGE_SIZE, {"user_id": user_id}
+    )
+    
+    if not thread_messages:
+        await update.callback_query.message.reply_text(f"Сообщений от пользователя с ID {user_id} нет.")
+        return
+    
+    if direction is None:
+        # Открытие переписки с последних сообщений считается их прочтением
+        await user_directory.mark_read(user_id)
+    
+    user_name = await user_directory.display_name(user_id, f"ID: {user_id}")
+    thread_messages = list(reversed(thread_messages))
+    entries = render_thread_entries(thread_messages, user_name)
+    keyboard = message_view_buttons(thread_messages)
+    
+    navigation_buttons = []
+    if has_older:
+        navigation_buttons.append(InlineKeyboardButton(
+            "⬅️ Раньше", callback_data=f"thr_{user_id}_older_{encode_message_cursor(thread_messages[0])}"
+        ))
+    if has_newer:
+        navigation_buttons.append(InlineKeyboardButton(
+            "Позже ➡️", callback_data=f"thr_{user_id}_newer_{encode_message_cursor(thread_messages[-1])}"
+        ))
+    if navigation_buttons:
+        keyboard.append(navigation_buttons)
+    keyboard.extend(user_actions_keyboard(user_id).inline_keyboard)
+    keyboard.append([InlineKeyboardButton("📥 Входящие", callback_data="inbox")])
+    
+    chunks = split_message_text(f"💬 Переписка с {user_name} (ID: {user_id}):\n\n", entries)
+    for chunk in chunks[:-1]:
+        await update.callback_query.message.reply_text(chunk)
+    await update.callback_query.message.reply_text(chunks[-1], reply_markup=InlineKeyboardMarkup(keyboard))
+    logger.info("Показана переписка с пользователем с ID %s", user_id)
+
+async def get_inbox(update: Update, context: CallbackContext) -> None:
+    user = update.effective_user
+    reply_target = update.callback_query.message if update.callback_query else update.message
+    if user.id != ADMIN_USER_ID:
+        await reply_target.reply_text("У вас нет доступа к этой команде.")
+        logger.warning("Пользователь %s пытался получить доступ к административной команде /inbox", user.id)
+        return
+    
+    # Счетчики и последнее сообщение ведутся в users при каждой записи, поэтому страница - один запрос по индексу
+    inbox_filter = {"last_activity": {"$exists": True}}
+    args = context.args or []
+    if len(args) == 2:
+        last_activity, user_doc_id = decode_message_cursor(args[0], args[1])
+        inbox_filter = {"$or": [
+            {"last_activity": {"$lt": last_activity}},
+            {"last_activity": last_activity, "_id": {"$lt": user_doc_id}}
+        ]}
+    conversations = await users_collection.find(
+        inbox_filter,
+        {"user_id": 1, "username": 1, "first_name": 1, "last_name": 1, "blocked": 1,
+         "last_activity": 1, "last_preview": 1, "unread": 1},
+        sort=[("last_activity", -1), ("_id", -1)], limit=MESSAGES_PAGE_SIZE + 1
+    )
+    has_more = len(conversations) > MESSAGES_PAGE_SIZE
+    conversations = conversations[:MESSAGES_PAGE_SIZE]
+    
+    if not conversations:
+        await reply_target.reply_text("Переписок пока нет.")
+        return
+    
+    entries = []
+    keyboard = []
+    for idx, conversation in enumerate(conversations, 1):
+        name = format_display_name(
+            (conversation.get("username"), conversation.get("first_name"), conversation.get("last_name")),
+            f"ID: {conversation['user_id']}"
+        )
+        unread = conversation.get("unread", 0)
+        entry = f"{idx}. {'🔵' if unread else '⚪️'} {name} (ID: {conversation['user_id']})"
+        entry += " 🚫" if conversation.get("blocked") else ""
+        entry += f" — непрочитанных: {unread}\n" if unread else "\n"
+        entry += f"🕒 {conversation['last_activity'].strftime('%d.%m.%Y %H:%M')}\n"
+        entry += f"📝 {conversation.get('last_preview', '')}\n\n"
+        entries.append(entry)
+        keyboard.append([InlineKeyboardButton(
+            f"{idx}. {name}" + (f" ({unread})" if unread else ""),
+            callback_data=f"user_msgs_{conversation['user_id']}"
+        )])
+    
+    if has_more:
+        last = conversations[-1]
+        milliseconds = (last["last_activity"] - datetime(1970, 1, 1)) // timedelta(milliseconds=1)
+        keyboard.append([InlineKeyboardButton("Дальше ➡️", callback_data=f"inbox_{milliseconds}_{last['_id']}")])
+    keyboard.append([InlineKeyboardButton("🔄 Обновить", callback_data="inbox")])
+    
+    chunks = split_message_text("📥 Входящие:\n\n", entries)
+    for chunk in chunks[:-1]:
+        await reply_target.reply_text(chunk)
+    await reply_target.reply_text(chunks[-1], reply_markup=InlineKeyboardMarkup(keyboard))
+    logger.info("Показан список переписок")
 
 async def block_user(update: Update, context: CallbackContext) -> None:
     user = update.effective_user
     if user.id != ADMIN_USER_ID:
         await update.message.reply_text("У вас нет доступа к этой команде.")
-        logger.warning(f"Пользователь {user.id} пытался получить доступ к административной команде /block")
-        await context.bot.send_message(
+        logger.warning("Пользователь %s пытался получить доступ к административной команде /block", user.id)
+        await outbound.send(
+            PRIORITY_NORMAL, context.bot.send_message,
             chat_id=ADMIN_USER_ID,
             text=f"⚠️ Пользователь с ID {user.id} пытался получить доступ к административной команде /block"
         )
@@ -375,31 +2652,26 @@ async def block_user(update: Update, context: CallbackContext) -> None:
     
     user_id = int(args[0])
     
-    if not messages_collection.find_one({"user_id": user_id}):
+    if not await user_directory.exists(user_id):
         await update.message.reply_text(f"Пользователь с ID {user_id} не найден в базе данных.")
-        logger.warning(f"Попытка заблокировать несуществующего пользователя с ID {user_id}")
+        logger.warning("Попытка заблокировать несуществующего пользователя с ID %s", user_id)
         return
     
-    if blocked_users_collection.find_one({"user_id": user_id}):
+    if not await blocklist.block(user_id, user.id):
         await update.message.reply_text(f"Пользователь с ID {user_id} уже заблокирован.")
-        logger.info(f"Попытка заблокировать уже заблокированного пользователя с ID {user_id}")
+        logger.info("Попытка заблокировать уже заблокированного пользователя с ID %s", user_id)
         return
     
-    blocked_users_collection.insert_one({
-        "user_id": user_id,
-        "blocked_by": user.id,
-        "blocked_at": datetime.now()
-    })
-    
     await update.message.reply_text(f"Пользователь с ID {user_id} заблокирован.")
-    logger.info(f"Пользователь с ID {user_id} заблокирован администратором")
+    logger.info("Пользователь с ID %s заблокирован администратором", user_id)
 
 async def unblock_user(update: Update, context: CallbackContext) -> None:
     user = update.effective_user
     if user.id != ADMIN_USER_ID:
         await update.message.reply_text("У вас нет доступа к этой команде.")
-        logger.warning(f"Пользователь {user.id} пытался получить доступ к административной команде /unblock")
-        await context.bot.send_message(
+        logger.warning("Пользователь %s пытался получить доступ к административной команде /unblock", user.id)
+        await outbound.send(
+            PRIORITY_NORMAL, context.bot.send_message,
             chat_id=ADMIN_USER_ID,
             text=f"⚠️ Пользователь с ID {user.id} пытался получить доступ к административной команде /unblock"
         )
@@ -411,31 +2683,36 @@ async def unblock_user(update: Update, context: CallbackContext) -> None:
         return
     
     user_id = int(args[0])
-    result = blocked_users_collection.delete_one({"user_id": user_id})
     
-    if result.deleted_count > 0:
+    if await blocklist.unblock(user_id):
         await update.message.reply_text(f"Пользователь с ID {user_id} разблокирован.")
-        logger.info(f"Пользователь с ID {user_id} разблокирован администратором")
+        logger.info("Пользователь с ID %s разблокирован администратором", user_id)
     else:
         await update.message.reply_text(f"Пользователь с ID {user_id} не был заблокирован.")
-        logger.warning(f"Попытка разблокировать незаблокированного пользователя с ID {user_id}")
+        logger.warning("Попытка разблокировать незаблокированного пользователя с ID %s", user_id)
 
 async def get_blocked_users(update: Update, context: CallbackContext) -> None:
     user = update.effective_user
     if user.id != ADMIN_USER_ID:
         await update.message.reply_text("У вас нет доступа к этой команде.")
-        logger.warning(f"Пользователь {user.id} пытался получить доступ к административной команде /blocked")
+        logger.warning("Пользователь %s пытался получить доступ к административной команде /blocked", user.id)
         try:
-            await context.bot.send_message(
+            await outbound.send(
+                PRIORITY_NORMAL, context.bot.send_message,
                 chat_id=ADMIN_USER_ID,
                 text=f"⚠️ Пользователь с ID {user.id} пытался получить доступ к административной команде /blocked"
             )
         except Exception as e:
-            logger.error(f"Ошибка при отправке уведомления администратору: {str(e)}")
+            logger.error("Ошибка при отправке уведомления администратору: %s", e)
         return
     
     try:
-        blocked_users = list(blocked_users_collection.find())
+        # Один запрос: блокировки вместе со сведениями о пользователях
+        blocked_users = await blocked_users_collection.aggregate([
+            {"$sort": {"blocked_at": 1}},
+            {"$lookup": {"from": "users", "localField": "user_id", "foreignField": "user_id", "as": "user"}},
+            {"$project": {"user_id": 1, "blocked_at": 1, "user": {"$arrayElemAt": ["$user", 0]}}}
+        ])
         
         if not blocked_users:
             await update.message.reply_text("Заблокированных пользователей нет.")
@@ -445,16 +2722,14 @@ async def get_blocked_users(update: Update, context: CallbackContext) -> None:
         response = "🚫 Заблокированные пользователи:\n\n"
         
         for i, user_data in enumerate(blocked_users, 1):
-            user_info = messages_collection.find_one({"user_id": user_data["user_id"]})
+            user_info = user_data.get("user")
             username = "Неизвестный пользователь"
             
             if user_info:
-                if user_info.get("username"):
-                    username = f"@{user_info['username']}"
-                else:
-                    username = f"{user_info.get('first_name', '')} {user_info.get('last_name', '')}"
-                    if username.strip() == "":
-                        username = f"ID: {user_data['user_id']}"
+                username = format_display_name(
+                    (user_info.get("username"), user_info.get("first_name"), user_info.get("last_name")),
+                    f"ID: {user_data['user_id']}"
+                )
             
             blocked_at = user_data["blocked_at"].strftime("%d.%m.%Y %H:%M")
             user_id = user_data["user_id"]
@@ -487,7 +2762,7 @@ async def get_blocked_users(update: Update, context: CallbackContext) -> None:
         await update.message.reply_text(response, reply_markup=reply_markup, parse_mode="Markdown")
         logger.info("Запрос на получение списка заблокированных пользователей выполнен")
     except Exception as e:
-        logger.error(f"Ошибка при получении списка заблокированных пользователей: {str(e)}")
+        logger.error("Ошибка при получении списка заблокированных пользователей: %s", e)
         await update.message.reply_text(f"Произошла ошибка при получении списка заблокированных пользователей: {str(e)}")
 
 async def button_callback(update: Update, context: CallbackContext) -> None:
@@ -495,61 +2770,64 @@ async def button_callback(update: Update, context: CallbackContext) -> None:
     await query.answer()
     data = query.data
     
-    logger.info(f"Получен callback запрос: {data}")
+    logger.info("Получен callback запрос: %s", data)
     
     if data.startswith("block_"):
         user_id = int(data.split("_")[1])
         
-        if blocked_users_collection.find_one({"user_id": user_id}):
+        if not await blocklist.block(user_id, ADMIN_USER_ID):
             await query.message.reply_text(text=f"Пользователь с ID {user_id} уже заблокирован.")
-            logger.info(f"Попытка заблокировать уже заблокированного пользователя с ID {user_id}")
+            logger.info("Попытка заблокировать уже заблокированного пользователя с ID %s", user_id)
             return
         
-        blocked_users_collection.insert_one({
-            "user_id": user_id,
-            "blocked_by": ADMIN_USER_ID,
-            "blocked_at": datetime.now()
-        })
-        
         # Отправляем новое сообщение вместо редактирования
         await query.message.reply_text(text=f"🚫 Пользователь с ID {user_id} заблокирован.")
-        logger.info(f"Пользователь с ID {user_id} заблокирован через кнопку в интерфейсе")
+        logger.info("Пользователь с ID %s заблокирован через кнопку в интерфейсе", user_id)
     
     elif data.startswith("unblock_"):
         user_id = int(data.split("_")[1])
-        result = blocked_users_collection.delete_one({"user_id": user_id})
         
-        if result.deleted_count > 0:
+        if await blocklist.unblock(user_id):
             await query.message.reply_text(text=f"✅ Пользователь с ID {user_id} разблокирован.", parse_mode="Markdown")
-            logger.info(f"Пользователь с ID {user_id} разблокирован через кнопку в интерфейсе")
+            logger.info("Пользователь с ID %s разблокирован через кнопку в интерфейсе", user_id)
         else:
             await query.message.reply_text(text=f"Пользователь с ID {user_id} не был заблокирован.", parse_mode="Markdown")
-            logger.warning(f"Попытка разблокировать незаблокированного пользователя с ID {user_id}")
+            logger.warning("Попытка разблокировать незаблокированного пользователя с ID %s", user_id)
     
     elif data.startswith("reply_"):
         user_id = int(data.split("_")[1])
-        context.user_data["reply_to"] = user_id
-        
-        user_info = messages_collection.find_one({"user_id": user_id})
-        username = "Неизвестный пользователь"
+        await reply_state.set(ADMIN_USER_ID, user_id)
         
-        if user_info:
-            if user_info.get("username"):
-                username = f"@{user_info['username']}"
-            else:
-                username = f"{user_info.get('first_name', '')} {user_info.get('last_name', '')}"
-                if username.strip() == "":
-                    username = f"Пользователь с ID: {user_id}"
+        username = await user_directory.display_name(user_id, f"Пользователь с ID: {user_id}")
         
         # Отправляем новое сообщение вместо редактирования существующего
         await query.message.reply_text(f"✏️ Теперь вы отвечаете пользователю {username} (ID: {user_id}).\nОтправьте ваш ответ или используйте /cancel для отмены.")
-        logger.info(f"Активирован режим ответа пользователю с ID {user_id}")
+        logger.info("Активирован режим ответа пользователю с ID %s", user_id)
+    
+    elif data.startswith("user_msgs_"):
+        user_id = int(data.split("_")[2])
+        await show_user_messages(update, context, user_id)
+    
+    elif data.startswith("thr_"):
+        # Страница переписки: thr_<пользователь>_<направление>_<дата>_<_id>
+        try:
+            _, user_id, direction, milliseconds, message_id_str = data.split("_")
+            await show_user_messages(
+                update, context, int(user_id), direction, decode_message_cursor(milliseconds, message_id_str)
+            )
+        except Exception as e:
+            logger.error("Ошибка при переходе по странице переписки: %s", e)
+            await query.message.reply_text(f"Произошла ошибка: {str(e)}")
+    
+    elif data == "inbox" or data.startswith("inbox_"):
+        context.args = data.split("_")[1:]
+        await get_inbox(update, context)
     
     elif data.startswith("view_msg_"):
         message_id_str = data.split("_")[2]
-        logger.info(f"Запрос на просмотр сообщения с ID {message_id_str}")
+        logger.info("Запрос на просмотр сообщения с ID %s", message_id_str)
         await view_message(update, context, message_id_str)
-        logger.info(f"Просмотр сообщения с ID {message_id_str} завершен")
+        logger.info("Просмотр сообщения с ID %s завершен", message_id_str)
     
     elif data == "back_to_messages":
         logger.info("Получен запрос на возврат к списку сообщений")
@@ -564,28 +2842,39 @@ async def button_callback(update: Update, context: CallbackContext) -> None:
         await get_messages(update, context)
         logger.info("Обновление списка сообщений выполнено")
     
-    elif data.startswith("more_messages_"):
-        # Получение большего количества сообщений
+    elif data.startswith("msgs_older_") or data.startswith("msgs_newer_"):
+        # Переход по страницам: msgs_<направление>_<размер>_<дата>_<_id>
         try:
-            current_limit = int(data.split("_")[2])
-            new_limit = current_limit + 10  # Увеличиваем на 10
-            logger.info(f"Получен запрос на больше сообщений (новый лимит: {new_limit})")
-            context.args = [str(new_limit)]
+            _, direction, page_size, milliseconds, message_id_str = data.split("_")
+            logger.info("Получен запрос на страницу сообщений (%s)", direction)
+            context.args = [page_size, direction, milliseconds, message_id_str]
             await get_messages(update, context)
-            logger.info(f"Запрос на больше сообщений выполнен (лимит: {new_limit})")
         except Exception as e:
-            logger.error(f"Ошибка при запросе большего количества сообщений: {str(e)}")
+            logger.error("Ошибка при переходе по страницам сообщений: %s", e)
+            await query.message.reply_text(f"Произошла ошибка: {str(e)}")
+    
+    elif data.startswith("srch_"):
+        # Страница результатов поиска: srch_<ключ>_<направление>_<дата>_<_id>
+        try:
+            context.args = data.split("_")[1:]
+            await search_messages(update, context)
+        except Exception as e:
+            logger.error("Ошибка при переходе по результатам поиска: %s", e)
             await query.message.reply_text(f"Произошла ошибка: {str(e)}")
+    
+    elif data.startswith("more_messages_"):
+        # Кнопка из старых версий бота: показываем первую страницу
+        context.args = []
+        await get_messages(update, context)
 
 async def cancel(update: Update, context: CallbackContext) -> None:
     user = update.effective_user
     if user.id != ADMIN_USER_ID:
         await update.message.reply_text("У вас нет доступа к этой команде.")
-        logger.warning(f"Пользователь {user.id} пытался получить доступ к административной команде /cancel")
+        logger.warning("Пользователь %s пытался получить доступ к административной команде /cancel", user.id)
         return
     
-    if "reply_to" in context.user_data:
-        del context.user_data["reply_to"]
+    if await reply_state.consume(user.id) is not None:
         await update.message.reply_text("Режим ответа отменен.")
         logger.info("Режим ответа отменен")
     else:
@@ -596,71 +2885,624 @@ async def admin_reply(update: Update, context: CallbackContext) -> None:
     if user.id != ADMIN_USER_ID:
         return
     
-    if "reply_to" not in context.user_data:
+    if await reply_state.get(user.id) is None:
         return
     
-    user_id = context.user_data["reply_to"]
+    # Цель ответа забирается атомарно: если ее уже забрал другой экземпляр бота, ничего не отправляем
+    user_id = await reply_state.consume(user.id)
+    if user_id is None:
+        return
     message = update.message
     
     try:
-        if message.photo:
-            await context.bot.send_photo(
-                chat_id=user_id,
-                photo=message.photo[-1].file_id,
-                caption=message.caption or "Ответ от администратора"
-            )
-        elif message.document:
-            await context.bot.send_document(
+        content_type = get_content_type(message)
+        if content_type == "text":
+            await outbound.send(
+                PRIORITY_HIGH, context.bot.send_message,
                 chat_id=user_id,
-                document=message.document.file_id,
-                caption=message.caption or "Ответ от администратора"
+                text=f"Ответ от администратора: {message.text}"
             )
-        elif message.video:
-            await context.bot.send_video(
-                chat_id=user_id,
-                video=message.video.file_id,
-                caption=message.caption or "Ответ от администратора"
+        else:
+            # Ответ любого типа копируется одним вызовом; без своей подписи он подписывается как ответ администратора
+            await copy_message_with_header(
+                context.bot, PRIORITY_HIGH, user_id, message.chat_id, message.message_id, content_type,
+                caption=None if message.caption else "Ответ от администратора"
             )
-        elif message.voice:
-            await context.bot.send_voice(
-                chat_id=user_id,
-                voice=message.voice.file_id,
-                caption="Ответ от администратора"
+        
+        recent_content.forget_user(user_id)
+        outbound.submit(
+            PRIORITY_INTERACTIVE, context.bot.send_message,
+            chat_id=message.chat_id,
+            text=f"Сообщение отправлено пользователю (ID: {user_id})."
+        )
+        logger.info("Ответ отправлен пользователю с ID %s", user_id)
+    except Exception as e:
+        await reply_state.restore(user.id, user_id)
+        outbound.submit(
+            PRIORITY_INTERACTIVE, context.bot.send_message,
+            chat_id=message.chat_id,
+            text=f"Ошибка при отправке сообщения: {str(e)}"
+        )
+        logger.error("Ошибка при отправке ответа пользователю %s: %s", user_id, e)
+        return
+    
+    # Ответ сохраняется в переписку пользователя; запись обнуляет его счетчик непрочитанных
+    reply_data = build_message_data(user, message)
+    reply_data.update({
+        "user_id": user_id,
+        "username": "",
+        "first_name": "",
+        "last_name": "",
+        "fingerprint": None,
+        "direction": "out"
+    })
+    await message_buffer.add(reply_data)
+
+class UserLaneUpdateProcessor(BaseUpdateProcessor):
+    """Параллельная обработка обновлений с сохранением порядка для каждого пользователя.
+
+    У каждого пользователя своя очередь (у администратора тоже), обновления из одной очереди
+    обрабатываются строго по порядку, из разных - одновременно, но не больше
+    UPDATE_CONCURRENCY сразу. Ограничение базового класса (UPDATE_MAX_PENDING) учитывает и
+    ожидающие обновления, а место в общем лимите занимается только после своей очереди,
+    чтобы поток сообщений от одного пользователя не задерживал остальных.
+    """
+
+    def __init__(self, max_concurrent_updates, max_pending_updates):
+        super().__init__(max_pending_updates)
+        self.concurrency = max_concurrent_updates
+        self.running_slots = asyncio.Semaphore(max_concurrent_updates)
+        self.lanes = {}
+        self.running = 0
+
+    @staticmethod
+    def lane_key(update):
+        if isinstance(update, Update):
+            if update.effective_user:
+                return update.effective_user.id
+            if update.effective_chat:
+                return update.effective_chat.id
+        return None
+
+    async def do_process_update(self, update, coroutine):
+        if isinstance(update, Update):
+            # Каждое обновление обрабатывается в своей задаче, поэтому значения видны только его записям
+            correlation_id.set(str(update.update_id))
+            log_sampled.set(random.random() < LOG_SAMPLE_RATE)
+        key = self.lane_key(update)
+        lane = self.lanes.get(key)
+        if lane is None:
+            lane = self.lanes[key] = {"lock": asyncio.Lock(), "backlog": 0}
+        lane["backlog"] += 1
+        try:
+            async with lane["lock"]:
+                # Отметка берется уже в очереди пользователя: ответы базы приходят в любом порядке
+                # и не должны менять порядок его обновлений
+                if UPDATE_DEDUP and isinstance(update, Update) and not await update_claims.claim(update.update_id):
+                    coroutine.close()
+                    logger.info("Обновление %s уже обработано другим экземпляром бота", update.update_id)
+                    return
+                async with self.running_slots:
+                    if isinstance(update, Update) and update.message:
+                        UPDATE_LAG.observe(max(0.0, time.time() - update.message.date.timestamp()))
+                    self.running += 1
+                    try:
+                        await coroutine
+                    finally:
+                        self.running -= 1
+        finally:
+            lane["backlog"] -= 1
+            if lane["backlog"] == 0:
+                del self.lanes[key]
+
+    @property
+    def pending(self):
+        # Все принятые, но еще не завершенные обновления: очередь Application опустошается сразу,
+        # а ожидание идет здесь, в очередях пользователей
+        return sum(lane["backlog"] for lane in self.lanes.values())
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    def stats_text(self):
+        backlogs = [lane["backlog"] for lane in self.lanes.values()]
+        return (
+            f"⚙️ Обработка обновлений: выполняется {self.running} из {self.concurrency}, "
+            f"очередей пользователей: {len(backlogs)}, ожидают: {sum(backlogs) - self.running}, "
+            f"наибольшая очередь: {max(backlogs, default=0)}"
+        )
+
+update_processor = UserLaneUpdateProcessor(UPDATE_CONCURRENCY, UPDATE_MAX_PENDING)
+
+class MessageArchiver:
+    """Переносит сообщения старше RETENTION_DAYS дней в коллекцию messages_archive.
+
+    Перенос идет пакетами по RETENTION_BATCH_SIZE с паузой RETENTION_PAUSE между ними, а при
+    нагрузке (очередь обновлений или режим сводки) паузы удлиняются. Сначала пакет копируется
+    в архив, затем удаляется из основной коллекции, поэтому прерванный перенос можно безопасно
+    повторить, в том числе одновременно из нескольких экземпляров бота.
+    """
+
+    def __init__(self, retention_days, interval, batch_size, pause):
+        self.retention_days = retention_days
+        self.interval = interval
+        self.batch_size = batch_size
+        self.pause = pause
+        self.archived = 0
+
+    def _busy(self):
+        return digest.active or len(update_processor.lanes) > update_processor.concurrency
+
+    async def archive_once(self):
+        cutoff = datetime.now() - timedelta(days=self.retention_days)
+        moved = 0
+        while True:
+            batch = await messages_collection.find({"date": {"$lt": cutoff}}, sort=[("date", 1)], limit=self.batch_size)
+            if not batch:
+                break
+            try:
+                await messages_archive_collection.insert_many(batch, ordered=False)
+            except BulkWriteError as e:
+                # Дубликаты означают, что пакет уже копировался прошлой попыткой
+                if any(error.get("code") != 11000 for error in e.details.get("writeErrors", [])):
+                    raise
+            await messages_collection.delete_many({"_id": {"$in": [msg["_id"] for msg in batch]}})
+            message_pages.invalidate()
+            moved += len(batch)
+            self.archived += len(batch)
+            await asyncio.sleep(self.pause * (10 if self._busy() else 1))
+        return moved
+
+    async def run(self):
+        while True:
+            try:
+                moved = await self.archive_once()
+                if moved:
+                    logger.info("В архив перенесено сообщений: %s", moved)
+            except Exception as e:
+                logger.error("Ошибка при переносе сообщений в архив: %s", e)
+            await asyncio.sleep(self.interval)
+
+archiver = MessageArchiver(RETENTION_DAYS, RETENTION_INTERVAL, RETENTION_BATCH_SIZE, RETENTION_PAUSE)
+
+class BroadcastRunner:
+    """Рассылка сообщения всем известным пользователям.
+
+    Получатели читаются из users пакетами по BROADCAST_BATCH_SIZE в порядке user_id, без
+    заблокированных администратором и заблокировавших бота. Сообщения идут через общую очередь
+    отправки с самым низким приоритетом, не больше BROADCAST_CONCURRENCY одновременно. После
+    каждого пакета в broadcasts сохраняются последний user_id и счетчики, поэтому прерванная
+    рассылка продолжается с того же места (повторно сообщение может получить только последний
+    незавершенный пакет). Выполняющий рассылку экземпляр бота продлевает аренду BROADCAST_LEASE
+    секунд; рассылку с истекшей арендой подхватывает любой экземпляр.
+    """
+
+    def __init__(self, batch_size, concurrency, progress_interval, lease):
+        self.batch_size = batch_size
+        self.concurrency = concurrency
+        self.progress_interval = progress_interval
+        self.lease = lease
+        self.task = None
+
+    @property
+    def running(self):
+        return self.task is not None and not self.task.done()
+
+    @staticmethod
+    def recipients_filter(after_user_id=None):
+        recipients = {"user_id": {"$ne": ADMIN_USER_ID}, "blocked": {"$ne": True}, "bot_blocked": {"$ne": True}}
+        if after_user_id is not None:
+            recipients["user_id"]["$gt"] = after_user_id
+        return recipients
+
+    async def create(self, bot, content, status_message):
+        broadcast = {
+            "_id": ObjectId(),
+            "status": "running",
+            "content": content,
+            "status_message": {"chat_id": status_message.chat_id, "message_id": status_message.message_id},
+            "total": await users_collection.count_documents(self.recipients_filter()),
+            "last_user_id": None,
+            "sent": 0,
+            "bot_blocked": 0,
+            "failed": 0,
+            "created_at": datetime.now(),
+            "lease_until": datetime.now() + timedelta(seconds=self.lease)
+        }
+        # Уникальный индекс по выполняющимся рассылкам не даст запустить вторую
+        await broadcasts_collection.insert_one(broadcast)
+        self.task = asyncio.create_task(self.run(bot, broadcast))
+        return broadcast
+
+    async def cancel(self):
+        result = await broadcasts_collection.update_one(
+            {"status": "running"}, {"$set": {"status": "cancelled", "finished_at": datetime.now()}}
+        )
+        return result.modified_count > 0
+
+    async def claim(self):
+        # Рассылка, чей экземпляр бота остановился, не продлив аренду
+        now = datetime.now()
+        return await broadcasts_collection.find_one_and_update(
+            {"status": "running", "lease_until": {"$lt": now}},
+            {"$set": {"lease_until": now + timedelta(seconds=self.lease)}},
+            return_document=ReturnDocument.AFTER
+        )
+
+    async def watch(self, bot):
+        while True:
+            if not self.running:
+                try:
+                    broadcast = await self.claim()
+                    if broadcast:
+                        logger.info("Продолжение рассылки %s с пользователя %s", broadcast["_id"], broadcast["last_user_id"])
+                        self.task = asyncio.create_task(self.run(bot, broadcast))
+                except Exception as e:
+                    logger.error("Ошибка при проверке незавершенных рассылок: %s", e)
+            await asyncio.sleep(self.lease / 2)
+
+    async def _deliver(self, bot, content, user_id, slots):
+        async with slots:
+            try:
+                if "text" in content:
+                    await outbound.send(PRIORITY_BULK, bot.send_message, chat_id=user_id, text=content["text"])
+                else:
+                    await outbound.send(
+                        PRIORITY_BULK, bot.copy_message,
+                        chat_id=user_id, from_chat_id=content["from_chat_id"], message_id=content["message_id"]
+                    )
+                return "sent"
+            except Forbidden:
+                return "bot_blocked"
+            except Exception as e:
+                logger.warning("Не удалось отправить рассылку пользователю %s: %s", user_id, e)
+                return "failed"
+
+    def progress_text(self, broadcast):
+        status = {"running": "⏳ идет", "done": "✅ завершена", "cancelled": "⛔️ остановлена"}[broadcast["status"]]
+        processed = broadcast["sent"] + broadcast["bot_blocked"] + broadcast["failed"]
+        return (
+            f"📣 Рассылка: {status}\n\n"
+            f"Обработано: {processed} из {broadcast['total']}\n"
+            f"✅ Доставлено: {broadcast['sent']}\n"
+            f"🚫 Бот заблокирован пользователем: {broadcast['bot_blocked']}\n"
+            f"❌ Ошибок: {broadcast['failed']}"
+        )
+
+    async def show_progress(self, bot, broadcast):
+        try:
+            await outbound.send(
+                PRIORITY_NORMAL, bot.edit_message_text,
+                chat_id=broadcast["status_message"]["chat_id"],
+                message_id=broadcast["status_message"]["message_id"],
+                text=self.progress_text(broadcast)
             )
-        elif message.audio:
-            await context.bot.send_audio(
-                chat_id=user_id,
-                audio=message.audio.file_id,
-                caption=message.caption or "Ответ от администратора"
+        except Exception as e:
+            logger.warning("Не удалось обновить состояние рассылки: %s", e)
+
+    async def run(self, bot, broadcast):
+        slots = asyncio.Semaphore(self.concurrency)
+        loop = asyncio.get_running_loop()
+        shown_at = loop.time()
+        while True:
+            recipients = await users_collection.find(
+                self.recipients_filter(broadcast["last_user_id"]), {"user_id": 1, "_id": 0},
+                sort=[("user_id", ASCENDING)], limit=self.batch_size
             )
-        elif message.sticker:
-            await context.bot.send_sticker(
-                chat_id=user_id,
-                sticker=message.sticker.file_id
+            if not recipients:
+                broadcast["status"] = "done"
+                break
+            results = await asyncio.gather(*(
+                self._deliver(bot, broadcast["content"], recipient["user_id"], slots) for recipient in recipients
+            ))
+            for result in ("sent", "bot_blocked", "failed"):
+                broadcast[result] += results.count(result)
+            bot_blocked = [recipient["user_id"] for recipient, result in zip(recipients, results) if result == "bot_blocked"]
+            if bot_blocked:
+                # Следующие рассылки не тратят на них лимит, пока пользователь снова не напишет боту
+                await users_collection.update_many({"user_id": {"$in": bot_blocked}}, {"$set": {"bot_blocked": True}})
+            broadcast["last_user_id"] = recipients[-1]["user_id"]
+            checkpoint = await broadcasts_collection.update_one({"_id": broadcast["_id"], "status": "running"}, {"$set": {
+                "last_user_id": broadcast["last_user_id"],
+                "sent": broadcast["sent"],
+                "bot_blocked": broadcast["bot_blocked"],
+                "failed": broadcast["failed"],
+                "lease_until": datetime.now() + timedelta(seconds=self.lease)
+            }})
+            if not checkpoint.matched_count:
+                broadcast["status"] = "cancelled"
+                break
+            if loop.time() - shown_at >= self.progress_interval:
+                shown_at = loop.time()
+                await self.show_progress(bot, broadcast)
+        if broadcast["status"] == "done":
+            await broadcasts_collection.update_one(
+                {"_id": broadcast["_id"]}, {"$set": {"status": "done", "finished_at": datetime.now()}}
             )
+        await self.show_progress(bot, broadcast)
+        logger.info(
+            "Рассылка %s завершена (%s): доставлено %s, бот заблокирован %s, ошибок %s",
+            broadcast["_id"], broadcast["status"], broadcast["sent"], broadcast["bot_blocked"], broadcast["failed"]
+        )
+
+    async def stop(self):
+        if not self.running:
+            return
+        self.task.cancel()
+        await asyncio.gather(self.task, return_exceptions=True)
+        # Сохраненная позиция остается, а аренда снимается, чтобы рассылка сразу продолжилась при запуске
+        try:
+            await broadcasts_collection.update_one({"status": "running"}, {"$set": {"lease_until": datetime.now()}})
+        except Exception as e:
+            logger.error("Ошибка при сохранении состояния рассылки: %s", e)
+
+broadcaster = BroadcastRunner(BROADCAST_BATCH_SIZE, BROADCAST_CONCURRENCY, BROADCAST_PROGRESS_INTERVAL, BROADCAST_LEASE)
+
+async def retry_on_startup(step, description):
+    delay = 1
+    while True:
+        try:
+            return await step()
+        except Exception as e:
+            logger.error("Ошибка при запуске (%s), повтор через %s с: %s", description, delay, e)
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, DB_INIT_RETRY_MAX)
+
+async def init_database() -> None:
+    # Запуск не ждет базу: до первого успешного подключения действует локальная копия блокировок.
+    # Список блокировок загружается отдельно от схемы, чтобы ошибка миграции или индекса не
+    # оставила бота на старой копии
+    await retry_on_startup(blocklist.load, "загрузка списка блокировок")
+    background_tasks.append(asyncio.create_task(blocklist.refresh_periodically()))
+    await retry_on_startup(ensure_schema, "обновление схемы базы данных")
+
+async def post_init(application: Application) -> None:
+    await spool.open()
+    await blocklist.load_snapshot()
+    message_buffer.start()
+    background_tasks.append(asyncio.create_task(init_database()))
+    background_tasks.append(asyncio.create_task(spool.run(messages_collection)))
+    if recent_content.enabled:
+        background_tasks.append(asyncio.create_task(recent_content.run()))
+    background_tasks.append(asyncio.create_task(digest.run(application.bot)))
+    if RETENTION_DAYS > 0:
+        background_tasks.append(asyncio.create_task(archiver.run()))
+    background_tasks.append(asyncio.create_task(broadcaster.watch(application.bot)))
+
+async def post_stop(application: Application) -> None:
+    await broadcaster.stop()
+    await message_buffer.close()
+    try:
+        await recent_content.flush()
+    except Exception as e:
+        logger.error("Ошибка при записи счетчиков повторов: %s", e)
+    await outbound.close(MESSAGE_SHUTDOWN_TIMEOUT)
+    for task in background_tasks:
+        task.cancel()
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+
+async def post_shutdown(application: Application) -> None:
+    mongo_executor.shutdown(wait=True)
+    spool.close()
+    client.close()
+    logger.info("Соединение с базой данных закрыто")
+
+async def get_stats(update: Update, context: CallbackContext) -> None:
+    user = update.effective_user
+    if user.id != ADMIN_USER_ID:
+        await update.message.reply_text("У вас нет доступа к этой команде.")
+        logger.warning("Пользователь %s пытался получить доступ к административной команде /stats", user.id)
+        return
+    
+    response = "📊 Состояние бота:\n\n"
+    response += update_processor.stats_text() + "\n"
+    response += outbound.stats_text() + "\n"
+    response += f"💾 Ожидают записи в базу: {len(message_buffer)} сообщений, в локальном журнале: {len(spool)}\n"
+    response += f"📥 Входящих за минуту: {digest.rate()}, режим сводки: {'включен' if digest.active else 'выключен'}\n"
+    response += flood_guard.stats_text() + "\n"
+    response += message_pages.stats_text()
+    await update.message.reply_text(response)
+    logger.info("Запрос статистики выполнен")
+
+class DryRunRequest(BaseRequest):
+    """Заглушка Bot API для локальной проверки без Telegram.
+
+    Запросы не уходят в сеть, а записываются в журнал; в ответ возвращается правдоподобный
+    результат, чтобы обработчики отработали до конца.
+    """
+
+    def __init__(self):
+        self.counter = itertools.count(1)
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None,
+                         write_timeout=None, connect_timeout=None, pool_timeout=None):
+        api_method = url.rsplit("/", 1)[-1]
+        parameters = request_data.parameters if request_data else {}
+        logger.info("[dry-run] %s: %s", api_method, parameters)
+        
+        if api_method == "getMe":
+            bot_id = int(TELEGRAM_TOKEN.split(":")[0]) if TELEGRAM_TOKEN and TELEGRAM_TOKEN.split(":")[0].isdigit() else 1
+            result = {"id": bot_id, "is_bot": True, "first_name": "Dry Run", "username": "dry_run_bot"}
+        elif api_method == "copyMessage":
+            result = {"message_id": next(self.counter)}
+        elif api_method.startswith("send") or api_method.startswith("edit"):
+            message = {
+                "message_id": next(self.counter),
+                "date": int(time.time()),
+                "chat": {"id": parameters.get("chat_id", ADMIN_USER_ID), "type": "private"},
+                "text": parameters.get("text", "")
+            }
+            result = [message] if api_method == "sendMediaGroup" else message
         else:
-            await context.bot.send_message(
-                chat_id=user_id,
-                text=f"Ответ от администратора: {message.text}"
+            result = True
+        return 200, json.dumps({"ok": True, "result": result}).encode()
+
+class InstrumentedRequest(BaseRequest):
+    """Обертка над транспортом Bot API, которая записывает время и ошибки каждого метода."""
+
+    def __init__(self, request):
+        self.request = request
+
+    async def initialize(self) -> None:
+        await self.request.initialize()
+
+    async def shutdown(self) -> None:
+        await self.request.shutdown()
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None,
+                         write_timeout=None, connect_timeout=None, pool_timeout=None):
+        api_method = url.rsplit("/", 1)[-1]
+        started = time.perf_counter()
+        try:
+            code, payload = await self.request.do_request(
+                url, method, request_data, read_timeout, write_timeout, connect_timeout, pool_timeout
             )
+        except Exception as e:
+            BOT_API_ERRORS.labels(api_method, type(e).__name__).inc()
+            raise
+        finally:
+            BOT_API_LATENCY.labels(api_method).observe(time.perf_counter() - started)
+        if code >= 400:
+            BOT_API_ERRORS.labels(api_method, str(code)).inc()
+        return code, payload
+
+def instrument_handler(callback):
+    name = callback.__name__
+    
+    @functools.wraps(callback)
+    async def wrapper(update, context):
+        started = time.perf_counter()
+        try:
+            return await callback(update, context)
+        except Exception:
+            HANDLER_ERRORS.labels(name).inc()
+            raise
+        finally:
+            HANDLER_LATENCY.labels(name).observe(time.perf_counter() - started)
+    return wrapper
+
+def start_metrics_server() -> None:
+    if not METRICS_PORT:
+        return
+    UPDATES_RUNNING.set_function(lambda: update_processor.running)
+    UPDATES_PENDING.set_function(
+        lambda: sum(lane["backlog"] for lane in update_processor.lanes.values()) - update_processor.running
+    )
+    OUTBOUND_DEPTH.set_function(lambda: outbound.depth)
+    BUFFER_DEPTH.set_function(lambda: len(message_buffer))
+    start_http_server(METRICS_PORT, addr=METRICS_LISTEN)
+    logger.info("Метрики доступны на http://%s:%s/metrics", METRICS_LISTEN, METRICS_PORT)
+
+def create_webhook_app(application: Application) -> web.Application:
+    async def receive_update(request: web.Request) -> web.Response:
+        if WEBHOOK_SECRET_TOKEN and request.headers.get("X-Telegram-Bot-Api-Secret-Token") != WEBHOOK_SECRET_TOKEN:
+            logger.warning("Отклонен запрос к вебхуку с неверным секретным токеном от %s", request.remote)
+            return web.Response(status=403)
         
-        del context.user_data["reply_to"]
-        await update.message.reply_text(f"Сообщение отправлено пользователю (ID: {user_id}).")
-        logger.info(f"Ответ отправлен пользователю с ID {user_id}")
-    except Exception as e:
-        await update.message.reply_text(f"Ошибка при отправке сообщения: {str(e)}")
-        logger.error(f"Ошибка при отправке ответа пользователю {user_id}: {str(e)}")
+        # Если обработка не успевает, Telegram получит 503 и повторит доставку позже
+        pending = application.update_queue.qsize() + update_processor.pending
+        if pending >= WEBHOOK_MAX_PENDING:
+            logger.warning("Очередь обновлений заполнена (%s), обновление отклонено", pending)
+            return web.Response(status=503)
+        
+        try:
+            update = Update.de_json(await request.json(), application.bot)
+        except Exception as e:
+            logger.error("Некорректное обновление в запросе к вебхуку: %s", e)
+            return web.Response(status=400)
+        
+        await application.update_queue.put(update)
+        return web.Response()
+    
+    async def health(request: web.Request) -> web.Response:
+        return web.json_response({
+            "status": "ok" if application.running else "stopped",
+            "pending_updates": application.update_queue.qsize() + update_processor.pending,
+            "outbound_queue": outbound.depth,
+            "write_buffer": len(message_buffer)
+        }, status=200 if application.running else 503)
+    
+    webhook_app = web.Application()
+    webhook_app.router.add_post(WEBHOOK_PATH, receive_update)
+    webhook_app.router.add_get("/health", health)
+    return webhook_app
 
-def main() -> None:
-    application = Application.builder().token(TELEGRAM_TOKEN).build()
+async def run_webhook(application: Application) -> None:
+    # Повторяет жизненный цикл run_polling, но обновления принимает собственный HTTP-сервер
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop_event.set)
+    
+    async with application:
+        await post_init(application)
+        await application.start()
+        
+        runner = web.AppRunner(create_webhook_app(application))
+        await runner.setup()
+        await web.TCPSite(runner, WEBHOOK_LISTEN, WEBHOOK_PORT).start()
+        logger.info("Вебхук слушает %s:%s%s", WEBHOOK_LISTEN, WEBHOOK_PORT, WEBHOOK_PATH)
+        
+        # Без WEBHOOK_URL вебхук не регистрируется: так сервер можно проверить локально, отправляя обновления вручную
+        if WEBHOOK_URL:
+            await application.bot.set_webhook(
+                url=WEBHOOK_URL,
+                secret_token=WEBHOOK_SECRET_TOKEN or None,
+                max_connections=WEBHOOK_MAX_CONNECTIONS,
+                allowed_updates=Update.ALL_TYPES
+            )
+            logger.info("Вебхук зарегистрирован: %s", WEBHOOK_URL)
+        
+        try:
+            await stop_event.wait()
+        finally:
+            await runner.cleanup()
+            await application.stop()
+            await post_stop(application)
+    await post_shutdown(application)
+
+def build_application(request: BaseRequest = None) -> Application:
+    # request подменяет транспорт Bot API, например, в нагрузочном тесте benchmarks/load_test.py
+    builder = (
+        Application.builder()
+        .token(TELEGRAM_TOKEN)
+        .post_init(post_init)
+        .post_stop(post_stop)
+        .post_shutdown(post_shutdown)
+        .concurrent_updates(update_processor)
+    )
+    if request is None and TELEGRAM_DRY_RUN:
+        request = DryRunRequest()
+    if request is not None:
+        builder = builder.request(InstrumentedRequest(request)).get_updates_request(DryRunRequest())
+    else:
+        # Тот же размер пула соединений, что ApplicationBuilder задает по умолчанию
+        builder = builder.request(InstrumentedRequest(HTTPXRequest(connection_pool_size=256)))
+    if BOT_MODE == 'webhook':
+        builder = builder.updater(None)
+    application = builder.build()
     
     # Command handlers
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CommandHandler("messages", get_messages))
+    application.add_handler(CommandHandler("inbox", get_inbox))
     application.add_handler(CommandHandler("block", block_user))
     application.add_handler(CommandHandler("unblock", unblock_user))
     application.add_handler(CommandHandler("blocked", get_blocked_users))
     application.add_handler(CommandHandler("cancel", cancel))
+    application.add_handler(CommandHandler("stats", get_stats))
+    application.add_handler(CommandHandler("search", search_messages))
+    application.add_handler(CommandHandler("export", export_messages))
+    application.add_handler(CommandHandler("broadcast", broadcast_message))
     
     # Callback query handler
     application.add_handler(CallbackQueryHandler(button_callback))
@@ -676,10 +3518,29 @@ def main() -> None:
         handle_message
     ))
     
+    # Метрики времени выполнения получают все зарегистрированные выше обработчики, в том числе новые
+    for handlers in application.handlers.values():
+        for handler in handlers:
+            handler.callback = instrument_handler(handler.callback)
+    
+    return application
+
+def main() -> None:
+    # Без секретного токена любой, кто знает адрес вебхука, сможет присылать боту поддельные обновления
+    if BOT_MODE == 'webhook' and WEBHOOK_URL and not WEBHOOK_SECRET_TOKEN:
+        logger.critical("Для регистрации вебхука (WEBHOOK_URL) требуется WEBHOOK_SECRET_TOKEN")
+        raise SystemExit(1)
+    
+    application = build_application()
+    start_metrics_server()
+    
     logger.info("Бот запущен и готов к работе")
     print(f"Бот запущен. ADMIN_USER_ID установлен на {ADMIN_USER_ID}")
     
-    application.run_polling()
+    if BOT_MODE == 'webhook':
+        asyncio.run(run_webhook(application))
+    else:
+        application.run_polling()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,81 @@
+import os
+import sys
+import threading
+import time
+
+import pytest
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("ADMIN_USER_ID", "1")
+os.environ.setdefault("TELEGRAM_BOT_TOKEN", "123456:test")
+os.environ.setdefault("MONGODB_URI", "mongodb://localhost:27017/")
+os.environ.setdefault("MONGODB_DB", "telegram_bot_test")
+os.environ["METRICS_PORT"] = "0"
+os.environ["LOG_LEVEL"] = "WARNING"
+
+import main  # noqa: E402
+
+class FakeCollection:
+    """Коллекция pymongo в памяти с настраиваемой задержкой и отказами.
+
+    Методы синхронные, как у pymongo, и вызываются из пула потоков AsyncCollection, поэтому
+    задержка time.sleep ведет себя как медленный ответ MongoDB.
+    """
+
+    def __init__(self, delay=0.0, name="fake"):
+        self.name = name
+        self.delay = delay
+        self.documents = {}
+        self.calls = []
+        self.fail = None
+        self.lock = threading.Lock()
+
+    def _call(self, method):
+        self.calls.append(method)
+        delay = self.delay() if callable(self.delay) else self.delay
+        if delay:
+            time.sleep(delay)
+        if self.fail:
+            raise self.fail
+
+    @staticmethod
+    def _matches(document, filter):
+        return all(document.get(key) == value for key, value in (filter or {}).items())
+
+    def insert_one(self, document):
+        self._call("insert_one")
+        with self.lock:
+            if document["_id"] in self.documents:
+                raise DuplicateKeyError("E11000 duplicate key error")
+            self.documents[document["_id"]] = dict(document)
+
+    def insert_many(self, documents, ordered=True):
+        self._call("insert_many")
+        with self.lock:
+            for inserted, document in enumerate(documents):
+                if document["_id"] in self.documents:
+                    raise BulkWriteError({
+                        "nInserted": inserted,
+                        "writeErrors": [{"index": inserted, "code": 11000, "errmsg": "E11000 duplicate key error"}]
+                    })
+                self.documents[document["_id"]] = dict(document)
+
+    def find_one(self, filter=None, *args, **kwargs):
+        self._call("find_one")
+        return next((dict(doc) for doc in self.documents.values() if self._matches(doc, filter)), None)
+
+    def update_one(self, filter, update, upsert=False):
+        self._call("update_one")
+
+    def bulk_write(self, operations, ordered=True):
+        self._call("bulk_write")
+
+@pytest.fixture
+def fake_collection(monkeypatch):
+    # Подменяет коллекцию pymongo внутри AsyncCollection на время теста
+    def replace(async_collection, delay=0.0):
+        fake = FakeCollection(delay, async_collection.collection.name)
+        monkeypatch.setattr(async_collection, "collection", fake)
+        return fake
+    return replace
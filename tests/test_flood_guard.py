@@ -0,0 +1,81 @@
+import pytest
+
+import main
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(main.time, "monotonic", clock)
+    return clock
+
+def drain(guard, user_id):
+    # Расходует все токены пользователя
+    while guard.buckets.get(user_id, {"tokens": 1})["tokens"] >= 1:
+        assert guard.check(user_id) == main.FLOOD_ADMIT
+
+def test_least_recent_user_is_evicted(clock):
+    guard = main.FloodGuard(rate=0.1, burst=2, strikes=5, mute_seconds=60, max_users=2)
+    drain(guard, 1)
+    guard.check(2)
+    guard.check(1)
+    assert guard.check(1) == main.FLOOD_DROP
+    # Пользователь 1 обращался недавно, поэтому вытесняется пользователь 2
+    guard.check(3)
+    assert list(guard.buckets) == [1, 3]
+    guard.check(4)
+    assert list(guard.buckets) == [3, 4]
+
+def test_evicted_user_returns_with_full_bucket(clock):
+    guard = main.FloodGuard(rate=0.1, burst=3, strikes=5, mute_seconds=60, max_users=2)
+    drain(guard, 1)
+    assert guard.check(1) == main.FLOOD_DROP
+    guard.check(2)
+    guard.check(3)
+    assert 1 not in guard.buckets
+    assert [guard.check(1) for _ in range(4)] == [main.FLOOD_ADMIT] * 3 + [main.FLOOD_DROP]
+
+def test_mute_after_consecutive_drops(clock):
+    guard = main.FloodGuard(rate=0.1, burst=1, strikes=3, mute_seconds=60, max_users=10)
+    results = [guard.check(1) for _ in range(4)]
+    assert results == [main.FLOOD_ADMIT, main.FLOOD_DROP, main.FLOOD_DROP, main.FLOOD_MUTE]
+    # Заглушенный пользователь не получает повторного уведомления
+    clock.now += 30
+    assert guard.check(1) == main.FLOOD_DROP
+    assert guard.dropped == 4
+
+def test_admitted_message_resets_strikes(clock):
+    guard = main.FloodGuard(rate=1, burst=1, strikes=3, mute_seconds=60, max_users=10)
+    guard.check(1)
+    guard.check(1)
+    guard.check(1)
+    clock.now += 1
+    assert guard.check(1) == main.FLOOD_ADMIT
+    assert [guard.check(1) for _ in range(2)] == [main.FLOOD_DROP, main.FLOOD_DROP]
+    assert 1 not in guard.muted
+
+def test_mute_expires(clock):
+    guard = main.FloodGuard(rate=0.1, burst=1, strikes=1, mute_seconds=60, max_users=10)
+    guard.check(1)
+    assert guard.check(1) == main.FLOOD_MUTE
+    clock.now += 59
+    assert guard.check(1) == main.FLOOD_DROP
+    clock.now += 2
+    assert guard.check(1) == main.FLOOD_ADMIT
+    assert 1 not in guard.muted
+
+def test_expired_mutes_are_pruned(clock):
+    guard = main.FloodGuard(rate=0.1, burst=1, strikes=1, mute_seconds=60, max_users=2)
+    for user_id in (1, 2):
+        guard.check(user_id)
+        assert guard.check(user_id) == main.FLOOD_MUTE
+    clock.now += 61
+    guard.check(3)
+    assert guard.check(3) == main.FLOOD_MUTE
+    assert guard.muted == {3: clock.now + 60}
@@ -0,0 +1,140 @@
+import asyncio
+import time
+from types import SimpleNamespace
+
+from telegram import Chat, Message, Update, User
+
+import main
+
+class SlowBot:
+    """Bot API, отвечающий с задержкой; запоминает отправленные сообщения."""
+
+    def __init__(self, delay):
+        self.delay = delay
+        self.sent = []
+        self.edited = []
+
+    async def send_message(self, chat_id, text, reply_markup=None, **kwargs):
+        await asyncio.sleep(self.delay)
+        self.sent.append((chat_id, text))
+        return SimpleNamespace(message_id=len(self.sent), chat_id=chat_id)
+
+    async def edit_message_text(self, chat_id, message_id, text, reply_markup=None):
+        await asyncio.sleep(self.delay)
+        self.edited.append((message_id, text))
+
+def make_update(update_id, user_id, text):
+    user = User(user_id, "Имя", False, username=f"user{user_id}")
+    message = Message(update_id, main.datetime.now(), Chat(user_id, "private"), from_user=user, text=text)
+    return Update(update_id, message=message)
+
+def test_handler_does_not_wait_for_admin_chat(monkeypatch):
+    # Пересылки и подтверждения ставятся в очередь, обработчик не ждет лимита чата администратора
+    monkeypatch.setattr(main, "message_buffer", main.MessageWriteBuffer(None, 100, 1, 1000))
+    monkeypatch.setattr(main, "recent_content", main.RecentContentIndex(600, 100, 5))
+    bot = SlowBot(0.2)
+    context = SimpleNamespace(bot=bot)
+
+    async def run():
+        started = time.monotonic()
+        for user_id in range(10, 15):
+            await main.handle_message(make_update(user_id, user_id, f"вопрос {user_id}"), context)
+        handled = time.monotonic() - started
+        while len(bot.sent) < 10:
+            await asyncio.sleep(0.05)
+        await asyncio.sleep(0)
+        return handled
+
+    handled = asyncio.run(run())
+    assert handled < 0.1
+    forwards = [chat_id for chat_id, _ in bot.sent if chat_id == main.ADMIN_USER_ID]
+    assert len(forwards) == 5
+    # Номер пересланного сообщения записывается после отправки, чтобы показывать счетчик повторов
+    entries = [entry for (user_id, _), entry in main.recent_content.entries.items() if user_id == 10]
+    assert entries and entries[0]["forward"] is not None
+
+def test_repeats_are_shown_without_waiting(monkeypatch):
+    # Повторы приходят раньше, чем пересылка оригинала отправлена: счетчик появляется после нее
+    monkeypatch.setattr(main, "message_buffer", main.MessageWriteBuffer(None, 100, 1, 1000))
+    monkeypatch.setattr(main, "recent_content", main.RecentContentIndex(600, 100, 5))
+    bot = SlowBot(0.2)
+    context = SimpleNamespace(bot=bot)
+
+    async def run():
+        started = time.monotonic()
+        for update_id in range(3):
+            await main.handle_message(make_update(100 + update_id, 20, "тот же вопрос"), context)
+        handled = time.monotonic() - started
+        while not bot.edited:
+            await asyncio.sleep(0.05)
+        return handled
+
+    handled = asyncio.run(run())
+    assert handled < 0.1
+    assert bot.edited[-1][1].endswith("🔁 Повторено ×3")
+
+def test_repeat_after_admin_reply_is_forwarded(monkeypatch):
+    # После ответа администратора тот же короткий ответ пользователя - новое сообщение, а не повтор
+    buffer = main.MessageWriteBuffer(None, 100, 1, 1000)
+    monkeypatch.setattr(main, "message_buffer", buffer)
+    monkeypatch.setattr(main, "recent_content", main.RecentContentIndex(600, 100, 5))
+    # Свой диспетчер без лимита чата: пересылки предыдущих тестов не задерживают этот
+    monkeypatch.setattr(main, "outbound", main.OutboundDispatcher(100, 100, 100, 1, 100))
+
+    async def consume(admin_id):
+        return 30
+
+    monkeypatch.setattr(main.reply_state, "get", consume)
+    monkeypatch.setattr(main.reply_state, "consume", consume)
+    bot = SlowBot(0)
+    context = SimpleNamespace(bot=bot)
+    admin = User(main.ADMIN_USER_ID, "Админ", False)
+    answer = Message(200, main.datetime.now(), Chat(main.ADMIN_USER_ID, "private"), from_user=admin, text="готово")
+    answer.set_bot(bot)
+
+    async def run():
+        await main.handle_message(make_update(300, 30, "да"), context)
+        await main.admin_reply(Update(301, message=answer), context)
+        await main.handle_message(make_update(302, 30, "да"), context)
+        await asyncio.sleep(0.05)
+
+    asyncio.run(run())
+    forwards = [text for chat_id, text in bot.sent if chat_id == main.ADMIN_USER_ID and text.endswith("Сообщение: да")]
+    assert len(forwards) == 2
+    # Оба сообщения пользователя и ответ администратора ждут записи в базу
+    assert len(buffer) == 3
+
+def test_view_message_overtakes_queued_forwards(fake_collection, monkeypatch):
+    # Просмотр сообщения не ждет пересылок в чат администратора, а детали не обгоняют копию
+    monkeypatch.setattr(main, "outbound", main.OutboundDispatcher(100, 20, 1, 1, 100))
+    stored = {
+        "_id": main.ObjectId(), "user_id": 40, "chat_id": 40, "message_id": 7, "username": "user40",
+        "date": main.datetime.now(), "content_type": "sticker", "file_id": "sticker"
+    }
+    fake_collection(main.messages_collection).documents[stored["_id"]] = stored
+    calls = []
+
+    class Bot:
+        async def send_message(self, chat_id, text, reply_markup=None):
+            calls.append(text.split("\n")[0])
+
+        async def copy_message(self, chat_id, from_chat_id, message_id, reply_markup=None):
+            calls.append("copy")
+
+    bot = Bot()
+    admin_chat = SimpleNamespace(chat_id=main.ADMIN_USER_ID)
+    update = SimpleNamespace(callback_query=SimpleNamespace(message=admin_chat))
+
+    async def run():
+        forwards = [
+            main.outbound.submit(main.PRIORITY_HIGH, bot.send_message, chat_id=main.ADMIN_USER_ID, text=f"пересылка {n}")
+            for n in range(5)
+        ]
+        await main.view_message(update, SimpleNamespace(bot=bot), str(stored["_id"]))
+        await asyncio.gather(*forwards)
+
+    asyncio.run(run())
+    # Впереди могут оказаться только пересылки, уже взятые из очереди чата до просмотра
+    detail = calls.index("📝 Детали сообщения:")
+    assert detail <= 2 and calls[detail + 1] == "copy"
+    assert [call for call in calls if call.startswith("пересылка")] == [f"пересылка {n}" for n in range(5)]
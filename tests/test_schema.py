@@ -0,0 +1,70 @@
+import asyncio
+
+import pytest
+
+import main
+
+# Как и нагрузочный тест, работает с mongomock, если он установлен
+mongomock = pytest.importorskip("mongomock")
+
+@pytest.fixture
+def mock_db(monkeypatch):
+    # Коллекции mongomock вместо MongoDB: индексы и агрегации работают как в базе
+    database = mongomock.MongoClient().db
+
+    def replace(async_collection):
+        collection = database[async_collection.collection.name]
+        monkeypatch.setattr(async_collection, "collection", collection)
+        return collection
+    return replace
+
+def test_users_are_deduplicated_before_unique_index(mock_db):
+    users = mock_db(main.users_collection)
+    users.insert_many([
+        {"user_id": 1, "message_count": 2, "unread": 1},
+        {"user_id": 1, "message_count": 3, "unread": 2, "blocked": True},
+        {"user_id": 2, "message_count": 1},
+    ])
+    asyncio.run(main.ensure_users_index())
+    assert "user_id_unique" in users.index_information()
+    merged = users.find_one({"user_id": 1})
+    assert users.count_documents({"user_id": 1}) == 1
+    assert (merged["message_count"], merged["unread"], merged["blocked"]) == (5, 3, True)
+
+def test_users_index_exists_during_migrations(mock_db, monkeypatch):
+    users = mock_db(main.users_collection)
+    mock_db(main.meta_collection)
+    indexes = []
+
+    async def migration():
+        indexes.extend(users.index_information())
+
+    monkeypatch.setattr(main, "MIGRATIONS", [(1, "проверка", migration)])
+    monkeypatch.setattr(main, "INDEXES", [])
+    asyncio.run(main.ensure_schema())
+    assert "user_id_unique" in indexes
+
+def test_blocklist_loads_when_schema_fails(mock_db, monkeypatch):
+    # Ошибка миграции или индекса не оставляет бота на локальной копии списка блокировок
+    mock_db(main.meta_collection)
+    mock_db(main.blocked_users_collection).insert_one({"user_id": 7})
+    monkeypatch.setattr(main, "blocklist", main.BlocklistCache())
+    monkeypatch.setattr(main, "background_tasks", [])
+
+    async def failing_schema():
+        raise main.DuplicateKeyError("E11000 duplicate key error")
+
+    monkeypatch.setattr(main, "ensure_schema", failing_schema)
+
+    async def run():
+        task = asyncio.create_task(main.init_database())
+        await asyncio.sleep(0.1)
+        started = len(main.background_tasks)
+        for pending in [task, *main.background_tasks]:
+            pending.cancel()
+        await asyncio.gather(task, *main.background_tasks, return_exceptions=True)
+        return started
+
+    started = asyncio.run(run())
+    assert 7 in main.blocklist
+    assert started == 1
@@ -0,0 +1,46 @@
+import asyncio
+import time
+from types import SimpleNamespace
+
+from telegram import Chat, Message, Update, User
+
+import main
+
+DELAY = 0.3
+
+class FakeBot:
+    async def send_message(self, chat_id, text, **kwargs):
+        return SimpleNamespace(message_id=1, chat_id=chat_id)
+
+def make_start(update_id, user_id, bot):
+    user = User(user_id, "Имя", False, username=f"user{user_id}")
+    message = Message(update_id, main.datetime.now(), Chat(user_id, "private"), from_user=user, text="/start")
+    message.set_bot(bot)
+    return Update(update_id, message=message)
+
+def run_starts(updates, bot):
+    # Обновления проходят через тот же обработчик очередей пользователей, что и в боте
+    processor = main.UserLaneUpdateProcessor(main.UPDATE_CONCURRENCY, main.UPDATE_MAX_PENDING)
+    context = SimpleNamespace(bot=bot)
+
+    async def run():
+        started = time.monotonic()
+        await asyncio.gather(*(
+            processor.process_update(update, main.start(update, context)) for update in updates
+        ))
+        return time.monotonic() - started
+    return asyncio.run(run())
+
+def test_slow_database_does_not_serialise_users(fake_collection):
+    # Каждый /start ждет медленную запись в users, но обновления разных пользователей идут одновременно
+    users = fake_collection(main.users_collection, delay=DELAY)
+    bot = FakeBot()
+    elapsed = run_starts([make_start(update_id, 100 + update_id, bot) for update_id in range(8)], bot)
+    assert users.calls.count("update_one") == 8
+    assert elapsed < 3 * DELAY
+
+def test_slow_database_keeps_one_user_in_order(fake_collection):
+    fake_collection(main.users_collection, delay=DELAY)
+    bot = FakeBot()
+    elapsed = run_starts([make_start(update_id, 100, bot) for update_id in range(3)], bot)
+    assert elapsed >= 3 * DELAY
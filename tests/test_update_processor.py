@@ -0,0 +1,55 @@
+import asyncio
+import random
+import time
+
+from telegram import Chat, Message, Update, User
+
+import main
+
+def make_update(update_id, user_id):
+    user = User(user_id, "Имя", False)
+    message = Message(update_id, main.datetime.now(), Chat(user_id, "private"), from_user=user, text=str(update_id))
+    return Update(update_id, message=message)
+
+async def process_all(processor, updates, handled):
+    async def handler(update):
+        handled.append((update.effective_user.id, update.update_id))
+
+    await asyncio.gather(*(processor.process_update(update, handler(update)) for update in updates))
+
+def test_claims_keep_per_user_order(monkeypatch, fake_collection):
+    # Отметки в базе завершаются в случайном порядке, но обновления пользователя идут по порядку
+    monkeypatch.setattr(main, "UPDATE_DEDUP", True)
+    fake_collection(main.processed_updates_collection, delay=lambda: random.uniform(0, 0.05))
+    processor = main.UserLaneUpdateProcessor(8, 100)
+    updates = [make_update(update_id, 10 + update_id % 2) for update_id in range(20)]
+    handled = []
+    asyncio.run(process_all(processor, updates, handled))
+    for user_id in (10, 11):
+        order = [update_id for handled_user, update_id in handled if handled_user == user_id]
+        assert order == sorted(order) and len(order) == 10
+
+def test_duplicate_update_is_skipped(monkeypatch, fake_collection):
+    monkeypatch.setattr(main, "UPDATE_DEDUP", True)
+    fake_collection(main.processed_updates_collection)
+    processor = main.UserLaneUpdateProcessor(4, 100)
+    handled = []
+    asyncio.run(process_all(processor, [make_update(1, 10)], handled))
+    asyncio.run(process_all(processor, [make_update(1, 10)], handled))
+    assert handled == [(10, 1)]
+
+def test_claims_are_skipped_while_database_is_down(monkeypatch, fake_collection):
+    # После первой ошибки обновления не ждут базу, пока не пройдет UPDATE_CLAIM_RETRY
+    fake = fake_collection(main.processed_updates_collection, delay=0.3)
+    fake.fail = ConnectionError("база недоступна")
+    claims = main.UpdateClaims(timeout=0.1, retry=30)
+
+    async def claim_many():
+        started = time.monotonic()
+        results = [await claims.claim(update_id) for update_id in range(20)]
+        return results, time.monotonic() - started
+
+    results, elapsed = asyncio.run(claim_many())
+    assert all(results)
+    assert elapsed < 0.5
+    assert claims.skipped == 19
@@ -0,0 +1,44 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+from aiohttp.test_utils import TestClient, TestServer
+
+import main
+from test_update_processor import make_update
+
+def test_busy_lanes_reject_webhook_updates(monkeypatch):
+    # Очередь Application пуста, но обновления ждут в очередях пользователей - Telegram получает 503
+    monkeypatch.setattr(main, "WEBHOOK_MAX_PENDING", 3)
+    monkeypatch.setattr(main, "WEBHOOK_SECRET_TOKEN", "")
+    processor = main.UserLaneUpdateProcessor(1, 100)
+    monkeypatch.setattr(main, "update_processor", processor)
+
+    async def run():
+        release = asyncio.Event()
+        tasks = [
+            asyncio.create_task(processor.process_update(make_update(update_id, 10), release.wait()))
+            for update_id in range(3)
+        ]
+        await asyncio.sleep(0.01)
+        application = SimpleNamespace(update_queue=asyncio.Queue(), bot=None, running=True)
+        async with TestClient(TestServer(main.create_webhook_app(application))) as client:
+            health = await (await client.get("/health")).json()
+            response = await client.post(main.WEBHOOK_PATH, json=make_update(3, 11).to_dict())
+            release.set()
+            await asyncio.gather(*tasks)
+            idle = await (await client.get("/health")).json()
+        return health, response.status, idle
+
+    health, status, idle = asyncio.run(run())
+    assert health["pending_updates"] == 3
+    assert status == 503
+    assert idle["pending_updates"] == 0
+
+def test_webhook_url_requires_secret_token(monkeypatch):
+    monkeypatch.setattr(main, "BOT_MODE", "webhook")
+    monkeypatch.setattr(main, "WEBHOOK_URL", "https://example.com/telegram")
+    monkeypatch.setattr(main, "WEBHOOK_SECRET_TOKEN", "")
+    monkeypatch.setattr(main, "build_application", lambda: None)
+    with pytest.raises(SystemExit):
+        main.main()
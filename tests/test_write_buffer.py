@@ -0,0 +1,108 @@
+import asyncio
+
+import pytest
+from bson import ObjectId
+
+import main
+from conftest import FakeCollection
+
+@pytest.fixture
+def messages(fake_collection):
+    # Сведения о пользователях после записи пакета уходят в отдельную коллекцию
+    fake_collection(main.users_collection)
+    fake = FakeCollection()
+    return fake, main.AsyncCollection(fake, main.mongo_executor)
+
+def documents(count):
+    return [{"user_id": 10, "text": str(number), "date": main.datetime.now()} for number in range(count)]
+
+def written_texts(fake):
+    return [document["text"] for document in fake.documents.values()]
+
+def test_flush_when_batch_is_full(messages):
+    fake, collection = messages
+    buffer = main.MessageWriteBuffer(collection, batch_size=3, flush_interval=1, limit=100)
+
+    async def run():
+        buffer.start()
+        for document in documents(3):
+            await buffer.add(document)
+        await asyncio.sleep(0.2)
+        written = written_texts(fake)
+        await buffer.close()
+        return written
+
+    assert asyncio.run(run()) == ["0", "1", "2"]
+
+def test_flush_after_interval(messages):
+    fake, collection = messages
+    buffer = main.MessageWriteBuffer(collection, batch_size=100, flush_interval=0.3, limit=100)
+
+    async def run():
+        buffer.start()
+        await buffer.add(documents(1)[0])
+        await asyncio.sleep(0.1)
+        before = written_texts(fake)
+        await asyncio.sleep(0.4)
+        after = written_texts(fake)
+        await buffer.close()
+        return before, after
+
+    assert asyncio.run(run()) == ([], ["0"])
+
+def test_add_waits_when_queue_is_full(messages):
+    fake, collection = messages
+    buffer = main.MessageWriteBuffer(collection, batch_size=10, flush_interval=0.05, limit=2)
+
+    async def run():
+        for document in documents(2):
+            await buffer.add(document)
+        third = asyncio.ensure_future(buffer.add({"user_id": 10, "text": "2", "date": main.datetime.now()}))
+        await asyncio.sleep(0.1)
+        waiting = not third.done()
+        # Запись освобождает очередь, и ожидающий add() завершается
+        buffer.start()
+        await asyncio.wait_for(third, 1)
+        await buffer.close()
+        return waiting
+
+    assert asyncio.run(run())
+    assert written_texts(fake) == ["0", "1", "2"]
+
+def test_documents_are_written_in_order(messages):
+    fake, collection = messages
+    buffer = main.MessageWriteBuffer(collection, batch_size=4, flush_interval=0.05, limit=100)
+
+    async def run():
+        buffer.start()
+        for document in documents(10):
+            await buffer.add(document)
+        await buffer.close()
+
+    asyncio.run(run())
+    assert written_texts(fake) == [str(number) for number in range(10)]
+    assert fake.calls.count("insert_many") == 3
+
+def test_retry_skips_already_written_documents(messages):
+    # Прошлая попытка успела записать начало пакета: повтор дописывает остальное без дублей
+    fake, collection = messages
+    batch = [dict(document, _id=ObjectId()) for document in documents(5)]
+    for document in batch[:2]:
+        fake.documents[document["_id"]] = dict(document)
+
+    asyncio.run(main.insert_without_duplicates(collection, batch))
+    assert written_texts(fake) == ["0", "1", "2", "3", "4"]
+
+def test_close_drains_pending_documents(messages):
+    fake, collection = messages
+    buffer = main.MessageWriteBuffer(collection, batch_size=100, flush_interval=10, limit=100)
+
+    async def run():
+        buffer.start()
+        for document in documents(5):
+            await buffer.add(document)
+        await buffer.close()
+        return len(buffer)
+
+    assert asyncio.run(run()) == 0
+    assert written_texts(fake) == ["0", "1", "2", "3", "4"]